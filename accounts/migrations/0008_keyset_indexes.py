@@ -0,0 +1,21 @@
+# Generated by Django 6.0.4 on 2026-10-17 02:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0007_address_latitude_longitude'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='authenticationaudit',
+            index=models.Index(fields=['timestamp', 'id'], name='authenticat_timesta_ab77d5_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='dataaccesslog',
+            index=models.Index(fields=['timestamp', 'id'], name='data_access_timesta_5b55c3_idx'),
+        ),
+    ]
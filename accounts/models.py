@@ -443,6 +443,7 @@ class AuthenticationAudit(models.Model):
             models.Index(fields=["action", "timestamp"]),
             models.Index(fields=["platform", "timestamp"]),
             models.Index(fields=["ip_address", "timestamp"]),
+            models.Index(fields=["timestamp", "id"]),
         ]
 
     def __str__(self):
@@ -499,6 +500,7 @@ class DataAccessLog(models.Model):
             models.Index(fields=["user", "timestamp"]),
             models.Index(fields=["data_type", "timestamp"]),
             models.Index(fields=["platform", "timestamp"]),
+            models.Index(fields=["timestamp", "id"]),
         ]
 
     def __str__(self):
@@ -5,9 +5,19 @@ from loguru import logger
 from jinja2 import Environment, FileSystemLoader
 import os
 from typing import Dict
+from functools import lru_cache
 import io
 
 
+@lru_cache(maxsize=None)
+def email_template():
+    """The compiled email template, parsed once per worker process."""
+    env = Environment(
+        loader=FileSystemLoader(os.path.join(os.path.dirname(__file__), "templates"))
+    )
+    return env.get_template("email_template.html")
+
+
 @shared_task
 def generic_send_mail(
     recipient: str, title: str, payload: Dict[str, str] = {}, email_type: str = None
@@ -55,20 +65,12 @@ def generic_send_mail(
             email_type="login"
         )
     """
-    env = Environment(
-        loader=FileSystemLoader(os.path.join(os.path.dirname(__file__), "templates"))
-    )
-
-    template_file = "email_template.html"
-    template = env.get_template(template_file)
-
-    # Add current year to payload
     from datetime import datetime
 
-    payload["current_year"] = datetime.now().year
-    payload["email_type"] = email_type
-
-    html_message = template.render(payload)
+    # Add current year and email type to the template context
+    html_message = email_template().render(
+        payload, current_year=datetime.now().year, email_type=email_type
+    )
     logger.info(f"sending email to {recipient}")
     try:
         base_url = settings.AWS_EMAIL_URL
@@ -10,6 +10,7 @@ class AdminModelViewSet(viewsets.ModelViewSet):
     Base for every admin_api resource. Admin-only, paginated, with search,
     filter, and ordering wired up. Resource viewsets set queryset,
     serializer_class, search_fields, filterset_fields, ordering_fields.
+    `?cursor=` switches a list to keyset pages on (cursor_ordering, pk).
     """
 
     permission_classes = [IsPlatformAdmin]
@@ -20,6 +21,7 @@ class AdminModelViewSet(viewsets.ModelViewSet):
         filters.OrderingFilter,
     ]
     ordering = ["-id"]
+    cursor_ordering = "-created_at"
 
 
 class AdminReadOnlyViewSet(viewsets.ReadOnlyModelViewSet):
@@ -33,3 +35,4 @@ class AdminReadOnlyViewSet(viewsets.ReadOnlyModelViewSet):
         filters.OrderingFilter,
     ]
     ordering = ["-id"]
+    cursor_ordering = "-created_at"
@@ -116,6 +116,7 @@ class SecurityEventAdminViewSet(AdminReadOnlyViewSet):
     search_fields = ["user__email", "ip_address"]
     filterset_fields = ["event_type", "severity", "is_resolved", "user"]
     ordering_fields = ["timestamp", "severity"]
+    cursor_ordering = "-timestamp"
 
     @action(detail=True, methods=["post"])
     def resolve(self, request, pk=None):
@@ -135,6 +136,7 @@ class AuthAuditAdminViewSet(AdminReadOnlyViewSet):
     search_fields = ["user__email", "ip_address", "endpoint"]
     filterset_fields = ["action", "success", "user", "platform"]
     ordering_fields = ["timestamp"]
+    cursor_ordering = "-timestamp"
 
 
 class DataAccessLogAdminViewSet(AdminReadOnlyViewSet):
@@ -143,6 +145,7 @@ class DataAccessLogAdminViewSet(AdminReadOnlyViewSet):
     search_fields = ["user__email", "resource_name", "resource_id"]
     filterset_fields = ["data_type", "access_type", "user", "platform"]
     ordering_fields = ["timestamp"]
+    cursor_ordering = "-timestamp"
 
 
 def register(router):
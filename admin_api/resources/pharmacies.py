@@ -29,6 +29,10 @@ from pharmacies.serializers import (
     SettlementPayoutSerializer,
     PaymentMethodSerializer,
 )
+from pharmacies.settlement_service import (
+    annotate_settlements,
+    settlement_orders_prefetch,
+)
 from admin_api.base import AdminModelViewSet, AdminReadOnlyViewSet
 
 
@@ -119,11 +123,17 @@ class PaymentAdminViewSet(AdminReadOnlyViewSet):
 
 
 class SettlementAdminViewSet(AdminReadOnlyViewSet):
-    queryset = Settlement.objects.select_related("pharmacy").all()
+    queryset = annotate_settlements(Settlement.objects.select_related("pharmacy"))
     serializer_class = SettlementListSerializer
     filterset_fields = ["status", "pharmacy"]
     ordering_fields = ["settlement_date"]
 
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.action == "retrieve":
+            queryset = queryset.prefetch_related(settlement_orders_prefetch())
+        return queryset
+
     def get_serializer_class(self):
         if self.action == "retrieve":
             return SettlementDetailSerializer
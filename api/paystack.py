@@ -1,7 +1,38 @@
 import json
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
 from django.conf import settings
 from django.core.cache import cache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# All Paystack calls share one Session, so connections (and their TLS
+# handshakes) are kept alive and reused across calls and threads. urllib3
+# retries connection errors for every method, but retries 429/5xx responses
+# only for idempotent methods (GET, PUT, DELETE): a POST such as a transfer is
+# never replayed once Paystack may have received it.
+_session = None
+
+
+def get_session() -> requests.Session:
+    """Shared keep-alive session for Paystack calls."""
+    global _session
+    if _session is None:
+        retry = Retry(
+            total=settings.PAYSTACK_MAX_RETRIES,
+            backoff_factor=settings.PAYSTACK_RETRY_BACKOFF,
+            status_forcelist=(429, 500, 502, 503, 504),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_maxsize=settings.PAYSTACK_MAX_CONCURRENCY, max_retries=retry
+        )
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        _session = session
+    return _session
 
 
 class PayStack:
@@ -9,22 +40,20 @@ class PayStack:
     PAYSTACK_PUBLIC_KEY = settings.PAYSTACK_PUBLIC_KEY
     HEADERS = {"Authorization": f"Bearer {PAYSTACK_PRIVATE_KEY}"}
 
-    base_url = "https://api.paystack.co"
+    base_url = settings.PAYSTACK_BASE_URL
 
     def make_request(self, method: str, path: str, **kwargs) -> requests.Response:
         """Helper function to make the appropriate request to paystack"""
-        options = {
-            "GET": requests.get,
-            "POST": requests.post,
-            "PUT": requests.put,
-            "DELETE": requests.delete,
-        }
         url = "{}{}".format(self.base_url, path)
         headers = {
             "Authorization": "Bearer {}".format(self.PAYSTACK_PRIVATE_KEY),
             "Content-Type": "application/json",
         }
-        return options[method](url, headers=headers, **kwargs)
+        kwargs.setdefault(
+            "timeout",
+            (settings.PAYSTACK_CONNECT_TIMEOUT, settings.PAYSTACK_READ_TIMEOUT),
+        )
+        return get_session().request(method, url, headers=headers, **kwargs)
 
     def initialize_payment(self, data):
         path = "/transaction/initialize"
@@ -64,9 +93,8 @@ class PayStack:
         data = []
         telco_list = cache.get("telco-list")
         if not telco_list:
-            paystack_base_url = f"{self.base_url}/bank?country=ghana"
             # make API Call
-            response = requests.get(url=paystack_base_url, headers=self.HEADERS)
+            response = self.make_request("GET", "/bank?country=ghana")
 
             # data
             if response.status_code == 200:
@@ -89,9 +117,8 @@ class PayStack:
         bank_list = cache.get("bank-list")
 
         if not bank_list:
-            paystack_base_url = f"{self.base_url}/bank?country=ghana"
             # make API Call
-            response = requests.get(url=paystack_base_url, headers=self.HEADERS)
+            response = self.make_request("GET", "/bank?country=ghana")
 
             if response.status_code == 200:
                 body = json.loads(response.text)
@@ -117,15 +144,10 @@ class PayStack:
     def verify_account_number(self, account_number, bank_code):
 
         # make api call to paystack to verify account number
-        paystack_base_url = f"{self.base_url}/bank/resolve"
         params = {"account_number": account_number, "bank_code": bank_code}
 
         # make request
-        response = requests.get(
-            url=paystack_base_url,
-            headers=self.HEADERS,
-            params=params,
-        )
+        response = self.make_request("GET", "/bank/resolve", params=params)
 
         if response.status_code == 200:
             body = json.loads(response.text)
@@ -137,7 +159,6 @@ class PayStack:
             return False, "Failed to verify account number"
 
     def create_recipient(self, data):
-        url = f"{self.base_url}/transferrecipient"
         body = {
             "type": data["type"],
             "name": data["name"],
@@ -145,11 +166,7 @@ class PayStack:
             "bank_code": data["bank_code"],
             "currency": data["currency"],
         }
-        response = requests.post(
-            url=url,
-            headers=self.HEADERS,
-            json=body,
-        )
+        response = self.make_request("POST", "/transferrecipient", json=body)
 
         if response.status_code == 201:
             body = json.loads(response.text)
@@ -160,7 +177,6 @@ class PayStack:
             return False, "Failed to create recipient"
 
     def initiate_transfer(self, data):
-        url = f"{self.base_url}/transfer"
         body = {
             "source": "balance",
             "amount": data["amount"],
@@ -169,11 +185,7 @@ class PayStack:
             "reason": data["reason"],
         }
 
-        response = requests.post(
-            url=url,
-            headers=self.HEADERS,
-            json=body,
-        )
+        response = self.make_request("POST", "/transfer", json=body)
 
         body = json.loads(response.text)
         if response.status_code == 200:
@@ -187,3 +199,24 @@ class PayStack:
         path = "/transfer/verify/{}".format(reference)
         response = self.make_request("GET", path)
         return self.verify_result(response)
+
+    def verify_transfers(self, references, max_workers=None):
+        """
+        verify_transfer for many references at once, at most `max_workers`
+        (default settings.PAYSTACK_MAX_CONCURRENCY) in flight over the shared
+        session. Returns {reference: (success, data|message)}; a request that
+        fails outright reports (False, error).
+        """
+
+        def verify(reference):
+            try:
+                return self.verify_transfer(reference)
+            except (requests.RequestException, ValueError) as exc:
+                return False, str(exc)
+
+        references = list(references)
+        max_workers = min(
+            max_workers or settings.PAYSTACK_MAX_CONCURRENCY, len(references) or 1
+        )
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            return dict(zip(references, pool.map(verify, references)))
@@ -22,7 +22,8 @@ class MessageAdmin(ModelAdmin):
         "is_read",
         "created_at",
     ]
-    list_filter = ["is_read", "created_at"]
+    list_filter = ["created_at"]
+    list_select_related = ["chat"]
     search_fields = ["chat__patient__patient_id", "chat__professional__user__email"]
     readonly_fields = ["id", "created_at", "get_full_content"]
 
@@ -0,0 +1,275 @@
+"""
+Benchmarks for chat hot paths, registered with the pharmacy benchmarks and
+run with `manage.py benchmark <name>`. Same rules: throwaway data, removed
+afterwards, never against production.
+"""
+
+import asyncio
+import time
+import uuid
+
+from asgiref.sync import async_to_sync
+from channels.testing import WebsocketCommunicator
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, override_settings
+
+from accounts.models import CustomUser
+from patients.models import PatientProfile
+from pharmacies.benchmarks import benchmark
+from professionals.models import ProfessionalProfile
+from . import write_behind_service
+from .consumers import ChatConsumer
+from .message_service import open_session, post_message
+from .models import Chat, Message
+
+
+class ChatFixture:
+    """One professional chatting with `size` patients, torn down by `cleanup()`."""
+
+    def __init__(self, size):
+        tag = uuid.uuid4().hex[:8]
+        self.users = []
+        professional_user = self.user(f"bench-doc-{tag}")
+        self.professional = ProfessionalProfile.objects.create(user=professional_user)
+        self.chats = []
+        for index in range(size):
+            patient = PatientProfile.objects.create(
+                user=self.user(f"bench-patient-{tag}-{index}"),
+                patient_id=f"bench-{tag}-{index}",
+            )
+            self.chats.append(
+                Chat.objects.create(patient=patient, professional=self.professional)
+            )
+
+    def user(self, username):
+        user = CustomUser.objects.create(
+            username=username, email=f"{username}@example.com"
+        )
+        self.users.append(user)
+        return user
+
+    def cleanup(self):
+        CustomUser.objects.filter(pk__in=[user.pk for user in self.users]).delete()
+
+
+async def _connect(chat):
+    communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), f"/ws/chat/{chat.pk}/")
+    communicator.scope["user"] = chat.patient.user
+    communicator.scope["url_route"] = {"kwargs": {"chat_id": str(chat.pk)}}
+    connected, _ = await communicator.connect()
+    return communicator if connected else None
+
+
+async def _converse(communicators, iterations):
+    """
+    Send `iterations` messages, each after the previous one's broadcast
+    came back, on each connection, concurrently: the way one Channels
+    worker serves them. Returns the seconds taken (including draining the
+    write-behind queue) and the number of broadcasts received.
+    """
+
+    async def converse(communicator):
+        received = 0
+        # Waiting for each broadcast also keeps the channel under the
+        # layer's capacity.
+        for index in range(iterations):
+            await communicator.send_json_to({"content": f"message {index}"})
+            reply = await communicator.receive_json_from(timeout=30)
+            received += "message" in reply
+        return received
+
+    started = time.perf_counter()
+    received = await asyncio.gather(*(converse(c) for c in communicators if c))
+    while await write_behind_service.flush():
+        pass
+    return time.perf_counter() - started, sum(received)
+
+
+async def _disconnect(communicators):
+    for communicator in communicators:
+        if communicator:
+            await communicator.disconnect()
+
+
+def _saved_in_order(fixture, iterations):
+    return all(
+        list(
+            Message.objects.filter(chat=chat)
+            .order_by("created_at", "id")
+            .values_list("content", flat=True)
+        )
+        == [f"message {index}" for index in range(iterations)]
+        for chat in fixture.chats
+    )
+
+
+@benchmark("chat-messages")
+def chat_messages(stdout, workers=8, iterations=200):
+    """
+    Drive `iterations` messages on each of `workers` concurrent connections
+    through ChatConsumer and report messages per second per worker. Checks
+    every message was stored, in order, with one INSERT and one UPDATE each.
+    """
+    fixture = ChatFixture(workers)
+    try:
+        chat = fixture.chats[0]
+        session = open_session(chat.pk, chat.patient.user)
+        with CaptureQueriesContext(connection) as queries:
+            post_message(session, "warm-up")
+        statements = [query["sql"].split()[0] for query in queries.captured_queries]
+        per_message = len(statements)
+        Message.objects.filter(chat=chat).delete()
+
+        async def run():
+            communicators = [await _connect(chat) for chat in fixture.chats]
+            try:
+                return await _converse(communicators, iterations)
+            finally:
+                await _disconnect(communicators)
+
+        with override_settings(CHAT_WRITE_BEHIND=False):
+            elapsed, received = async_to_sync(run)()
+        total = workers * iterations
+        stdout.write(
+            f"{total} messages on {workers} connections in {elapsed:.2f}s: "
+            f"{total / elapsed:.0f} messages/s per worker, "
+            f"{per_message} queries per message"
+        )
+        return (
+            # Django logs the transaction's BEGIN and COMMIT too.
+            statements == ["BEGIN", "UPDATE", "INSERT", "COMMIT"]
+            and received == total
+            and _saved_in_order(fixture, iterations)
+        )
+    finally:
+        fixture.cleanup()
+
+
+@benchmark("chat-write-behind")
+def chat_write_behind(stdout, workers=8, iterations=200):
+    """
+    Run the chat-messages workload with per-message inserts and then in
+    write-behind mode, and compare messages per second per worker. The
+    write-behind time includes draining the queue, so every message is in
+    the database when the clock stops. Checks both modes saved everything,
+    in order.
+    """
+    fixture = ChatFixture(workers * 2)
+    modes = {
+        False: fixture.chats[:workers],
+        True: fixture.chats[workers:],
+    }
+    try:
+        # Every connection is opened before either run and closed after
+        # both: with channels_redis, connections opened after others in the
+        # same process have disconnected can stop receiving.
+        async def compare():
+            communicators = {}
+            for write_behind, chats in modes.items():
+                with override_settings(CHAT_WRITE_BEHIND=write_behind):
+                    communicators[write_behind] = [
+                        await _connect(chat) for chat in chats
+                    ]
+            try:
+                return {
+                    write_behind: await _converse(connections, iterations)
+                    for write_behind, connections in communicators.items()
+                }
+            finally:
+                for connections in communicators.values():
+                    await _disconnect(connections)
+
+        total = workers * iterations
+        passed = True
+        for write_behind, (elapsed, received) in async_to_sync(compare)().items():
+            mode = "write-behind" if write_behind else "per-message insert"
+            stdout.write(
+                f"{mode}: {total} messages in {elapsed:.2f}s, "
+                f"{total / elapsed:.0f} messages/s per worker"
+            )
+            fixture.chats = modes[write_behind]
+            passed = (
+                passed and received == total and _saved_in_order(fixture, iterations)
+            )
+        return passed
+    finally:
+        fixture.chats = modes[False] + modes[True]
+        fixture.cleanup()
+
+
+@benchmark("chat-history")
+def chat_history(stdout, workers=1, iterations=50, size=20000):
+    """
+    Time the newest page of a `size`-message chat three ways: the old
+    page-number last page (COUNT + OFFSET), a keyset page from Postgres (an
+    `after` cursor with the cache cold) and a page from the recent-messages
+    cache. Checks all three return the same messages and the cached page
+    makes no query.
+    """
+    from django.conf import settings
+    from django.utils import timezone
+
+    from helpers.redis_client import get_redis
+    from .history_service import message_page, recent_key
+
+    fixture = ChatFixture(1)
+    chat = fixture.chats[0]
+    try:
+        started = timezone.now()
+        messages = Message.objects.bulk_create(
+            (
+                Message(
+                    chat=chat,
+                    patient=chat.patient,
+                    content=f"message {index}",
+                    created_at=started + timezone.timedelta(milliseconds=index),
+                )
+                for index in range(size)
+            ),
+            batch_size=5000,
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(f"ANALYZE {Message._meta.db_table}")
+        page_size = settings.REST_FRAMEWORK["PAGE_SIZE"]
+
+        def numbered():
+            messages = Message.objects.filter(chat=chat).order_by("created_at")
+            count = messages.count()
+            return list(messages[max(count - page_size, 0) : count])
+
+        anchor = messages[-page_size - 1].id
+
+        def keyset():
+            return message_page(chat, after=anchor, limit=page_size)[0]
+
+        def cached():
+            return message_page(chat, limit=page_size)[0]
+
+        get_redis().delete(recent_key(chat.pk))
+        results = {}
+        for name, fetch in (
+            ("page-number", numbered),
+            ("keyset", keyset),
+            ("cached", cached),
+        ):
+            if name == "cached":
+                fetch()  # loads the cache
+            with CaptureQueriesContext(connection) as queries:
+                began = time.perf_counter()
+                for _ in range(iterations):
+                    page = fetch()
+                elapsed = (time.perf_counter() - began) / iterations
+            results[name] = [message.id for message in page]
+            stdout.write(
+                f"{name}: {elapsed * 1000:.2f}ms, "
+                f"{len(queries.captured_queries) / iterations:.0f} queries per page"
+            )
+            if name == "cached":
+                cached_queries = len(queries.captured_queries)
+        get_redis().delete(recent_key(chat.pk))
+        return (
+            cached_queries == 0
+            and results["page-number"] == results["keyset"] == results["cached"]
+        )
+    finally:
+        fixture.cleanup()
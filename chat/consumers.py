@@ -3,9 +3,16 @@ from channels.generic.websocket import (
     AsyncJsonWebsocketConsumer,
 )  # AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from .models import Chat, Message
-from helpers import exceptions
+from . import write_behind_service
+from .message_service import (
+    chat_group,
+    mark_read,
+    message_payload,
+    open_session,
+    post_message,
+)
 
 User = get_user_model()
 
@@ -22,17 +29,18 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
             return
 
         self.chat_id = self.scope["url_route"]["kwargs"]["chat_id"]
-        self.chat_group_name = f"chat_{self.chat_id}"
+        self.chat_group_name = chat_group(self.chat_id)
 
-        # Verify user has access to this chat
-        chat = await self.get_chat(self.chat_id)
-        if not chat:
+        # Resolve the chat, its participants and the user's roles once; the
+        # session also verifies the user has access to this chat
+        self.session = await self.open_session()
+        if self.session is None:
             await self.close()
             return
 
-        if not await self.has_chat_access(chat):
-            await self.close()
-            return
+        self.write_behind = settings.CHAT_WRITE_BEHIND
+        if self.write_behind:
+            write_behind_service.start_flusher()
 
         # Join chat room group
         await self.channel_layer.group_add(self.chat_group_name, self.channel_name)
@@ -47,35 +55,50 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
         """Receive message from WebSocket"""
         try:
             data = json.loads(text_data)
-            message_content = data.get("content", "").strip()
             role = data.get("role", None)  # Optional: "patient" or "professional"
 
+            if data.get("type") == "read":
+                # Read receipt: move the user's read cursor, tell the group
+                message_id = data.get("message_id")
+                if self.write_behind and message_id:
+                    # The message may be broadcast but still queued
+                    await write_behind_service.flush_through(message_id)
+                cursor = await self.mark_read(message_id, role=role)
+                if cursor:
+                    await self.channel_layer.group_send(
+                        self.chat_group_name, {"type": "chat_read", "read": cursor}
+                    )
+                return
+
+            message_content = data.get("content", "").strip()
+
             if not message_content:
                 await self.send(
                     text_data=json.dumps({"error": "Message content cannot be empty"})
                 )
                 return
 
-            # Get chat
-            chat = await self.get_chat(self.chat_id)
-            if not chat:
-                await self.send(text_data=json.dumps({"error": "Chat not found"}))
-                return
-
-            # Create and save message
-            message = await self.create_message(chat, message_content, role=role)
+            if self.write_behind:
+                # Queue the message (saved by the flusher) under the client's id
+                message = await write_behind_service.enqueue(
+                    self.session,
+                    message_content,
+                    role=role,
+                    message_id=data.get("id"),
+                    reply_channel=self.channel_name,
+                )
+            else:
+                # Create and save message
+                message = message_payload(
+                    *await self.create_message(message_content, role=role)
+                )
 
             # Send message to chat group
             await self.channel_layer.group_send(
                 self.chat_group_name,
                 {
                     "type": "chat_message",
-                    "message": {
-                        "id": str(message.id),
-                        "content": message.content,
-                        "sender_type": "patient" if message.patient else "professional",
-                        "created_at": message.created_at.isoformat(),
-                    },
+                    "message": message,
                 },
             )
         except json.JSONDecodeError:
@@ -91,92 +114,39 @@ class ChatConsumer(AsyncJsonWebsocketConsumer):
         # Send message to WebSocket
         await self.send(text_data=json.dumps({"message": message}))
 
-    @database_sync_to_async
-    def get_chat(self, chat_id):
-        """Get chat by ID"""
-        try:
-            return Chat.objects.get(id=chat_id)
-        except Chat.DoesNotExist:
-            return None
+    async def chat_read(self, event):
+        """Receive a read receipt from chat group"""
+        await self.send(text_data=json.dumps({"read": event["read"]}))
+
+    async def chat_persist_failed(self, event):
+        """Write-behind messages of this connection that could not be saved"""
+        await self.send(
+            text_data=json.dumps(
+                {
+                    "error": "Messages could not be saved, please resend them",
+                    "message_ids": event["message_ids"],
+                }
+            )
+        )
 
     @database_sync_to_async
-    def has_chat_access(self, chat):
-        """Check if user has access to this chat"""
-        # User can access if they are either the patient or the professional in this chat
-        is_patient = chat.patient.user == self.user
-        is_professional = chat.professional.user == self.user
-        return is_patient or is_professional
+    def open_session(self):
+        """Chat session of this user, or None if the chat is missing or not theirs"""
+        return open_session(self.chat_id, self.user)
 
     @database_sync_to_async
-    def create_message(self, chat, content, role=None):
+    def create_message(self, content, role=None):
         """
-        Create a new message with smart role detection.
+        Create a new message as the role the user holds in this chat.
 
-        Role determination priority:
-        1. Explicit role specified in message (if user has both profiles)
-        2. Chat context (if user is patient in this chat, use patient profile)
-        3. Default based on available profiles
+        A user with both profiles may pick the role with `role`; otherwise
+        they send as the patient if they are this chat's patient.
         """
-        message = Message(chat=chat)
-
-        # Check what profiles the user has
-        has_patient = hasattr(self.user, "patient_profile")
-        has_professional = hasattr(self.user, "professional_profile")
+        return post_message(self.session, content, role=role)
 
-        if not has_patient and not has_professional:
-            raise exceptions.GeneralException(
-                "User must have either a patient or professional profile"
-            )
-
-        # Smart role determination
-        if has_patient and has_professional:
-            # User has both profiles - need to determine which one to use
-            if role:
-                # Explicit role specified
-                if role.lower() == "patient":
-                    message.patient = self.user.patient_profile
-                elif role.lower() in ["professional", "provider"]:
-                    message.provider = self.user.professional_profile
-                else:
-                    raise exceptions.GeneralException(
-                        f"Invalid role '{role}'. Must be 'patient' or 'professional'"
-                    )
-            else:
-                # Determine from chat context
-                # If user is the patient in this chat, they're acting as patient
-                if chat.patient.user == self.user:
-                    message.patient = self.user.patient_profile
-                # If user is the professional in this chat, they're acting as professional
-                elif chat.professional.user == self.user:
-                    message.provider = self.user.professional_profile
-                else:
-                    # This shouldn't happen due to access control, but handle gracefully
-                    raise exceptions.GeneralException(
-                        "Cannot determine role. Please specify 'role' in message or ensure you're part of this chat"
-                    )
-        elif has_patient:
-            # User only has patient profile
-            message.patient = self.user.patient_profile
-        elif has_professional:
-            # User only has professional profile
-            message.provider = self.user.professional_profile
-
-        # Verify the selected role matches the chat
-        # Prevent sending as wrong role (e.g., patient sending as professional in their own chat)
-        if message.patient and chat.patient != message.patient:
-            raise exceptions.GeneralException(
-                "Cannot send message as patient: you are not the patient in this chat"
-            )
-        if message.provider and chat.professional != message.provider:
-            raise exceptions.GeneralException(
-                "Cannot send message as professional: you are not the professional in this chat"
-            )
-
-        # Set message content
-        message.content = content
-        message.save()
-
-        # Update chat updated_at
-        chat.save(update_fields=["updated_at"])
-
-        return message
+    @database_sync_to_async
+    def mark_read(self, message_id=None, role=None):
+        """Move the user's read cursor up to `message_id` (default: the latest)"""
+        return mark_read(
+            self.chat_id, self.session.sender_role(role), message_id=message_id
+        )
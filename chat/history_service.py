@@ -0,0 +1,256 @@
+"""
+Chat message history: keyset pages and a Redis cache of recent messages.
+
+History is paged with cursors over (created_at, id): `before` a message
+id returns the messages just older than it, `after` one the messages just
+newer, and neither the newest. Every page is an indexed range scan on
+(chat, created_at, id), however far back it is.
+
+The last CHAT_RECENT_MESSAGES messages of each chat with messages posted
+or loaded in the past CHAT_RECENT_TTL seconds are also kept in a capped Redis list,
+appended to as messages are posted (or queued, in write-behind mode). A list
+always holds the newest messages of its chat with no gaps, so any page that
+falls inside it is served without touching Postgres, as opening a chat and
+catching up after a reconnect usually are. A list that starts at the
+chat's first message begins with a START marker, so short chats are served
+from Redis too. A newest-page request that misses the cache loads the list
+from Postgres, merging in whatever was appended meanwhile.
+"""
+
+import json
+import uuid
+
+import redis
+from django.conf import settings
+from django.db.models import Q, Subquery
+from django.utils.dateparse import parse_datetime
+from loguru import logger
+
+from helpers import exceptions
+from helpers.redis_client import get_redis
+from .models import Message
+
+# First item of a list that reaches back to the chat's first message.
+START = "start"
+
+
+def recent_key(chat_id) -> str:
+    return f"chat:{chat_id}:recent"
+
+
+def entry(message) -> dict:
+    """The cached form of a message."""
+    return {
+        "id": str(message.id),
+        "patient_id": str(message.patient_id) if message.patient_id else None,
+        "provider_id": str(message.provider_id) if message.provider_id else None,
+        "content": message.content,
+        "created_at": message.created_at.isoformat(),
+    }
+
+
+def remember(pipe, chat_id, entries):
+    """Queue the commands appending `entries` to a chat's list on `pipe`."""
+    key = recent_key(chat_id)
+    pipe.rpush(key, *(json.dumps(item) for item in entries))
+    pipe.ltrim(key, -settings.CHAT_RECENT_MESSAGES, -1)
+    pipe.expire(key, settings.CHAT_RECENT_TTL)
+
+
+def forget(pipe, chat_id, entries):
+    """Queue the commands removing `entries` from a chat's list on `pipe`."""
+    key = recent_key(chat_id)
+    for item in entries:
+        pipe.lrem(key, 0, json.dumps(item))
+
+
+# KEYS[1]: a chat's list; ARGV: pairs of a cached entry and its replacement.
+# Entries are replaced where they stand, and only if still in the list.
+_REPLACE = """
+for i = 1, #ARGV, 2 do
+  local index = redis.call('LPOS', KEYS[1], ARGV[i])
+  if index then
+    redis.call('LSET', KEYS[1], index, ARGV[i + 1])
+  end
+end
+return 1
+"""
+
+
+def replace(pipe, chat_id, pairs):
+    """Queue the command swapping each (old, new) entry of a chat's list on `pipe`."""
+    pipe.eval(
+        _REPLACE,
+        1,
+        recent_key(chat_id),
+        *(json.dumps(item) for pair in pairs for item in pair),
+    )
+
+
+def remember_message(message):
+    """Append a just-saved message to its chat's list; a Redis outage only logs."""
+    try:
+        with get_redis().pipeline(transaction=False) as pipe:
+            remember(pipe, message.chat_id, [entry(message)])
+            pipe.execute()
+    except redis.RedisError as error:
+        logger.warning(f"Could not cache message {message.id}: {error}")
+
+
+def _key(item):
+    return item["created_at"], item["id"]
+
+
+def _ordered(items):
+    """Entries by (created_at, id) without duplicates, and whether START was among them."""
+    complete = START in items
+    unique = {}
+    for item in items:
+        if item != START:
+            unique[item["id"]] = item
+    return sorted(unique.values(), key=_key), complete
+
+
+def _cached(chat_id):
+    """The cached entries of a chat and whether they start at its first message, or None."""
+    try:
+        raw = get_redis().lrange(recent_key(chat_id), 0, -1)
+    except redis.RedisError as error:
+        logger.warning(f"Recent messages of chat {chat_id} unavailable: {error}")
+        return None
+    if not raw:
+        return None
+    items = [item if item == START else json.loads(item) for item in raw]
+    # Appends from different workers can land slightly out of order, and a
+    # message can be appended again after a reload picked it up.
+    return _ordered(items)
+
+
+def _fill(chat_id, entries, complete):
+    """Load a chat's list from Postgres rows, unless it changes while doing so."""
+    key = recent_key(chat_id)
+    limit = settings.CHAT_RECENT_MESSAGES
+    try:
+        with get_redis().pipeline() as pipe:
+            pipe.watch(key)
+            appended = [
+                json.loads(item) for item in pipe.lrange(key, 0, -1) if item != START
+            ]
+            merged, _ = _ordered(entries + appended)
+            complete = complete and len(merged) <= limit
+            pipe.multi()
+            pipe.delete(key)
+            pipe.rpush(
+                key,
+                *([START] if complete else []),
+                *(json.dumps(item) for item in merged[-limit:]),
+            )
+            pipe.expire(key, settings.CHAT_RECENT_TTL)
+            pipe.execute()
+    except redis.WatchError:
+        pass  # a message arrived meanwhile; the next request loads it again
+    except redis.RedisError as error:
+        logger.warning(f"Could not cache recent messages of chat {chat_id}: {error}")
+
+
+def _from_cache(cached, before, after, limit):
+    """
+    The page as (entries, has_older, has_newer) if the cached entries cover
+    it, else None.
+    """
+    entries, complete = cached
+    ids = [item["id"] for item in entries]
+    if after:
+        if after not in ids:
+            return None
+        start = ids.index(after) + 1
+        return entries[start : start + limit], True, len(entries) > start + limit
+    if before:
+        if before not in ids:
+            return None
+        end = ids.index(before)
+    else:
+        end = len(entries)
+    if end < limit and not complete:
+        return None
+    start = max(end - limit, 0)
+    return entries[start:end], start > 0 or not complete, end < len(entries)
+
+
+def _message(item, chat) -> Message:
+    return Message(
+        id=uuid.UUID(item["id"]),
+        chat=chat,
+        patient_id=item["patient_id"],
+        provider_id=item["provider_id"],
+        content=item["content"],
+        created_at=parse_datetime(item["created_at"]),
+    )
+
+
+def _cursor(value, name):
+    if not value:
+        return None
+    try:
+        return str(uuid.UUID(str(value)))
+    except ValueError:
+        raise exceptions.GeneralException(f"Invalid {name} cursor '{value}'")
+
+
+def _beyond(messages, chat, message_id, newer):
+    """`messages` strictly newer (or older) than message `message_id` of `chat`."""
+    created_at = Subquery(
+        Message.objects.filter(pk=message_id, chat=chat)
+        .order_by()
+        .values("created_at")[:1]
+    )
+    lookup = "gt" if newer else "lt"
+    return messages.filter(
+        Q(**{f"created_at__{lookup}": created_at})
+        | Q(created_at=created_at, **{f"id__{lookup}": message_id})
+    )
+
+
+def message_page(chat, before=None, after=None, limit=50):
+    """
+    A page of at most `limit` messages of `chat`, oldest first, ending just
+    before message `before`, starting just after message `after`, or the
+    newest. Returns (messages, has_older, has_newer); the messages carry
+    `chat`, so their `is_read` needs no query.
+    """
+    before, after = _cursor(before, "before"), _cursor(after, "after")
+    cached = _cached(chat.pk)
+    if cached is not None and limit <= settings.CHAT_RECENT_MESSAGES:
+        page = _from_cache(cached, before, after, limit)
+        if page is not None:
+            entries, has_older, has_newer = page
+            return [_message(item, chat) for item in entries], has_older, has_newer
+
+    messages = Message.objects.filter(chat=chat)
+    if after:
+        rows = list(
+            _beyond(messages, chat, after, newer=True).order_by("created_at", "id")[
+                : limit + 1
+            ]
+        )
+        for message in rows:
+            message.chat = chat
+        return rows[:limit], True, len(rows) > limit
+
+    if before:
+        messages = _beyond(messages, chat, before, newer=False)
+    # The newest page also loads the cache, so it reads a whole list's worth.
+    size = limit if before else max(limit, settings.CHAT_RECENT_MESSAGES)
+    rows = list(messages.order_by("-created_at", "-id")[: size + 1])
+    if not before:
+        _fill(
+            chat.pk,
+            [entry(message) for message in rows[: settings.CHAT_RECENT_MESSAGES]],
+            complete=len(rows) <= settings.CHAT_RECENT_MESSAGES,
+        )
+    has_older = len(rows) > limit
+    rows = rows[:limit]
+    rows.reverse()
+    for message in rows:
+        message.chat = chat
+    return rows, has_older, bool(before)
@@ -0,0 +1,66 @@
+"""
+Chat inbox queries.
+
+The inbox lists a user's chats with each chat's last message and the number
+of messages unread by the user. The last message is a correlated subquery
+annotated onto the chat query, the unread count is a counter on the chat,
+and both participants are joined in, so an inbox page is a single query
+however many chats it shows.
+"""
+
+from django.db.models import F, IntegerField, JSONField, OuterRef, Q, Subquery, Value
+from django.db.models.functions import JSONObject
+
+from .models import Chat, Message
+
+
+def user_chats(user):
+    """Chats where `user` is the patient or the professional."""
+    query = Q()
+    if hasattr(user, "patient_profile"):
+        query |= Q(patient=user.patient_profile)
+    if hasattr(user, "professional_profile"):
+        query |= Q(professional=user.professional_profile)
+    if not query:
+        return Chat.objects.none()
+    return Chat.objects.filter(query)
+
+
+def reader_role(user):
+    """
+    The side whose unread count `user` sees in the inbox. A user with both
+    profiles reads as the patient, as ChatSerializer always has.
+    """
+    if hasattr(user, "patient_profile"):
+        return "patient"
+    if hasattr(user, "professional_profile"):
+        return "professional"
+    return None
+
+
+def annotate_inbox(queryset, user):
+    """
+    `queryset` with both participants joined, and annotated with
+    `last_message_data` (a dict, or None for an empty chat) and `unread`.
+    """
+    last_message = Message.objects.filter(chat=OuterRef("pk")).order_by(
+        "-created_at", "-id"
+    )
+    queryset = queryset.select_related("patient", "professional__user").annotate(
+        last_message_data=Subquery(
+            last_message.values(
+                data=JSONObject(
+                    id="id",
+                    content="content",
+                    patient="patient_id",
+                    created_at="created_at",
+                )
+            )[:1],
+            output_field=JSONField(),
+        )
+    )
+    role = reader_role(user)
+    if role is None:
+        return queryset.annotate(unread=Value(0, output_field=IntegerField()))
+    # Kept up to date by message_service on every message and read receipt.
+    return queryset.annotate(unread=F(f"{role}_unread"))
@@ -0,0 +1,226 @@
+"""
+Chat message posting and read receipts.
+
+A WebSocket connection resolves everything a message needs once, in
+`open_session`: the chat, both participants' profile ids and the roles the
+user may act as.
+
+Read state is incremental. Each Chat counts the messages each side has
+sent and each side has not read, and keeps a read cursor (last message
+read and its time) per participant. Every message carries `sequence`, its
+position among its side's messages. Posting a message is one UPDATE of the
+chat (its side's count, the recipient's unread count, `updated_at`) and
+one INSERT; moving a read cursor is one indexed lookup of the target
+message and one UPDATE, with the unread count recomputed as the other
+side's count minus the target's sequence. Nothing counts messages.
+
+That only holds if `created_at` order is `sequence` order, so a message is
+timestamped under the chat's row lock: never earlier than just after the
+chat's `updated_at`, which every insert moves to its message's time.
+
+Posted messages are also appended to the chat's recent-messages cache
+(see history_service).
+"""
+
+import uuid
+from dataclasses import dataclass, field
+from datetime import timedelta
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import transaction
+from django.db.models import F, Q, Subquery, Value
+from django.db.models.functions import Greatest
+from loguru import logger
+
+from helpers import exceptions
+from .history_service import remember_message
+from .models import Chat, Message
+
+PATIENT = "patient"
+PROFESSIONAL = "professional"
+ROLE_ALIASES = {PATIENT: PATIENT, PROFESSIONAL: PROFESSIONAL, "provider": PROFESSIONAL}
+OTHER_SIDE = {PATIENT: PROFESSIONAL, PROFESSIONAL: PATIENT}
+# Message column holding each side's sender profile.
+SENDER_FIELD = {PATIENT: "patient", PROFESSIONAL: "provider"}
+# Least gap between the times of consecutive messages of a chat.
+TICK = timedelta(microseconds=1)
+
+
+@dataclass
+class ChatSession:
+    chat_id: object
+    patient_id: object
+    professional_id: object
+    # Roles the user holds in this chat, patient first.
+    roles: list = field(default_factory=list)
+    # Whether an explicit role on a message is honoured (the user has both
+    # profiles); otherwise the user always sends as their only profile.
+    chooses_role: bool = False
+
+    def sender_role(self, role=None) -> str:
+        """The role the user acts as (sends or reads as), given the role asked for."""
+        if not self.chooses_role or not role:
+            return self.roles[0]
+        chosen = ROLE_ALIASES.get(role.lower())
+        if chosen is None:
+            raise exceptions.GeneralException(
+                f"Invalid role '{role}'. Must be 'patient' or 'professional'"
+            )
+        if chosen not in self.roles:
+            raise exceptions.GeneralException(
+                f"Cannot send message as {chosen}: you are not the {chosen} in this chat"
+            )
+        return chosen
+
+
+def chat_group(chat_id) -> str:
+    """Channel layer group of a chat's WebSocket connections."""
+    return f"chat_{chat_id}"
+
+
+def open_session(chat_id, user):
+    """
+    The ChatSession of `user` in chat `chat_id`, or None when the chat
+    doesn't exist or the user is neither of its participants.
+    """
+    chat = (
+        Chat.objects.filter(pk=chat_id)
+        .values(
+            "patient_id",
+            "professional_id",
+            "patient__user_id",
+            "professional__user_id",
+        )
+        .first()
+    )
+    if chat is None:
+        return None
+    roles = []
+    if chat["patient__user_id"] == user.pk:
+        roles.append(PATIENT)
+    if chat["professional__user_id"] == user.pk:
+        roles.append(PROFESSIONAL)
+    if not roles:
+        return None
+    return ChatSession(
+        chat_id=chat_id,
+        patient_id=chat["patient_id"],
+        professional_id=chat["professional_id"],
+        roles=roles,
+        chooses_role=hasattr(user, "patient_profile")
+        and hasattr(user, "professional_profile"),
+    )
+
+
+def insert_message(message, sender):
+    """
+    Save a new message from `sender` and count it: one UPDATE of the chat
+    (which also locks it until the insert commits), then the INSERT, which
+    reads the message's sequence and time back from the chat row.
+    """
+    sent = f"{sender}_sent"
+    unread = f"{OTHER_SIDE[sender]}_unread"
+    chat = Chat.objects.filter(pk=message.chat_id)
+    with transaction.atomic():
+        chat.update(
+            updated_at=Greatest(Value(message.created_at), F("updated_at") + TICK),
+            **{sent: F(sent) + 1, unread: F(unread) + 1},
+        )
+        message.sequence = Subquery(chat.order_by().values(sent)[:1])
+        message.created_at = Subquery(chat.order_by().values("updated_at")[:1])
+        message.save(force_insert=True)
+    return message
+
+
+def post_message(session, content, role=None):
+    """Save a message from the session's user. Returns (message, sender role)."""
+    sender = session.sender_role(role)
+    message = Message(
+        chat_id=session.chat_id,
+        patient_id=session.patient_id if sender == PATIENT else None,
+        provider_id=session.professional_id if sender == PROFESSIONAL else None,
+        content=content,
+    )
+    insert_message(message, sender)
+    remember_message(message)
+    return message, sender
+
+
+def message_payload(message, sender) -> dict:
+    """The message as broadcast to the chat group."""
+    return {
+        "id": str(message.id),
+        "content": message.content,
+        "sender_type": sender,
+        "created_at": message.created_at.isoformat(),
+    }
+
+
+def mark_read(chat_id, reader, message_id=None):
+    """
+    Move `reader`'s read cursor in chat `chat_id` to the latest message
+    from the other side sent no later than message `message_id` (any
+    message of the chat), or to the other side's latest message. Cursors
+    only move forward. Returns the new cursor, or None if it didn't move.
+    """
+    other = OTHER_SIDE[reader]
+    messages = Message.objects.filter(
+        chat_id=chat_id, **{f"{SENDER_FIELD[other]}__isnull": False}
+    )
+    if message_id:
+        try:
+            message_id = uuid.UUID(str(message_id))
+        except ValueError:
+            raise exceptions.GeneralException(f"Invalid message id '{message_id}'")
+        messages = messages.filter(
+            created_at__lte=Subquery(
+                Message.objects.filter(pk=message_id, chat_id=chat_id).values(
+                    "created_at"
+                )[:1]
+            )
+        )
+    target = (
+        messages.order_by("-created_at", "-id")
+        .values("id", "created_at", "sequence")
+        .first()
+    )
+    if target is None:
+        return None
+    read_at = f"{reader}_read_at"
+    moved = (
+        Chat.objects.filter(pk=chat_id)
+        .filter(
+            Q(**{f"{read_at}__isnull": True})
+            | Q(**{f"{read_at}__lt": target["created_at"]})
+        )
+        .update(
+            **{
+                f"{reader}_read_message": target["id"],
+                read_at: target["created_at"],
+                f"{reader}_unread": Greatest(
+                    F(f"{other}_sent") - target["sequence"], Value(0)
+                ),
+            }
+        )
+    )
+    if not moved:
+        return None
+    return {
+        "reader": reader,
+        "message_id": str(target["id"]),
+        "read_at": target["created_at"].isoformat(),
+    }
+
+
+def publish_read(chat_id, cursor):
+    """Push a moved read cursor to the chat's connections; a layer outage only logs."""
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+    try:
+        async_to_sync(channel_layer.group_send)(
+            chat_group(chat_id), {"type": "chat.read", "read": cursor}
+        )
+    except Exception as exc:
+        logger.warning(f"Could not push read receipt for chat {chat_id}: {exc}")
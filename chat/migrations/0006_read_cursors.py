@@ -0,0 +1,118 @@
+# Generated by Django 6.0.4 on 2026-10-17 04:27
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def backfill_read_state(apps, schema_editor):
+    # Read state from the is_read flags it replaces.
+    Chat = apps.get_model('chat', 'Chat')
+    Message = apps.get_model('chat', 'Message')
+
+    # Number each side's messages in every chat, in send order.
+    numbered, chat_id, counts = [], None, {}
+    for message in (
+        Message.objects.order_by('chat_id', 'created_at', 'id')
+        .only('id', 'chat_id', 'patient_id')
+        .iterator(chunk_size=2000)
+    ):
+        if message.chat_id != chat_id:
+            chat_id, counts = message.chat_id, {True: 0, False: 0}
+        side = message.patient_id is not None
+        counts[side] += 1
+        message.sequence = counts[side]
+        numbered.append(message)
+        if len(numbered) >= 2000:
+            Message.objects.bulk_update(numbered, ['sequence'])
+            numbered = []
+    Message.objects.bulk_update(numbered, ['sequence'])
+
+    def sent_by(sender, **filters):
+        return Message.objects.filter(
+            chat=OuterRef('pk'), **{f'{sender}__isnull': False}, **filters
+        )
+
+    def count(messages):
+        return Coalesce(
+            Subquery(
+                messages.order_by().values('chat').annotate(n=Count('pk')).values('n')
+            ),
+            Value(0),
+        )
+
+    def last_read(messages, field):
+        return Subquery(
+            messages.filter(is_read=True).order_by('-created_at', '-id').values(field)[:1]
+        )
+
+    Chat.objects.update(
+        patient_sent=count(sent_by('patient')),
+        professional_sent=count(sent_by('provider')),
+        patient_unread=count(sent_by('provider', is_read=False)),
+        professional_unread=count(sent_by('patient', is_read=False)),
+        patient_read_at=last_read(sent_by('provider'), 'created_at'),
+        patient_read_message=last_read(sent_by('provider'), 'id'),
+        professional_read_at=last_read(sent_by('patient'), 'created_at'),
+        professional_read_message=last_read(sent_by('patient'), 'id'),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0005_message_created_at_default'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chat',
+            name='patient_read_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='patient_read_message',
+            field=models.UUIDField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='patient_sent',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='patient_unread',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='professional_read_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='professional_read_message',
+            field=models.UUIDField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='professional_sent',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='professional_unread',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='sequence',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(backfill_read_state, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='message',
+            name='is_read',
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 6.0.4 on 2026-10-17 04:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0006_read_cursors'),
+        ('patients', '0011_vitals_multi_log'),
+        ('professionals', '0009_add_is_student_to_professional_profile'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['chat', 'created_at', 'id'], name='messages_chat_id_6d46cf_idx'),
+        ),
+    ]
@@ -1,4 +1,5 @@
 from django.db import models
+from django.utils import timezone
 from patients.models import PatientProfile
 from professionals.models import ProfessionalProfile
 import uuid
@@ -21,6 +22,18 @@ class Chat(models.Model):
         on_delete=models.CASCADE,
         related_name="chats",
     )
+    # Messages sent by each side; a message's `sequence` is its side's count
+    # when it was sent.
+    patient_sent = models.PositiveIntegerField(default=0)
+    professional_sent = models.PositiveIntegerField(default=0)
+    # Messages from the other side each participant hasn't read yet.
+    patient_unread = models.PositiveIntegerField(default=0)
+    professional_unread = models.PositiveIntegerField(default=0)
+    # Read cursors: the last message from the other side each participant read.
+    patient_read_message = models.UUIDField(null=True, blank=True)
+    patient_read_at = models.DateTimeField(null=True, blank=True)
+    professional_read_message = models.UUIDField(null=True, blank=True)
+    professional_read_at = models.DateTimeField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -61,18 +74,33 @@ class Message(models.Model):
         blank=True,
     )
     content = models.TextField(help_text="Message content")
-    is_read = models.BooleanField(default=False)
-    created_at = models.DateTimeField(auto_now_add=True)
+    # Position among the messages its sender has sent in this chat, from 1.
+    sequence = models.PositiveIntegerField(default=0, editable=False)
+    # Not auto_now_add: write-behind messages keep the time they were sent.
+    created_at = models.DateTimeField(default=timezone.now, editable=False)
 
     class Meta:
         db_table = "messages"
         verbose_name = "Message"
         verbose_name_plural = "Messages"
         ordering = ["created_at"]
+        indexes = [
+            # History pages and the inbox's last message: keyset order per chat.
+            models.Index(fields=["chat", "created_at", "id"]),
+        ]
 
     def __str__(self):
         return f"Message in {self.chat} at {self.created_at}"
 
+    @property
+    def is_read(self):
+        """Whether the recipient's read cursor has reached this message."""
+        if self.patient_id:
+            read_at = self.chat.professional_read_at
+        else:
+            read_at = self.chat.patient_read_at
+        return read_at is not None and self.created_at <= read_at
+
 
 class AIChatSession(models.Model):
     """Model to store chat sessions"""
@@ -1,5 +1,7 @@
+from django.utils.dateparse import parse_datetime
 from rest_framework import serializers
 from .models import Chat, Message, AIChatSession, AIChatMessage
+from .inbox_service import reader_role
 from patients.serializers import PatientChatDetailSerializer
 from professionals.serializers import ProfessionalChatDetailSerializer
 
@@ -56,13 +58,32 @@ class ChatSerializer(serializers.ModelSerializer):
             "professional_detail",
             "last_message",
             "unread_count",
+            "patient_read_at",
+            "professional_read_at",
+            "created_at",
+            "updated_at",
+        )
+        read_only_fields = (
+            "id",
+            "patient_read_at",
+            "professional_read_at",
             "created_at",
             "updated_at",
         )
-        read_only_fields = ("id", "created_at", "updated_at")
 
     def get_last_message(self, obj):
         """Get the last message in the chat"""
+        if hasattr(obj, "last_message_data"):
+            # Annotated by inbox_service.annotate_inbox.
+            data = obj.last_message_data
+            if not data:
+                return None
+            return {
+                "id": data["id"],
+                "content": data["content"],
+                "sender_type": "patient" if data["patient"] else "professional",
+                "created_at": parse_datetime(data["created_at"]),
+            }
         last_msg = obj.messages.last()
         if last_msg:
             return {
@@ -75,18 +96,17 @@ class ChatSerializer(serializers.ModelSerializer):
 
     def get_unread_count(self, obj):
         """Get count of unread messages"""
+        if hasattr(obj, "unread"):
+            return obj.unread
         request = self.context.get("request")
         if not request or not request.user:
             return 0
 
-        # Determine current user type
-        if hasattr(request.user, "patient_profile"):
-            # Patient checking unread messages from professional
-            return obj.messages.filter(provider__isnull=False, is_read=False).count()
-        elif hasattr(request.user, "professional_profile"):
-            # Professional checking unread messages from patient
-            return obj.messages.filter(patient__isnull=False, is_read=False).count()
-        return 0
+        # Counters kept by message_service, for the user's side of the chat
+        role = reader_role(request.user)
+        if role is None:
+            return 0
+        return getattr(obj, f"{role}_unread")
 
 
 class MessageListSerializer(serializers.ModelSerializer):
@@ -111,9 +131,10 @@ class MessageListSerializer(serializers.ModelSerializer):
 
     def get_sender_type(self, obj):
         """Determine if sender is patient or professional"""
-        if obj.patient:
+        # By id: history pages don't load the senders.
+        if obj.patient_id:
             return "patient"
-        elif obj.provider:
+        elif obj.provider_id:
             return "professional"
         return None
 
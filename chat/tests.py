@@ -1,3 +1,521 @@
-# from django.test import TestCase
+import asyncio
+import json
+import uuid
+from datetime import timedelta
+from unittest import skipUnless
+from unittest.mock import patch
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from accounts.models import CustomUser
+from helpers import exceptions
+from helpers.redis_client import get_redis
+from patients.models import PatientProfile
+from professionals.models import ProfessionalProfile
+from . import history_service, write_behind_service
+from .consumers import ChatConsumer
+from .history_service import message_page, recent_key
+from .message_service import (
+    PATIENT,
+    PROFESSIONAL,
+    insert_message,
+    mark_read,
+    open_session,
+    post_message,
+)
+from .models import Chat, Message
+
+
+def make_patient(email):
+    user = CustomUser.objects.create(username=email, email=email)
+    # An explicit patient_id: generated ids are unique per minute only.
+    return PatientProfile.objects.create(
+        user=user, first_name=email.split("@")[0], patient_id=email
+    )
+
+
+def make_professional(email):
+    user = CustomUser.objects.create(username=email, email=email)
+    return ProfessionalProfile.objects.create(user=user)
+
+
+def send(chat, sender, content):
+    """Save a message from the chat's patient or professional, with its counters."""
+    if isinstance(sender, PatientProfile):
+        return insert_message(
+            Message(chat=chat, patient=sender, content=content), PATIENT
+        )
+    return insert_message(
+        Message(chat=chat, provider=sender, content=content), PROFESSIONAL
+    )
+
+
+class ChatInboxTests(TestCase):
+    def setUp(self):
+        self.professional = make_professional("doc@x.com")
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.professional.user)
+
+    def add_chats(self, count):
+        start = Chat.objects.count()
+        for index in range(start, start + count):
+            patient = make_patient(f"patient{index}@x.com")
+            chat = Chat.objects.create(patient=patient, professional=self.professional)
+            send(chat, patient, f"Hello {index}")
+            send(chat, self.professional, "Hi")
+            send(chat, patient, f"Last {index}")
+
+    def inbox(self):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get("/chat/chats/", {"page_size": 100})
+        self.assertEqual(response.status_code, 200)
+        return response.data, len(ctx.captured_queries)
+
+    def test_inbox_shows_last_message_and_unread_count(self):
+        self.add_chats(1)
+        empty = Chat.objects.create(
+            patient=make_patient("quiet@x.com"), professional=self.professional
+        )
+
+        data, _ = self.inbox()
+        rows = {row["id"]: row for row in data["results"]}
+        chat = Chat.objects.exclude(pk=empty.pk).get()
+        row = rows[str(chat.pk)]
+        self.assertEqual(row["last_message"]["content"], "Last 0")
+        self.assertEqual(row["last_message"]["sender_type"], "patient")
+        self.assertEqual(row["unread_count"], 2)
+        self.assertEqual(
+            row["professional_detail"]["user"]["id"], str(self.professional.user_id)
+        )
+        self.assertEqual(row["patient_detail"]["first_name"], "patient0")
+        self.assertIsNone(rows[str(empty.pk)]["last_message"])
+        self.assertEqual(rows[str(empty.pk)]["unread_count"], 0)
+
+    def test_mark_read_clears_unread_count_and_marks_messages_read(self):
+        self.add_chats(1)
+        chat = Chat.objects.get()
+
+        response = self.client.post(f"/chat/chats/{chat.pk}/mark_read/")
+        self.assertEqual(response.status_code, 200)
+        data, _ = self.inbox()
+        self.assertEqual(data["results"][0]["unread_count"], 0)
+        messages = self.client.get(f"/chat/chats/{chat.pk}/messages/").data["results"]
+        self.assertEqual(
+            [(m["sender_type"], m["is_read"]) for m in messages],
+            [("patient", True), ("professional", False), ("patient", True)],
+        )
+
+    def test_inbox_query_count_is_constant(self):
+        self.add_chats(3)
+        self.inbox()  # the user's profile lookups are cached after the first request
+        _, few = self.inbox()
+        self.add_chats(30)
+        data, many = self.inbox()
+        self.assertEqual(data["count"], 33)
+        self.assertEqual(many, few)
+
+
+@override_settings(
+    CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+)
+class ChatSocketTestCase(TransactionTestCase):
+    def setUp(self):
+        self.patient = make_patient("patient@x.com")
+        self.professional = make_professional("doc@x.com")
+        self.chat = Chat.objects.create(
+            patient=self.patient, professional=self.professional
+        )
+
+    def communicator(self, user):
+        communicator = WebsocketCommunicator(
+            ChatConsumer.as_asgi(), f"/ws/chat/{self.chat.pk}/"
+        )
+        communicator.scope["user"] = user
+        communicator.scope["url_route"] = {"kwargs": {"chat_id": str(self.chat.pk)}}
+        return communicator
+
+
+class ChatConsumerTests(ChatSocketTestCase):
+
+    def test_message_is_saved_and_broadcast(self):
+        async def exchange():
+            patient = self.communicator(self.patient.user)
+            professional = self.communicator(self.professional.user)
+            self.assertTrue((await patient.connect())[0])
+            self.assertTrue((await professional.connect())[0])
+            await patient.send_json_to({"content": " Hello doctor "})
+            received = await professional.receive_json_from()
+            await patient.disconnect()
+            await professional.disconnect()
+            return received["message"]
+
+        message = async_to_sync(exchange)()
+        self.assertEqual(message["content"], "Hello doctor")
+        self.assertEqual(message["sender_type"], "patient")
+        saved = Message.objects.get()
+        self.assertEqual(str(saved.id), message["id"])
+        self.assertEqual(saved.patient, self.patient)
+        self.chat.refresh_from_db()
+        self.assertEqual(self.chat.updated_at, saved.created_at)
+
+    def test_read_event_moves_cursor_and_is_broadcast(self):
+        first = send(self.chat, self.patient, "One")
+        send(self.chat, self.patient, "Two")
+
+        async def exchange():
+            patient = self.communicator(self.patient.user)
+            professional = self.communicator(self.professional.user)
+            await patient.connect()
+            await professional.connect()
+            await professional.send_json_to(
+                {"type": "read", "message_id": str(first.id)}
+            )
+            receipt = await patient.receive_json_from()
+            await patient.disconnect()
+            await professional.disconnect()
+            return receipt["read"]
+
+        receipt = async_to_sync(exchange)()
+        self.assertEqual(receipt["reader"], "professional")
+        self.assertEqual(receipt["message_id"], str(first.id))
+        self.chat.refresh_from_db()
+        self.assertEqual(self.chat.professional_read_message, first.id)
+        self.assertEqual(self.chat.professional_unread, 1)
+
+    def test_outsider_cannot_connect(self):
+        outsider = make_professional("other@x.com").user
+
+        async def connect():
+            communicator = self.communicator(outsider)
+            connected, _ = await communicator.connect()
+            return connected
+
+        self.assertFalse(async_to_sync(connect)())
+
+    def test_message_is_one_insert_and_one_update(self):
+        session = open_session(self.chat.pk, self.professional.user)
+        with CaptureQueriesContext(connection) as ctx:
+            message, sender = post_message(session, "Take it twice daily")
+        statements = [q["sql"].split()[0] for q in ctx.captured_queries]
+        self.assertEqual(statements, ["BEGIN", "UPDATE", "INSERT", "COMMIT"])
+        self.assertEqual(sender, "professional")
+        self.assertEqual(message.provider_id, self.professional.pk)
+        self.assertEqual(message.sequence, 1)
+        self.chat.refresh_from_db()
+        self.assertEqual(
+            (self.chat.professional_sent, self.chat.patient_unread), (1, 1)
+        )
+
+    def test_read_cursor_moves_forward_in_one_lookup_and_one_update(self):
+        sent = [send(self.chat, self.professional, f"Dose {n}") for n in range(3)]
+        send(self.chat, self.patient, "Thanks")
+
+        with CaptureQueriesContext(connection) as ctx:
+            cursor = mark_read(self.chat.pk, PATIENT, message_id=sent[1].id)
+        statements = [q["sql"].split()[0] for q in ctx.captured_queries]
+        self.assertEqual(statements, ["SELECT", "UPDATE"])
+        self.assertEqual(cursor["message_id"], str(sent[1].id))
+        self.chat.refresh_from_db()
+        self.assertEqual(self.chat.patient_unread, 1)
+        # Reading an earlier message doesn't move the cursor back.
+        self.assertIsNone(mark_read(self.chat.pk, PATIENT, message_id=sent[0].id))
+        mark_read(self.chat.pk, PATIENT)
+        self.chat.refresh_from_db()
+        self.assertEqual(self.chat.patient_read_message, sent[2].id)
+        self.assertEqual(self.chat.patient_unread, 0)
+        self.assertEqual(self.chat.professional_unread, 1)
+
+    def test_late_insert_is_timestamped_after_the_chats_last_message(self):
+        earlier = Message(chat=self.chat, provider=self.professional, content="Slow")
+        later = send(self.chat, self.professional, "Fast")
+        insert_message(earlier, PROFESSIONAL)
+
+        self.assertEqual((later.sequence, earlier.sequence), (1, 2))
+        self.assertGreater(earlier.created_at, later.created_at)
+        cursor = mark_read(self.chat.pk, PATIENT)
+        self.assertEqual(cursor["message_id"], str(earlier.id))
+        self.chat.refresh_from_db()
+        self.assertEqual(self.chat.patient_unread, 0)
+        self.assertEqual(self.chat.updated_at, earlier.created_at)
+
+    def test_role_must_be_held_in_the_chat(self):
+        user = self.professional.user
+        PatientProfile.objects.create(user=user, patient_id="doc-as-patient")
+        session = open_session(self.chat.pk, CustomUser.objects.get(pk=user.pk))
+        with self.assertRaises(exceptions.GeneralException):
+            post_message(session, "Hi", role="patient")
+        _, sender = post_message(session, "Hi", role="provider")
+        self.assertEqual(sender, "professional")
+
+
+def redis_available():
+    try:
+        return get_redis().ping()
+    except Exception:
+        return False
+
+
+@skipUnless(redis_available(), "Redis is not reachable")
+@override_settings(CHAT_WRITE_BEHIND=True, CHAT_FLUSH_INTERVAL=60)
+class ChatWriteBehindTests(ChatSocketTestCase):
+    def setUp(self):
+        super().setUp()
+        get_redis().delete(write_behind_service.QUEUE_KEY)
+        self.addCleanup(get_redis().delete, write_behind_service.QUEUE_KEY)
+
+    def test_message_is_broadcast_then_saved_by_the_flusher(self):
+        client_ids = [str(uuid.uuid4()) for _ in range(3)]
+
+        async def exchange():
+            patient = self.communicator(self.patient.user)
+            await patient.connect()
+            broadcast = []
+            for index, client_id in enumerate(client_ids):
+                await patient.send_json_to({"id": client_id, "content": f"Hi {index}"})
+                broadcast.append((await patient.receive_json_from())["message"])
+            saved_before_flush = await database_sync_to_async(Message.objects.count)()
+            flushed = await write_behind_service.flush()
+            await patient.disconnect()
+            return broadcast, saved_before_flush, flushed
+
+        broadcast, saved_before_flush, flushed = async_to_sync(exchange)()
+        self.assertEqual([message["id"] for message in broadcast], client_ids)
+        self.assertEqual(saved_before_flush, 0)
+        self.assertEqual(flushed, 3)
+        saved = list(Message.objects.order_by("created_at", "id"))
+        self.assertEqual([str(message.id) for message in saved], client_ids)
+        self.assertEqual(saved[0].patient, self.patient)
+        self.assertEqual(saved[-1].created_at.isoformat(), broadcast[-1]["created_at"])
+        self.assertEqual([message.sequence for message in saved], [1, 2, 3])
+        self.chat.refresh_from_db()
+        self.assertEqual(self.chat.updated_at, saved[-1].created_at)
+        self.assertEqual(self.chat.patient_sent, 3)
+        self.assertEqual(self.chat.professional_unread, 3)
+
+    def test_read_event_for_a_queued_message_moves_cursor(self):
+        self.addCleanup(get_redis().delete, recent_key(self.chat.pk))
+        client_ids = [str(uuid.uuid4()) for _ in range(2)]
+
+        async def exchange():
+            patient = self.communicator(self.patient.user)
+            professional = self.communicator(self.professional.user)
+            await patient.connect()
+            await professional.connect()
+            for index, client_id in enumerate(client_ids):
+                await patient.send_json_to({"id": client_id, "content": f"Hi {index}"})
+                await patient.receive_json_from()
+                await professional.receive_json_from()
+            await professional.send_json_to(
+                {"type": "read", "message_id": client_ids[0]}
+            )
+            receipt = await patient.receive_json_from()
+            await patient.disconnect()
+            await professional.disconnect()
+            return receipt["read"]
+
+        receipt = async_to_sync(exchange)()
+        self.assertEqual(receipt["reader"], "professional")
+        self.assertEqual(receipt["message_id"], client_ids[0])
+        self.assertEqual(Message.objects.count(), 2)
+        self.chat.refresh_from_db()
+        self.assertEqual(str(self.chat.professional_read_message), client_ids[0])
+        self.assertEqual(self.chat.professional_unread, 1)
+
+    def test_flushed_messages_are_timestamped_after_the_chats_last_message(self):
+        queued_at = timezone.now()
+        posted = send(self.chat, self.patient, "Posted while queued")
+        entries = [
+            {
+                "id": str(uuid.uuid4()),
+                "chat_id": str(self.chat.pk),
+                "patient_id": None,
+                "provider_id": str(self.professional.pk),
+                "content": f"Queued {index}",
+                "created_at": queued_at.isoformat(),
+            }
+            for index in range(2)
+        ]
+        failed, restamped = write_behind_service.persist(entries)
+        self.assertEqual(failed, [])
+        self.assertEqual(
+            [entry["id"] for entry, _ in restamped], [entry["id"] for entry in entries]
+        )
+
+        saved = list(Message.objects.order_by("created_at", "id"))
+        self.assertEqual(
+            [message.content for message in saved],
+            ["Posted while queued", "Queued 0", "Queued 1"],
+        )
+        self.assertLess(posted.created_at, saved[1].created_at)
+        self.assertLess(saved[1].created_at, saved[2].created_at)
+        self.chat.refresh_from_db()
+        self.assertEqual(self.chat.updated_at, saved[2].created_at)
+
+    def test_concurrent_flushes_insert_batches_in_queue_order(self):
+        self.addCleanup(get_redis().delete, recent_key(self.chat.pk))
+        queued_at = timezone.now()
+        # The second message was stamped first, by another worker.
+        entries = [
+            {
+                "id": str(uuid.uuid4()),
+                "chat_id": str(self.chat.pk),
+                "patient_id": str(self.patient.pk),
+                "provider_id": None,
+                "content": content,
+                "created_at": created_at.isoformat(),
+            }
+            for content, created_at in (
+                ("First", queued_at),
+                ("Second", queued_at - timedelta(milliseconds=5)),
+            )
+        ]
+        with get_redis().pipeline() as pipe:
+            for entry in entries:
+                pipe.rpush(write_behind_service.QUEUE_KEY, json.dumps(entry))
+            history_service.remember(
+                pipe,
+                self.chat.pk,
+                [
+                    history_service.entry(write_behind_service._message(entry))
+                    for entry in entries
+                ],
+            )
+            pipe.execute()
+
+        # The flush that popped the first batch is the slower to insert it.
+        real = write_behind_service.database_sync_to_async
+        calls = []
+
+        def first_is_slow(function):
+            run = real(function)
+
+            async def slowed(*args):
+                calls.append(args)
+                if len(calls) == 1:
+                    await asyncio.sleep(0.2)
+                return await run(*args)
+
+            return slowed
+
+        async def flush_twice():
+            return await asyncio.gather(
+                write_behind_service.flush(1), write_behind_service.flush(1)
+            )
+
+        with patch.object(
+            write_behind_service, "database_sync_to_async", first_is_slow
+        ):
+            self.assertEqual(async_to_sync(flush_twice)(), [1, 1])
+
+        saved = list(Message.objects.order_by("created_at", "id"))
+        self.assertEqual([message.content for message in saved], ["First", "Second"])
+        self.assertEqual([message.sequence for message in saved], [1, 2])
+        cached = [
+            json.loads(item)
+            for item in get_redis().lrange(recent_key(self.chat.pk), 0, -1)
+        ]
+        self.assertEqual(
+            [(item["id"], item["created_at"]) for item in cached],
+            [(str(message.id), message.created_at.isoformat()) for message in saved],
+        )
+
+    def test_sender_is_told_about_messages_that_failed_to_save(self):
+        taken = send(self.chat, self.professional, "Earlier")
+
+        async def exchange():
+            patient = self.communicator(self.patient.user)
+            await patient.connect()
+            await patient.send_json_to({"id": str(taken.id), "content": "Clash"})
+            await patient.send_json_to({"content": "Fine"})
+            await patient.receive_json_from()
+            await patient.receive_json_from()
+            await write_behind_service.flush()
+            error = await patient.receive_json_from()
+            await patient.disconnect()
+            return error
+
+        self.addCleanup(get_redis().delete, recent_key(self.chat.pk))
+        error = async_to_sync(exchange)()
+        self.assertEqual(error["message_ids"], [str(taken.id)])
+        cached = get_redis().lrange(recent_key(self.chat.pk), 0, -1)
+        self.assertEqual([json.loads(item)["content"] for item in cached], ["Fine"])
+        self.assertEqual(
+            sorted(Message.objects.values_list("content", flat=True)),
+            ["Earlier", "Fine"],
+        )
+
+
+class ChatHistoryTests(TestCase):
+    def setUp(self):
+        self.patient = make_patient("patient@x.com")
+        self.professional = make_professional("doc@x.com")
+        self.chat = Chat.objects.create(
+            patient=self.patient, professional=self.professional
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.patient.user)
+        if redis_available():
+            self.addCleanup(get_redis().delete, recent_key(self.chat.pk))
+
+    def page(self, **params):
+        response = self.client.get(f"/chat/chats/{self.chat.pk}/messages/", params)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_pages_walk_back_and_forward_by_cursor(self):
+        for n in range(5):
+            send(self.chat, self.patient if n % 2 else self.professional, f"m{n}")
+
+        newest = self.page(page_size=2)
+        self.assertEqual([m["content"] for m in newest["results"]], ["m3", "m4"])
+        self.assertEqual(newest["count"], 5)
+        self.assertIsNone(newest["next"])
+        older = self.client.get(newest["previous"]).data
+        self.assertEqual([m["content"] for m in older["results"]], ["m1", "m2"])
+        oldest = self.client.get(older["previous"]).data
+        self.assertEqual([m["content"] for m in oldest["results"]], ["m0"])
+        self.assertIsNone(oldest["previous"])
+        newer = self.client.get(oldest["next"]).data
+        self.assertEqual([m["content"] for m in newer["results"]], ["m1", "m2"])
+        self.assertEqual(newer["results"][0]["sender_type"], "patient")
+
+    @skipUnless(redis_available(), "Redis is not reachable")
+    def test_recent_messages_are_served_from_redis(self):
+        session = open_session(self.chat.pk, self.patient.user)
+        sent = [post_message(session, f"m{n}")[0] for n in range(3)]
+
+        with self.assertNumQueries(0):
+            messages, has_older, has_newer = message_page(self.chat, limit=2)
+        self.assertEqual([m.id for m in messages], [m.id for m in sent[1:]])
+        self.assertEqual((has_older, has_newer), (True, False))
+
+        # A cold cache is loaded by the newest page; a chat shorter than the
+        # list is then served back to its first message.
+        get_redis().delete(recent_key(self.chat.pk))
+        with self.assertNumQueries(1):
+            message_page(self.chat)
+        with self.assertNumQueries(0):
+            messages, has_older, _ = message_page(self.chat, before=sent[1].id)
+            newer, _, _ = message_page(self.chat, after=sent[0].id)
+        self.assertEqual([m.content for m in messages], ["m0"])
+        self.assertFalse(has_older)
+        self.assertEqual([m.content for m in newer], ["m1", "m2"])
+
+    @skipUnless(redis_available(), "Redis is not reachable")
+    @override_settings(CHAT_RECENT_MESSAGES=3)
+    def test_pages_older_than_the_cache_come_from_postgres(self):
+        session = open_session(self.chat.pk, self.patient.user)
+        sent = [post_message(session, f"m{n}")[0] for n in range(5)]
+
+        with self.assertNumQueries(1):
+            messages, has_older, _ = message_page(self.chat, before=sent[3].id, limit=2)
+        self.assertEqual([m.content for m in messages], ["m1", "m2"])
+        self.assertTrue(has_older)
+        self.assertEqual(get_redis().llen(recent_key(self.chat.pk)), 3)
@@ -3,11 +3,11 @@ from rest_framework import viewsets, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated, AllowAny
-from django.db.models import Q
 from django.http import StreamingHttpResponse
-from drf_spectacular.utils import extend_schema
+from drf_spectacular.utils import OpenApiParameter, extend_schema
+from rest_framework.utils.urls import remove_query_param, replace_query_param
 from patients.models import PatientProfile
-from .models import Chat, Message, AIChatSession
+from .models import Chat, AIChatSession
 from .serializers import (
     ChatSerializer,
     MessageSerializer,
@@ -19,6 +19,9 @@ from .serializers import (
 from helpers import exceptions
 from rest_framework.views import APIView
 from .ai_agent import ChatService
+from .history_service import message_page
+from .inbox_service import annotate_inbox, user_chats
+from .message_service import mark_read, open_session, post_message, publish_read
 from loguru import logger
 
 chat_service = ChatService()
@@ -33,24 +36,11 @@ class ChatViewSet(viewsets.ModelViewSet):
 
     def get_queryset(self):
         """Get chats for the current user where they are either the patient or professional"""
-        user = self.request.user
-
-        # Build query to filter chats where user is either patient or professional
-        query = Q()
-
-        if hasattr(user, "patient_profile"):
-            # Include chats where user is the patient
-            query |= Q(patient=user.patient_profile)
-
-        if hasattr(user, "professional_profile"):
-            # Include chats where user is the professional
-            query |= Q(professional=user.professional_profile)
-
-        if query:
-            return Chat.objects.filter(query)
-        else:
-            # User has neither profile
-            return Chat.objects.none()
+        queryset = user_chats(self.request.user)
+        if self.action in ("list", "retrieve"):
+            # Last message, unread count and participants in the same query.
+            queryset = annotate_inbox(queryset, self.request.user)
+        return queryset
 
     @extend_schema(
         request=ChatSerializer,
@@ -104,22 +94,61 @@ class ChatViewSet(viewsets.ModelViewSet):
         )
 
     @extend_schema(
+        parameters=[
+            OpenApiParameter(
+                name="before",
+                type={"type": "string", "format": "uuid"},
+                location=OpenApiParameter.QUERY,
+                description="Return the messages just older than this message",
+            ),
+            OpenApiParameter(
+                name="after",
+                type={"type": "string", "format": "uuid"},
+                location=OpenApiParameter.QUERY,
+                description="Return the messages just newer than this message",
+            ),
+        ],
         responses={200: MessageListSerializer(many=True)},
     )
     @action(detail=True, methods=["get"])
     def messages(self, request, pk=None):
-        """Get messages for a chat"""
+        """Get a page of messages for a chat, oldest first
+
+        The newest messages by default; `before` or `after` a message id for
+        the ones just older or newer than it. `previous` and `next` link to
+        the adjacent pages.
+        """
         chat = self.get_object()
-        messages = chat.messages.all().order_by("created_at")
+        before = request.query_params.get("before")
+        after = request.query_params.get("after")
+        messages, has_older, has_newer = message_page(
+            chat,
+            before=before,
+            after=after,
+            limit=self.paginator.get_page_size(request),
+        )
 
-        # Paginate if needed
-        page = self.paginate_queryset(messages)
-        if page is not None:
-            serializer = MessageListSerializer(page, many=True)
-            return self.get_paginated_response(serializer.data)
+        def link(cursor, message):
+            url = remove_query_param(
+                remove_query_param(request.build_absolute_uri(), "before"), "after"
+            )
+            return replace_query_param(url, cursor, str(message.id))
 
+        previous_link = next_link = None
+        if messages and has_older:
+            previous_link = link("before", messages[0])
+        if messages and has_newer:
+            next_link = link("after", messages[-1])
         serializer = MessageListSerializer(messages, many=True)
-        return Response(serializer.data)
+        return Response(
+            {
+                # Counted on the chat by message_service; no COUNT query.
+                "count": chat.patient_sent + chat.professional_sent,
+                "next": next_link,
+                "previous": previous_link,
+                "results": serializer.data,
+            }
+        )
 
     @extend_schema(
         request=MessageSerializer,
@@ -135,62 +164,10 @@ class ChatViewSet(viewsets.ModelViewSet):
         if not content:
             raise exceptions.GeneralException("Message content cannot be empty")
 
-        # Create message
-        message = Message(chat=chat)
-
-        # Smart role determination (same logic as WebSocket consumer)
-        user = request.user
-        has_patient = hasattr(user, "patient_profile")
-        has_professional = hasattr(user, "professional_profile")
-
-        if not has_patient and not has_professional:
-            raise exceptions.GeneralException(
-                "User must have either a patient or professional profile"
-            )
-
-        if has_patient and has_professional:
-            # User has both profiles - determine which one to use
-            if role:
-                # Explicit role specified
-                if role.lower() == "patient":
-                    message.patient = user.patient_profile
-                elif role.lower() in ["professional", "provider"]:
-                    message.provider = user.professional_profile
-                else:
-                    raise exceptions.GeneralException(
-                        f"Invalid role '{role}'. Must be 'patient' or 'professional'"
-                    )
-            else:
-                # Determine from chat context
-                if chat.patient.user == user:
-                    message.patient = user.patient_profile
-                elif chat.professional.user == user:
-                    message.provider = user.professional_profile
-                else:
-                    raise exceptions.GeneralException(
-                        "Cannot determine role. Please specify 'role' in request or ensure you're part of this chat"
-                    )
-        elif has_patient:
-            message.patient = user.patient_profile
-        elif has_professional:
-            message.provider = user.professional_profile
-
-        # Verify the selected role matches the chat
-        if message.patient and chat.patient != message.patient:
-            raise exceptions.GeneralException(
-                "Cannot send message as patient: you are not the patient in this chat"
-            )
-        if message.provider and chat.professional != message.provider:
-            raise exceptions.GeneralException(
-                "Cannot send message as professional: you are not the professional in this chat"
-            )
-
-        # Set message content
-        message.content = content
-        message.save()
-
-        # Update chat
-        chat.save(update_fields=["updated_at"])
+        # Same role rules and bookkeeping as the WebSocket consumer
+        session = open_session(chat.pk, request.user)
+        message, _ = post_message(session, content, role=role)
+        message.chat = chat
 
         serializer = MessageSerializer(message)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
@@ -202,19 +179,12 @@ class ChatViewSet(viewsets.ModelViewSet):
     def mark_read(self, request, pk=None):
         """Mark messages as read"""
         chat = self.get_object()
-        user = request.user
+        session = open_session(chat.pk, request.user)
 
-        # Mark appropriate messages as read
-        if hasattr(user, "patient_profile"):
-            # Patient marks professional's messages as read
-            chat.messages.filter(provider__isnull=False, is_read=False).update(
-                is_read=True
-            )
-        elif hasattr(user, "professional_profile"):
-            # Professional marks patient's messages as read
-            chat.messages.filter(patient__isnull=False, is_read=False).update(
-                is_read=True
-            )
+        # Move the user's read cursor to the other side's latest message
+        cursor = mark_read(chat.pk, session.sender_role(request.data.get("role")))
+        if cursor:
+            publish_read(chat.pk, cursor)
 
         return Response({"status": "Messages marked as read"})
 
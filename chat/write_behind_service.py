@@ -0,0 +1,346 @@
+"""
+Write-behind persistence of chat messages (settings.CHAT_WRITE_BEHIND).
+
+Instead of inserting each message before broadcasting it, ChatConsumer
+gives the message its id (the client's, if it sent one) and timestamp,
+appends it to a Redis list (and to the chat's recent-messages cache, see
+history_service) and broadcasts it straight away. A flusher task
+on each worker's event loop takes up to CHAT_FLUSH_BATCH_SIZE messages off
+the head of the list every CHAT_FLUSH_INTERVAL seconds (at once while the
+list stays full) and inserts them with one `bulk_create`, numbering them and
+updating their chats' message and unread counts as `insert_message` does
+for a single message.
+
+Flushers on every worker drain the one shared list, so a flusher holds a
+Redis lock (CHAT_FLUSH_LOCK_TIMEOUT seconds at most) from popping a batch
+until it is inserted: batches are inserted in the order they were queued,
+and history is in send order even when several workers flush at once.
+`created_at` is the time a message was queued, not flushed. As in
+`insert_message`, a message is never timestamped before its chat's
+`updated_at`, read under the chat's row lock, so `created_at` order stays
+`sequence` order; a message queued just behind a later-stamped one of its
+chat is saved just after it, and its recent-messages cache entry is
+rewritten with the saved time. A batch that fails to insert is retried row
+by row; the rows that still fail are removed from the recent-messages cache
+and their senders get an error frame naming them. A batch popped by a
+worker that dies before inserting it is lost: that is the durability this
+mode trades for throughput.
+
+A read receipt may name a message that has been broadcast but not saved
+yet; the consumer flushes through it (`flush_through`) before moving the
+read cursor to it.
+"""
+
+import asyncio
+import json
+import uuid
+import weakref
+from collections import defaultdict
+
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import DatabaseError, transaction
+from django.db.models import (
+    Case,
+    DateTimeField,
+    F,
+    PositiveIntegerField,
+    Value,
+    When,
+)
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from loguru import logger
+from redis.exceptions import LockError, RedisError
+
+from helpers import exceptions
+from helpers.redis_client import get_async_redis
+from . import history_service
+from .message_service import (
+    PATIENT,
+    PROFESSIONAL,
+    TICK,
+    insert_message,
+    message_payload,
+)
+from .models import Chat, Message
+
+QUEUE_KEY = "chat:write-behind"
+FLUSH_LOCK_KEY = "chat:write-behind:flushing"
+PERSIST_FAILED = "chat.persist_failed"
+
+# Flusher tasks are bound to the event loop they run on.
+_flushers = weakref.WeakKeyDictionary()
+
+
+async def enqueue(session, content, role=None, message_id=None, reply_channel=None):
+    """
+    Queue a message from the session's user and return its broadcast
+    payload. `message_id` is the client's id for it, if it sent one.
+    """
+    sender = session.sender_role(role)
+    try:
+        message_id = uuid.UUID(str(message_id)) if message_id else uuid.uuid4()
+    except ValueError:
+        raise exceptions.GeneralException(f"Invalid message id '{message_id}'")
+    created_at = timezone.now()
+    entry = {
+        "id": str(message_id),
+        "chat_id": str(session.chat_id),
+        "patient_id": str(session.patient_id) if sender == PATIENT else None,
+        "provider_id": str(session.professional_id) if sender == PROFESSIONAL else None,
+        "content": content,
+        "created_at": created_at.isoformat(),
+        "reply_channel": reply_channel,
+    }
+    message = Message(
+        id=message_id,
+        chat_id=session.chat_id,
+        patient_id=entry["patient_id"],
+        provider_id=entry["provider_id"],
+        content=content,
+        created_at=created_at,
+    )
+    # Queued and cached in one round trip, so history shows it at once.
+    async with get_async_redis().pipeline(transaction=False) as pipe:
+        pipe.rpush(QUEUE_KEY, json.dumps(entry))
+        history_service.remember(
+            pipe, session.chat_id, [history_service.entry(message)]
+        )
+        await pipe.execute()
+    return message_payload(message, sender)
+
+
+def _message(entry) -> Message:
+    return Message(
+        id=entry["id"],
+        chat_id=uuid.UUID(entry["chat_id"]),
+        patient_id=entry["patient_id"],
+        provider_id=entry["provider_id"],
+        content=entry["content"],
+        created_at=parse_datetime(entry["created_at"]),
+    )
+
+
+def _sender(entry) -> str:
+    return PATIENT if entry["patient_id"] else PROFESSIONAL
+
+
+def _per_chat(values, default, output_field=None):
+    """CASE expression taking each chat's value from `values` (chat id -> value)."""
+    return Case(
+        *(When(pk=chat_id, then=Value(value)) for chat_id, value in values.items()),
+        default=default,
+        output_field=output_field or PositiveIntegerField(),
+    )
+
+
+def _insert_batch(messages, senders):
+    """
+    Insert a batch with its read-state bookkeeping in three queries: lock
+    the batch's chats and read their message counts and times, insert the
+    messages numbered and timestamped from those, and update every chat's
+    counts, unread counts and updated_at in one UPDATE.
+    """
+    sent, latest = {}, {}
+    for chat_id, patient_sent, professional_sent, updated_at in (
+        Chat.objects.select_for_update()
+        .filter(pk__in={message.chat_id for message in messages})
+        .values_list("pk", "patient_sent", "professional_sent", "updated_at")
+    ):
+        sent[chat_id] = {PATIENT: patient_sent, PROFESSIONAL: professional_sent}
+        latest[chat_id] = updated_at
+    added = defaultdict(lambda: {PATIENT: 0, PROFESSIONAL: 0})
+    for message, sender in zip(messages, senders):
+        counts = sent.setdefault(message.chat_id, {PATIENT: 0, PROFESSIONAL: 0})
+        counts[sender] += 1
+        message.sequence = counts[sender]
+        added[message.chat_id][sender] += 1
+        if message.chat_id in latest:
+            message.created_at = max(message.created_at, latest[message.chat_id] + TICK)
+        latest[message.chat_id] = message.created_at
+    Message.objects.bulk_create(messages)
+
+    def count_of(side):
+        return {chat_id: sent[chat_id][side] for chat_id in added}
+
+    def added_by(side):
+        return {chat_id: counts[side] for chat_id, counts in added.items()}
+
+    Chat.objects.filter(pk__in=added).update(
+        updated_at=_per_chat(
+            {chat_id: latest[chat_id] for chat_id in added},
+            F("updated_at"),
+            DateTimeField(),
+        ),
+        patient_sent=_per_chat(count_of(PATIENT), F("patient_sent")),
+        professional_sent=_per_chat(count_of(PROFESSIONAL), F("professional_sent")),
+        patient_unread=F("patient_unread")
+        + _per_chat(added_by(PROFESSIONAL), Value(0)),
+        professional_unread=F("professional_unread")
+        + _per_chat(added_by(PATIENT), Value(0)),
+    )
+
+
+def persist(entries):
+    """
+    Insert queued messages in order. Returns the entries that couldn't be
+    saved, and (entry, saved message) for those saved with a later
+    `created_at` than they were queued with.
+    """
+    messages = [_message(entry) for entry in entries]
+    senders = [_sender(entry) for entry in entries]
+    try:
+        with transaction.atomic():
+            _insert_batch(messages, senders)
+        return [], _restamped(entries, messages)
+    except DatabaseError as error:
+        logger.warning(
+            f"Chat batch of {len(messages)} failed, saving one by one: {error}"
+        )
+
+    failed, saved, saved_messages = [], [], []
+    for entry, sender in zip(entries, senders):
+        # A fresh instance: the failed batch stamped and numbered the old one.
+        message = _message(entry)
+        try:
+            insert_message(message, sender)
+        except DatabaseError as error:
+            logger.error(f"Chat message {entry['id']} could not be saved: {error}")
+            failed.append(entry)
+        else:
+            saved.append(entry)
+            saved_messages.append(message)
+    return failed, _restamped(saved, saved_messages)
+
+
+def _restamped(entries, messages):
+    return [
+        (entry, message)
+        for entry, message in zip(entries, messages)
+        if message.created_at != parse_datetime(entry["created_at"])
+    ]
+
+
+async def _restamp(saved):
+    """Rewrite the cached entries of messages saved with a later time."""
+    by_chat = defaultdict(list)
+    for entry, message in saved:
+        by_chat[entry["chat_id"]].append(
+            (history_service.entry(_message(entry)), history_service.entry(message))
+        )
+    try:
+        async with get_async_redis().pipeline(transaction=False) as pipe:
+            for chat_id, pairs in by_chat.items():
+                history_service.replace(pipe, chat_id, pairs)
+            await pipe.execute()
+    except RedisError as error:
+        logger.error(f"Could not update restamped chat messages in history: {error}")
+
+
+async def _forget(entries):
+    """Drop unsaved messages from their chats' recent-messages lists."""
+    try:
+        async with get_async_redis().pipeline(transaction=False) as pipe:
+            for entry in entries:
+                history_service.forget(
+                    pipe, entry["chat_id"], [history_service.entry(_message(entry))]
+                )
+            await pipe.execute()
+    except RedisError as error:
+        logger.error(f"Could not drop unsaved chat messages from history: {error}")
+
+
+async def _report_failures(entries):
+    """Tell each sender which of their messages were not saved."""
+    by_channel = defaultdict(list)
+    for entry in entries:
+        if entry.get("reply_channel"):
+            by_channel[entry["reply_channel"]].append(entry["id"])
+    channel_layer = get_channel_layer()
+    for channel, message_ids in by_channel.items():
+        try:
+            await channel_layer.send(
+                channel, {"type": PERSIST_FAILED, "message_ids": message_ids}
+            )
+        except Exception as error:
+            logger.error(
+                f"Could not report unsaved chat messages to {channel}: {error}"
+            )
+
+
+async def flush(batch_size=None) -> int:
+    """
+    Insert the next batch of queued messages, once no other flusher is
+    inserting one. Returns how many were taken.
+    """
+    batch_size = batch_size or settings.CHAT_FLUSH_BATCH_SIZE
+    lock = get_async_redis().lock(
+        FLUSH_LOCK_KEY,
+        timeout=settings.CHAT_FLUSH_LOCK_TIMEOUT,
+        sleep=0.01,
+        blocking_timeout=settings.CHAT_FLUSH_LOCK_TIMEOUT,
+    )
+    if not await lock.acquire():
+        return 0
+    try:
+        async with get_async_redis().pipeline(transaction=True) as pipe:
+            pipe.lrange(QUEUE_KEY, 0, batch_size - 1)
+            pipe.ltrim(QUEUE_KEY, batch_size, -1)
+            queued, _ = await pipe.execute()
+        if not queued:
+            return 0
+        entries = [json.loads(entry) for entry in queued]
+        failed, restamped = await database_sync_to_async(persist)(entries)
+    finally:
+        try:
+            await lock.release()
+        except LockError:
+            logger.warning(
+                "Chat flush outlived its lock; raise CHAT_FLUSH_LOCK_TIMEOUT"
+            )
+    if restamped:
+        await _restamp(restamped)
+    if failed:
+        await _forget(failed)
+        await _report_failures(failed)
+    return len(entries)
+
+
+async def flush_through(message_id):
+    """
+    Flush queued batches until message `message_id` is saved: at most one
+    more than the queue holds now, by which time it is saved if it was
+    queued at all.
+    """
+    try:
+        message_id = uuid.UUID(str(message_id))
+    except ValueError:
+        return  # mark_read rejects it
+    saved = database_sync_to_async(Message.objects.filter(pk=message_id).exists)
+    batch_size = settings.CHAT_FLUSH_BATCH_SIZE
+    queued = await get_async_redis().llen(QUEUE_KEY)
+    for _ in range(-(-queued // batch_size) + 1):
+        if await saved():
+            return
+        await flush(batch_size)
+
+
+async def _run_flusher():
+    batch_size = settings.CHAT_FLUSH_BATCH_SIZE
+    while True:
+        await asyncio.sleep(settings.CHAT_FLUSH_INTERVAL)
+        try:
+            while await flush(batch_size) >= batch_size:
+                pass
+        except Exception:
+            logger.exception("Chat write-behind flush failed")
+
+
+def start_flusher():
+    """Start the flusher of the running event loop, unless it is running already."""
+    loop = asyncio.get_running_loop()
+    task = _flushers.get(loop)
+    if task is None or task.done():
+        _flushers[loop] = loop.create_task(_run_flusher())
@@ -11,11 +11,14 @@ django_asgi_app = get_asgi_application()
 from channels.routing import ProtocolTypeRouter, URLRouter
 from chat.routing import websocket_urlpatterns
 from chat.middleware import JWTAuthMiddlewareStack
+from pharmacies.routing import websocket_urlpatterns as pharmacy_websocket_urlpatterns
 
 
 application = ProtocolTypeRouter(
     {
         "http": django_asgi_app,
-        "websocket": JWTAuthMiddlewareStack(URLRouter(websocket_urlpatterns)),
+        "websocket": JWTAuthMiddlewareStack(
+            URLRouter(websocket_urlpatterns + pharmacy_websocket_urlpatterns)
+        ),
     }
 )
@@ -21,10 +21,24 @@ app.conf.beat_schedule = {
         "task": "pharmacies.tasks.calculate_daily_settlements",
         "schedule": crontab(hour=23, minute=55),
     },
+    "refresh-expired-stock-levels": {
+        "task": "pharmacies.tasks.refresh_expired_stock_levels",
+        "schedule": crontab(hour=0, minute=5),
+    },
+    "reconcile-dashboard-rollups": {
+        "task": "pharmacies.tasks.backfill_dashboard_rollups",
+        "schedule": crontab(hour=0, minute=15),
+        "kwargs": {"days": 2},
+    },
     "send-daily-expiry-alerts": {
         "task": "pharmacies.tasks.send_expiry_alerts",
         "schedule": crontab(hour=8, minute=0),
     },
+    # Webhook events whose processing task was lost, or that failed and can retry.
+    "retry-webhook-events": {
+        "task": "pharmacies.tasks.retry_webhook_events",
+        "schedule": crontab(minute="*/10"),
+    },
     # Fallback for any payout left in PROCESSING by a missed transfer webhook.
     "reconcile-pending-payouts": {
         "task": "pharmacies.tasks.reconcile_pending_payouts",
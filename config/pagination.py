@@ -1,6 +1,201 @@
-from rest_framework.pagination import PageNumberPagination
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
+
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.db.models import Q, QuerySet
+from rest_framework.exceptions import NotFound
+from rest_framework.filters import OrderingFilter
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+from helpers import exceptions
+
+
+class KeysetPagination(BasePagination):
+    """
+    Keyset (cursor) pages ordered on (`cursor_ordering`, pk), e.g. newest
+    `created_at` first. Each page is one indexed range scan from the previous
+    page's last row, so deep pages cost the same as the first one, unlike
+    OFFSET. Cursors are opaque; the total count is included unless the client
+    passes `count=false`.
+
+    Views choose the key with a `cursor_ordering` attribute ("-created_at" by
+    default, "-timestamp" for audit logs, ...). `?ordering=` does not apply
+    to cursor pages. A malformed cursor is a 404, as with DRF's
+    CursorPagination.
+
+    DRF's CursorPagination (used on its own by StockHistoryPagination) is
+    kept for views that only ever page by cursor. This class exists for the
+    endpoints that page by number by default: DefaultPagination switches to
+    it per request, it reports `count`, and its cursor holds the whole
+    (key, pk) position, where DRF's holds the key plus an OFFSET past rows
+    sharing it, which gets slow on bulk-inserted rows with equal timestamps.
+    """
+
+    cursor_query_param = "cursor"
+    invalid_cursor_message = "Invalid cursor"
+    count_query_param = "count"
+    default_ordering = "-created_at"
+
+    def __init__(self, page_size):
+        self.page_size = page_size
+        self.count = None
+        self.next_cursor = None
+        self.previous_cursor = None
+
+    def encode_cursor(self, value, pk, reverse=False):
+        payload = json.dumps([str(value), str(pk), int(reverse)])
+        return urlsafe_b64encode(payload.encode()).decode()
+
+    def decode_cursor(self, encoded):
+        if not encoded:
+            return None
+        try:
+            value, pk, reverse = json.loads(urlsafe_b64decode(encoded.encode()))
+        except (TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        return value, pk, bool(reverse)
+
+    def _position(self, queryset, field, cursor):
+        """The cursor's (key, pk) as the model's own types."""
+        meta = queryset.model._meta
+        try:
+            return (
+                meta.get_field(field).to_python(cursor[0]),
+                meta.pk.to_python(cursor[1]),
+            )
+        except (TypeError, ValueError, ValidationError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def _ordering(self, queryset, view):
+        ordering = getattr(view, "cursor_ordering", self.default_ordering)
+        field = ordering.lstrip("-")
+        try:
+            queryset.model._meta.get_field(field)
+        except FieldDoesNotExist:
+            raise exceptions.GeneralException(
+                detail="Cursor pagination is not available for this resource"
+            )
+        return field, ordering.startswith("-")
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        field, descending = self._ordering(queryset, view)
+        cursor = self.decode_cursor(request.query_params.get(self.cursor_query_param))
+
+        if request.query_params.get(self.count_query_param, "").lower() != "false":
+            self.count = queryset.count()
+
+        # A reverse cursor walks back towards the newest rows, so it flips the
+        # order, and the page is flipped back once fetched.
+        reverse = bool(cursor and cursor[2])
+        walk_descending = descending != reverse
+        if walk_descending:
+            queryset = queryset.order_by(f"-{field}", "-pk")
+        else:
+            queryset = queryset.order_by(field, "pk")
+        if cursor:
+            value, pk = self._position(queryset, field, cursor)
+            after = "lt" if walk_descending else "gt"
+            queryset = queryset.filter(
+                Q(**{f"{field}__{after}": value})
+                | Q(**{field: value, f"pk__{after}": pk})
+            )
+
+        rows = list(queryset[: self.page_size + 1])
+        has_more = len(rows) > self.page_size
+        rows = rows[: self.page_size]
+        if reverse:
+            rows.reverse()
+
+        if rows:
+            first, last = rows[0], rows[-1]
+            if has_more or reverse:
+                self.next_cursor = self.encode_cursor(getattr(last, field), last.pk)
+            if cursor and (has_more or not reverse):
+                self.previous_cursor = self.encode_cursor(
+                    getattr(first, field), first.pk, reverse=True
+                )
+        return rows
+
+    def _link(self, cursor):
+        if cursor is None:
+            return None
+        return replace_query_param(
+            self.request.build_absolute_uri(), self.cursor_query_param, cursor
+        )
+
+    def get_next_link(self):
+        return self._link(self.next_cursor)
+
+    def get_previous_link(self):
+        return self._link(self.previous_cursor)
+
+    def get_paginated_response(self, data, results_key="results"):
+        fields = [] if self.count is None else [("count", self.count)]
+        fields += [
+            ("next", self.get_next_link()),
+            ("previous", self.get_previous_link()),
+            (results_key, data),
+        ]
+        return Response(OrderedDict(fields))
 
 
 class DefaultPagination(PageNumberPagination):
+    """
+    Page-number pages by default; passing `?cursor=` (empty for the first
+    page) switches the request to keyset pages (see KeysetPagination).
+
+    Keyset pages re-order the results on (cursor_ordering, pk), so they are
+    only used when the results are already in that order. Anything else
+    stays page-numbered: results that are a list (e.g. geo_service's k
+    nearest), and querysets ordered by distance, search relevance or
+    another `?ordering=`.
+    """
+
     page_size_query_param = "page_size"
     max_page_size = 200
+    keyset = None
+
+    def _in_cursor_order(self, queryset, request, view) -> bool:
+        if not isinstance(queryset, QuerySet):
+            return False
+        query = queryset.query
+        if query.order_by:
+            ordering = list(query.order_by)
+        elif query.default_ordering:
+            ordering = list(queryset.model._meta.ordering)
+        else:
+            ordering = []
+        pk = queryset.model._meta.pk.name
+        pk_terms = {"pk", "-pk", pk, f"-{pk}"}
+        cursor_ordering = getattr(
+            view, "cursor_ordering", KeysetPagination.default_ordering
+        )
+        if ordering[:1] == [cursor_ordering]:
+            return all(term in pk_terms for term in ordering[1:])
+        # A default order on the primary key alone (the admin lists' `-id`)
+        # is only a stable tie-break, not an order the client asked for.
+        return OrderingFilter.ordering_param not in request.query_params and all(
+            term in pk_terms for term in ordering
+        )
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.keyset = None
+        if (
+            KeysetPagination.cursor_query_param in request.query_params
+            and self._in_cursor_order(queryset, request, view)
+        ):
+            page_size = self.get_page_size(request)
+            if not page_size:
+                return None
+            self.keyset = KeysetPagination(page_size)
+            return self.keyset.paginate_queryset(queryset, request, view)
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        if self.keyset is not None:
+            return self.keyset.get_paginated_response(data)
+        return super().get_paginated_response(data)
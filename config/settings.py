@@ -54,6 +54,7 @@ INSTALLED_APPS = [
     "whitenoise.runserver_nostatic",
     "django.contrib.staticfiles",
     "django.contrib.sites",
+    "django.contrib.postgres",
     # Third-party
     "allauth",
     "allauth.account",
@@ -452,6 +453,17 @@ CHANNEL_LAYERS = {
 # Store in environment variable CHAT_ENCRYPTION_KEY
 # For production, use a secure key management system
 CHAT_ENCRYPTION_KEY = os.getenv("CHAT_ENCRYPTION_KEY", None)
+# Write-behind chat messages: broadcast at once, queue in Redis, and insert in
+# batches of at most CHAT_FLUSH_BATCH_SIZE every CHAT_FLUSH_INTERVAL seconds.
+CHAT_WRITE_BEHIND = as_bool(os.getenv("CHAT_WRITE_BEHIND", "false"))
+CHAT_FLUSH_BATCH_SIZE = int(os.getenv("CHAT_FLUSH_BATCH_SIZE", default="200"))
+CHAT_FLUSH_INTERVAL = float(os.getenv("CHAT_FLUSH_INTERVAL", default="0.25"))
+# One flusher at a time holds the queue, for at most this many seconds.
+CHAT_FLUSH_LOCK_TIMEOUT = float(os.getenv("CHAT_FLUSH_LOCK_TIMEOUT", default="30"))
+# The last CHAT_RECENT_MESSAGES messages of chats active in the last
+# CHAT_RECENT_TTL seconds are cached in Redis for the message history.
+CHAT_RECENT_MESSAGES = int(os.getenv("CHAT_RECENT_MESSAGES", default="100"))
+CHAT_RECENT_TTL = int(os.getenv("CHAT_RECENT_TTL", default="86400"))
 THROTTLE_RATE = os.getenv("THROTTLE_RATE", "100/s")
 
 # CELERY
@@ -587,12 +599,25 @@ EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
 # PAYSTACK
 PAYSTACK_PRIVATE_KEY = os.getenv("PAYSTACK_PRIVATE_KEY", default="")
 PAYSTACK_PUBLIC_KEY = os.getenv("PAYSTACK_PUBLIC_KEY", default="")
+PAYSTACK_BASE_URL = os.getenv("PAYSTACK_BASE_URL", default="https://api.paystack.co")
+# (connect, read) timeouts in seconds, retries with exponential backoff for
+# connection errors and retryable responses, and the cap on concurrent calls
+# (also the size of the shared connection pool).
+PAYSTACK_CONNECT_TIMEOUT = float(os.getenv("PAYSTACK_CONNECT_TIMEOUT", default="5"))
+PAYSTACK_READ_TIMEOUT = float(os.getenv("PAYSTACK_READ_TIMEOUT", default="20"))
+PAYSTACK_MAX_RETRIES = int(os.getenv("PAYSTACK_MAX_RETRIES", default="3"))
+PAYSTACK_RETRY_BACKOFF = float(os.getenv("PAYSTACK_RETRY_BACKOFF", default="0.5"))
+PAYSTACK_MAX_CONCURRENCY = int(os.getenv("PAYSTACK_MAX_CONCURRENCY", default="8"))
 
 # Platform commission (percent) withheld from pharmacy settlement payouts.
 # 0 = pharmacies receive 100% of their fulfilled drug sales.
 SETTLEMENT_COMMISSION_PERCENT = float(
     os.getenv("SETTLEMENT_COMMISSION_PERCENT", "0")
 )
+# Number of parallel shards the nightly settlement reconciliation is split into.
+SETTLEMENT_SYNC_SHARDS = int(os.getenv("SETTLEMENT_SYNC_SHARDS", default="8"))
+# Unchanged drug expiry alerts are re-sent to a pharmacy after this many days.
+EXPIRY_ALERT_RESEND_DAYS = int(os.getenv("EXPIRY_ALERT_RESEND_DAYS", default="7"))
 PAYSTACK_CALLBACK_URL = os.getenv(
     "PAYSTACK_CALLBACK_URL",
     default="http://localhost:8000/api/pharmacies/payments/verify-payment/",
@@ -157,3 +157,9 @@ class InvalidOrExpiredResetLinkException(BaseException):
     default_detail = (
         "This password reset link is invalid or has expired. Please request a new one."
     )
+
+
+class InsufficientStockException(BaseException):
+    status_code = 400
+    default_code = 126
+    default_detail = "Some items in your order are out of stock."
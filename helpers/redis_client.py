@@ -0,0 +1,35 @@
+"""
+Redis clients on the cache database, shared by everything that keeps its own
+data structures there (carts, the chat history cache and write-behind queue).
+"""
+
+import asyncio
+import weakref
+
+import redis
+import redis.asyncio as async_redis
+from django.conf import settings
+
+_client = None
+# Async clients are bound to the event loop they run on.
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_redis() -> redis.Redis:
+    """Shared client on the cache database (the connection pool is reused)."""
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(
+            settings.CACHES["default"]["LOCATION"], decode_responses=True
+        )
+    return _client
+
+
+def get_async_redis() -> async_redis.Redis:
+    """The running event loop's client on the cache database."""
+    loop = asyncio.get_running_loop()
+    if loop not in _async_clients:
+        _async_clients[loop] = async_redis.Redis.from_url(
+            settings.CACHES["default"]["LOCATION"], decode_responses=True
+        )
+    return _async_clients[loop]
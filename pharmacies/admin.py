@@ -7,6 +7,8 @@ from .models import (
     DrugSupplier,
     DrugCategory,
     StockMovement,
+    BatchStockLevel,
+    DrugStockLevel,
     Payment,
     Order,
     Settlement,
@@ -140,6 +142,40 @@ class StockMovementAdmin(ModelAdmin):
     ordering = ["-created_at"]
 
 
+@admin.register(BatchStockLevel)
+class BatchStockLevelAdmin(ModelAdmin):
+    list_display = [
+        "batch",
+        "drug",
+        "pharmacy",
+        "expiry_date",
+        "quantity",
+        "updated_at",
+    ]
+    list_filter = [
+        "expiry_date",
+    ]
+    readonly_fields = ["updated_at"]
+    ordering = ["expiry_date"]
+
+
+@admin.register(DrugStockLevel)
+class DrugStockLevelAdmin(ModelAdmin):
+    list_display = [
+        "drug",
+        "pharmacy",
+        "available_quantity",
+        "nearest_expiry",
+        "as_of",
+        "updated_at",
+    ]
+    list_filter = [
+        "as_of",
+    ]
+    readonly_fields = ["updated_at"]
+    ordering = ["available_quantity"]
+
+
 @admin.register(Payment)
 class PaymentAdmin(ModelAdmin):
     list_display = [
@@ -0,0 +1,188 @@
+"""
+FEFO (first-expiry-first-out) batch allocation.
+
+Serves stock-out quantities from the earliest-expiring non-empty batches,
+splitting a quantity across as many batches as it takes, and books returns
+back onto batches. Balances come from the locked BatchStockLevel rows, so an
+allocation never aggregates movement history, and its query count does not
+depend on how many batches a drug has.
+"""
+
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Sum, Value, When, Window
+from django.utils import timezone
+
+from helpers import exceptions
+from .models import BatchStockLevel, Drug, StockMovement
+from .stock_service import apply_movements
+
+OUTFLOW_REASONS = (
+    StockMovement.Reason.SALE,
+    StockMovement.Reason.ADJUSTMENT,
+    StockMovement.Reason.EXPIRED,
+)
+
+
+def lock_batch_levels(requested, today=None):
+    """
+    Lock and return, earliest expiry first, the sellable batch levels needed
+    to cover `requested` ({drug_id: quantity}).
+
+    Only the FEFO prefix of each drug's batches whose running total reaches
+    the requested quantity is locked, so a drug with hundreds of batches costs
+    no more than one with a few. If a concurrent writer drained part of that
+    prefix before it was locked, every live batch of the drugs is locked
+    instead. Rows are always locked in (drug, expiry, batch) order so two
+    transactions that share drugs can't deadlock on the first query.
+    """
+    today = today or timezone.localdate()
+    live = BatchStockLevel.objects.filter(
+        drug_id__in=requested, expiry_date__gte=today, quantity__gt=0
+    )
+    fefo_order = ("drug_id", "expiry_date", "batch_id")
+    needed = live.annotate(
+        stocked_before=Window(
+            Sum("quantity"),
+            partition_by=[F("drug_id")],
+            order_by=[F("expiry_date").asc(), F("batch_id").asc()],
+        )
+        - F("quantity")
+    ).filter(
+        stocked_before__lt=Case(
+            *[
+                When(drug_id=drug_id, then=Value(qty))
+                for drug_id, qty in requested.items()
+            ],
+            default=Value(0),
+            output_field=IntegerField(),
+        )
+    )
+    levels = list(
+        BatchStockLevel.objects.select_for_update()
+        .filter(batch_id__in=needed.values("batch_id"), quantity__gt=0)
+        .order_by(*fefo_order)
+    )
+
+    locked = defaultdict(int)
+    for level in levels:
+        locked[level.drug_id] += level.quantity
+    if any(locked[drug_id] < qty for drug_id, qty in requested.items()):
+        levels = list(live.select_for_update().order_by(*fefo_order))
+    return levels
+
+
+def allocate_fefo(requested, levels):
+    """
+    Split {drug_id: quantity} over `levels` (as returned by lock_batch_levels).
+    Returns (picks, short): picks is a list of (level, quantity) in FEFO order
+    and short lists the drugs that can't be filled in full.
+    """
+    by_drug = defaultdict(list)
+    for level in levels:
+        by_drug[level.drug_id].append(level)
+
+    picks = []
+    short = []
+    for drug_id, quantity in requested.items():
+        remaining = quantity
+        for level in by_drug.get(drug_id, ()):
+            take = min(level.quantity, remaining)
+            picks.append((level, take))
+            remaining -= take
+            if not remaining:
+                break
+        if remaining:
+            short.append(drug_id)
+    return picks, short
+
+
+def write_movements(picks, reason, note="", sign=-1):
+    """Bulk-insert one movement per (level, quantity) pick and apply it to the ledger."""
+    movements = [
+        StockMovement(
+            pharmacy_id=level.pharmacy_id,
+            drug_id=level.drug_id,
+            batch_id=level.batch_id,
+            quantity=sign * quantity,
+            reason=reason,
+            note=note,
+        )
+        for level, quantity in picks
+    ]
+    StockMovement.objects.bulk_create(movements)
+    apply_movements(movements)
+    return movements
+
+
+def deduct_stock(drug: Drug, quantity: int, reason, note="") -> list:
+    """
+    Take `quantity` units of `drug` out of stock FEFO (sale, adjustment or
+    write-off). Raises InsufficientStockException, writing nothing, if the
+    drug's non-expired stock can't cover it.
+    """
+    if reason not in OUTFLOW_REASONS:
+        raise exceptions.GeneralException(
+            detail=f"'{reason}' is not a stock-out reason"
+        )
+
+    with transaction.atomic():
+        levels = lock_batch_levels({drug.pk: quantity})
+        picks, short = allocate_fefo({drug.pk: quantity}, levels)
+        if short:
+            raise exceptions.InsufficientStockException(
+                detail=f"Insufficient stock for: {drug.name}"
+            )
+        return write_movements(picks, reason, note)
+
+
+def return_stock(drug: Drug, quantity: int, note="", sold_note=None) -> list:
+    """
+    Book `quantity` returned units of `drug` back into stock. When `sold_note`
+    identifies the original sale (e.g. "Order ORD-XXXX"), units go back onto
+    the unexpired batches that sale drew from, latest-expiring first, capped at
+    what was taken from each; anything left over (or every unit, without `sold_note`)
+    goes onto the drug's latest-expiring live batch.
+    """
+    today = timezone.localdate()
+    with transaction.atomic():
+        picks = []
+        remaining = quantity
+        if sold_note:
+            sold = (
+                StockMovement.objects.filter(
+                    drug=drug, reason=StockMovement.Reason.SALE, note=sold_note
+                )
+                .values("batch_id")
+                .annotate(total=-Sum("quantity"))
+                .order_by()
+            )
+            sold = {row["batch_id"]: row["total"] for row in sold}
+            levels = list(
+                BatchStockLevel.objects.select_for_update()
+                .filter(batch_id__in=sold, expiry_date__gte=today)
+                .order_by("-expiry_date", "batch_id")
+            )
+            for level in levels:
+                take = min(sold[level.batch_id], remaining)
+                if take > 0:
+                    picks.append((level, take))
+                    remaining -= take
+                if not remaining:
+                    break
+
+        if remaining:
+            level = (
+                BatchStockLevel.objects.select_for_update()
+                .filter(drug=drug, expiry_date__gte=today)
+                .order_by("-expiry_date", "batch_id")
+                .first()
+            )
+            if level is None:
+                raise exceptions.GeneralException(
+                    detail=f"{drug.name} has no unexpired batch to return stock to"
+                )
+            picks.append((level, remaining))
+
+        return write_movements(picks, StockMovement.Reason.RETURN, note, sign=1)
@@ -0,0 +1,856 @@
+"""
+Benchmarks for pharmacy hot paths, run with `manage.py benchmark <name>`.
+
+Each benchmark builds its own throwaway pharmacy and removes everything it
+created when it finishes, so it can be pointed at a local or staging
+database. Do not run it against production.
+"""
+
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from decimal import Decimal
+
+from django.db import connection
+from django.db.models import F, OuterRef, Q, Subquery, Sum
+from django.db.models.functions import TruncMonth
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from accounts.models import CustomUser
+from helpers import exceptions
+from .models import (
+    BatchStockLevel,
+    Drug,
+    DrugBatch,
+    DrugCategory,
+    DrugStockLevel,
+    DrugUnit,
+    Order,
+    OrderItem,
+    PharmacyOrder,
+    PharmacyProfile,
+    Settlement,
+    StockMovement,
+)
+from .batch_allocation import deduct_stock
+from .dashboard_service import rebuild_daily_stats
+from .drug_matcher import DrugNameIndex
+from .order_service import place_order
+from .settlement_service import sync_settlements
+from .stock_service import rebuild_stock_levels
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+
+    return register
+
+
+class Fixture:
+    """Scratch pharmacy, drugs and buyer, torn down by `cleanup()`."""
+
+    def __init__(self):
+        tag = uuid.uuid4().hex[:8]
+        owner = CustomUser.objects.create(
+            username=f"bench-{tag}", email=f"bench-{tag}@example.com"
+        )
+        self.buyer = CustomUser.objects.create(
+            username=f"bench-buyer-{tag}", email=f"bench-buyer-{tag}@example.com"
+        )
+        self.pharmacy = PharmacyProfile.objects.create(
+            user=owner,
+            pharmacy_name=f"Benchmark {tag}",
+            pharmacy_license=f"BENCH-{tag}",
+            address="Benchmark",
+            phone_number="+233200000000",
+            is_verified=True,
+        )
+        self.category = DrugCategory.objects.create(
+            pharmacy=self.pharmacy, name=f"Benchmark {tag}"
+        )
+
+    def drug(self, name, batches=1, stock_per_batch=0, unit_price="5.00"):
+        drug = Drug.objects.create(
+            pharmacy=self.pharmacy,
+            name=name,
+            category=self.category,
+            base_unit=DrugUnit.TABLET,
+            unit_price=Decimal(unit_price),
+        )
+        today = timezone.localdate()
+        for index in range(batches):
+            batch = DrugBatch.objects.create(
+                pharmacy=self.pharmacy,
+                drug=drug,
+                batch_number=f"{name}-{index}",
+                expiry_date=today + timedelta(days=30 + index),
+            )
+            if stock_per_batch:
+                StockMovement.objects.create(
+                    pharmacy=self.pharmacy,
+                    drug=drug,
+                    batch=batch,
+                    quantity=stock_per_batch,
+                    reason=StockMovement.Reason.RESTOCK,
+                )
+        return drug
+
+    def cleanup(self):
+        Order.objects.filter(user=self.buyer).delete()
+        StockMovement.objects.filter(pharmacy=self.pharmacy).delete()
+        Drug.objects.filter(pharmacy=self.pharmacy).delete()
+        owner = self.pharmacy.user
+        self.pharmacy.delete()
+        owner.delete()
+        self.buyer.delete()
+
+
+def _run_in_thread(func, *args):
+    try:
+        return func(*args)
+    finally:
+        connection.close()
+
+
+@benchmark("checkout-concurrency")
+def checkout_concurrency(stdout, workers=8, iterations=200, size=5):
+    """
+    Fire `iterations` parallel checkouts of `size` units each at a drug that
+    only holds stock for half of them, then check nothing was oversold.
+    """
+    fixture = Fixture()
+    try:
+        batches = 4
+        stock = (iterations * size) // 2
+        per_batch = -(-stock // batches)
+        drug = fixture.drug("Checkout", batches=batches, stock_per_batch=per_batch)
+        stock = per_batch * batches
+
+        def checkout(_):
+            try:
+                place_order(
+                    fixture.buyer,
+                    [{"drug": drug.id, "quantity": size}],
+                    Order.DeliveryMethod.PICKUP,
+                )
+                return True
+            except exceptions.InsufficientStockException:
+                return False
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = list(
+                pool.map(lambda i: _run_in_thread(checkout, i), range(iterations))
+            )
+        elapsed = time.perf_counter() - started
+
+        placed = sum(results)
+        sold = placed * size
+        remaining = DrugStockLevel.objects.get(drug=drug).available_quantity
+        negative = BatchStockLevel.objects.filter(drug=drug, quantity__lt=0).count()
+        drift = rebuild_stock_levels(fixture.pharmacy, commit=False)
+
+        stdout.write(
+            f"{iterations} checkouts on {workers} workers in {elapsed:.2f}s "
+            f"({iterations / elapsed:.0f}/s)"
+        )
+        stdout.write(
+            f"stock={stock} placed={placed} rejected={iterations - placed} "
+            f"sold={sold} remaining={remaining} negative_batches={negative}"
+        )
+        oversold = (
+            sold > stock
+            or remaining != stock - sold
+            or negative
+            or drift["batch_drift"]
+            or drift["drug_drift"]
+        )
+        return not oversold
+    finally:
+        fixture.cleanup()
+
+
+@benchmark("fefo-allocation")
+def fefo_allocation(stdout, workers=1, iterations=200, size=300):
+    """
+    Time FEFO stock-outs against a drug with `size` batches, each call
+    spanning three batches, and check the query count per call matches a
+    drug with only a handful of batches.
+    """
+    fixture = Fixture()
+    try:
+        per_batch = 10
+        quantity = per_batch * 2 + 5
+        iterations = min(iterations, (size * per_batch) // quantity)
+        deep = fixture.drug("Deep", batches=size, stock_per_batch=per_batch)
+        shallow = fixture.drug("Shallow", batches=3, stock_per_batch=per_batch)
+
+        def queries_per_call(drug):
+            with CaptureQueriesContext(connection) as ctx:
+                deduct_stock(drug, quantity, StockMovement.Reason.ADJUSTMENT)
+            return len(ctx.captured_queries)
+
+        shallow_queries = queries_per_call(shallow)
+        deep_queries = queries_per_call(deep)
+
+        started = time.perf_counter()
+        movements = 0
+        for _ in range(iterations - 1):
+            movements += len(
+                deduct_stock(deep, quantity, StockMovement.Reason.ADJUSTMENT)
+            )
+        elapsed = time.perf_counter() - started
+
+        drift = rebuild_stock_levels(fixture.pharmacy, commit=False)
+        stdout.write(
+            f"{iterations - 1} allocations of {quantity} units over {size} batches "
+            f"in {elapsed:.2f}s ({(iterations - 1) / elapsed:.0f}/s, "
+            f"{movements} movements)"
+        )
+        stdout.write(
+            f"queries per allocation: {size} batches={deep_queries} "
+            f"3 batches={shallow_queries}"
+        )
+        return deep_queries == shallow_queries and not (
+            drift["batch_drift"] or drift["drug_drift"]
+        )
+    finally:
+        fixture.cleanup()
+
+
+GENERICS = (
+    "Paracetamol",
+    "Ibuprofen",
+    "Amoxicillin",
+    "Metronidazole",
+    "Ciprofloxacin",
+    "Azithromycin",
+    "Metformin",
+    "Amlodipine",
+    "Lisinopril",
+    "Omeprazole",
+    "Salbutamol",
+    "Diclofenac",
+    "Furosemide",
+    "Cotrimoxazole",
+    "Artemether Lumefantrine",
+    "Doxycycline",
+    "Cetirizine",
+    "Loratadine",
+    "Prednisolone",
+    "Ferrous Sulphate",
+)
+
+
+@benchmark("prescription-matching")
+def prescription_matching(stdout, workers=1, iterations=50, size=10000):
+    """
+    Match a 20-line prescription against a pharmacy of `size` drugs with the
+    name index, against the previous scan of the whole inventory per line.
+    """
+    fixture = Fixture()
+    try:
+        strengths = (100, 125, 200, 250, 400, 500, 625, 1000)
+        forms = ("Tablets", "Capsules", "Syrup", "Injection")
+        per_maker = len(GENERICS) * len(strengths) * len(forms)
+        names = [
+            f"{generic} {strength}mg {form} (Lab {maker})"
+            for maker in range(size // per_maker + 1)
+            for generic in GENERICS
+            for strength in strengths
+            for form in forms
+        ][:size]
+        Drug.objects.bulk_create(
+            [
+                Drug(
+                    pharmacy=fixture.pharmacy,
+                    name=name,
+                    category=fixture.category,
+                    base_unit=DrugUnit.TABLET,
+                    unit_price=Decimal("1.00"),
+                )
+                for name in names
+            ],
+            batch_size=1000,
+        )
+        medications = [
+            "Paracetamol 500mg Tablets",
+            "panadol 500 mg",
+            "Amoxil 250mg",
+            "Metronidazol 200mg",
+            "Ciprofloxacin",
+            "Coartem 20mg",
+            "Ventolin",
+            "Azithromycin 500mg Capsules",
+            "Omeprazol",
+            "Unknown Herbal Mixture",
+        ] * 2
+
+        started = time.perf_counter()
+        index = DrugNameIndex.for_pharmacy(fixture.pharmacy.pk)
+        built = time.perf_counter() - started
+
+        started = time.perf_counter()
+        for _ in range(iterations):
+            matches = index.match_many(medications)
+        indexed = (time.perf_counter() - started) / iterations
+
+        inventory = list(Drug.objects.filter(pharmacy=fixture.pharmacy))
+        started = time.perf_counter()
+        legacy_hits = 0
+        for _ in range(max(1, iterations // 10)):
+            legacy_hits = 0
+            for medication in medications:
+                name = medication.lower()
+                hit = next((d for d in inventory if d.name.lower() == name), None)
+                hit = hit or next(
+                    (
+                        d
+                        for d in inventory
+                        if name in d.name.lower() or d.name.lower() in name
+                    ),
+                    None,
+                )
+                legacy_hits += hit is not None
+        legacy = (time.perf_counter() - started) / max(1, iterations // 10)
+
+        index_hits = sum(1 for medication in medications if matches[medication])
+        stdout.write(
+            f"{len(index)} drugs indexed in {built * 1000:.0f}ms; "
+            f"{len(medications)} lines matched in {indexed * 1000:.2f}ms "
+            f"(scan: {legacy * 1000:.2f}ms)"
+        )
+        stdout.write(f"lines matched: index={index_hits} scan={legacy_hits}")
+        return index_hits >= legacy_hits
+    finally:
+        fixture.cleanup()
+
+
+def _legacy_dashboard_figures(pharmacy, today, first_trend_month):
+    """The aggregates DashboardStatisticsView ran per request before the rollups."""
+    sales_items = (
+        OrderItem.objects.filter(
+            drug__pharmacy=pharmacy, order__payment_status=Order.PaymentStatus.PAID
+        )
+        .exclude(
+            order__pharmacy_orders__pharmacy=pharmacy,
+            order__pharmacy_orders__status__in=[
+                PharmacyOrder.Status.CANCELLED,
+                PharmacyOrder.Status.REFUNDED,
+            ],
+        )
+        .distinct()
+    )
+    orders_today = PharmacyOrder.objects.filter(
+        pharmacy=pharmacy, created_at__date=today
+    ).count()
+    today_revenue = sales_items.filter(order__created_at__date=today).aggregate(
+        total=Sum("total_price")
+    )["total"] or Decimal("0.00")
+    trend = {
+        (row["month"].year, row["month"].month): row["total_amount"]
+        for row in sales_items.filter(order__created_at__date__gte=first_trend_month)
+        .annotate(month=TruncMonth("order__created_at"))
+        .values("month")
+        .annotate(total_amount=Sum("total_price"))
+    }
+    return orders_today, today_revenue, trend
+
+
+@benchmark("dashboard")
+def dashboard(stdout, workers=1, iterations=50, size=20000):
+    """
+    Time the dashboard statistics endpoint for a pharmacy with `size` paid
+    orders spread over the last six months, against the per-request order
+    aggregates it used to run, and check both report the same figures.
+    """
+    from rest_framework.test import APIRequestFactory, force_authenticate
+
+    from .views import DashboardStatisticsView
+
+    fixture = Fixture()
+    try:
+        drug = fixture.drug("Dashboard")
+        now = timezone.now()
+        tag = uuid.uuid4().hex[:8].upper()
+        orders = Order.objects.bulk_create(
+            [
+                Order(
+                    order_number=f"BENCH-{tag}-{index}",
+                    user=fixture.buyer,
+                    payment_status=Order.PaymentStatus.PAID,
+                    subtotal=drug.unit_price * (index % 3 + 1),
+                    total_amount=drug.unit_price * (index % 3 + 1),
+                )
+                for index in range(size)
+            ],
+            batch_size=1000,
+        )
+        OrderItem.objects.bulk_create(
+            [
+                OrderItem(
+                    order=order,
+                    drug=drug,
+                    quantity=index % 3 + 1,
+                    unit_price=drug.unit_price,
+                    total_price=drug.unit_price * (index % 3 + 1),
+                )
+                for index, order in enumerate(orders)
+            ],
+            batch_size=1000,
+        )
+        PharmacyOrder.objects.bulk_create(
+            [
+                PharmacyOrder(
+                    pharmacy=fixture.pharmacy,
+                    order=order,
+                    status=(
+                        PharmacyOrder.Status.CANCELLED
+                        if index % 10 == 0
+                        else PharmacyOrder.Status.DELIVERED
+                    ),
+                )
+                for index, order in enumerate(orders)
+            ],
+            batch_size=1000,
+        )
+        # Spread the orders over ~180 days (auto_now_add pinned them to now).
+        for index, order in enumerate(orders):
+            order.created_at = now - timedelta(minutes=index * 180 * 24 * 60 // size)
+        Order.objects.bulk_update(orders, ["created_at"], batch_size=1000)
+        PharmacyOrder.objects.filter(pharmacy=fixture.pharmacy).update(
+            created_at=Subquery(
+                Order.objects.filter(id=OuterRef("order_id")).values("created_at")
+            )
+        )
+
+        started = time.perf_counter()
+        rows = rebuild_daily_stats([fixture.pharmacy.pk])
+        rebuilt = time.perf_counter() - started
+
+        view = DashboardStatisticsView.as_view()
+        factory = APIRequestFactory()
+
+        def fetch():
+            request = factory.get("/pharmacies/dashboard-statistics/")
+            force_authenticate(request, user=fixture.pharmacy.user)
+            return view(request).data
+
+        with CaptureQueriesContext(connection) as ctx:
+            data = fetch()
+        started = time.perf_counter()
+        for _ in range(iterations):
+            fetch()
+        rollup = (time.perf_counter() - started) / iterations
+
+        today = timezone.localdate()
+        first_trend_month = (today.replace(day=1) - timedelta(days=150)).replace(day=1)
+        started = time.perf_counter()
+        for _ in range(iterations):
+            legacy = _legacy_dashboard_figures(
+                fixture.pharmacy, today, first_trend_month
+            )
+        legacy_time = (time.perf_counter() - started) / iterations
+
+        orders_today, today_revenue, trend = legacy
+        trend_total = sum(
+            point["total_amount"] for point in data["monthly_sales_trend"]
+        )
+        stdout.write(
+            f"{size} orders rolled up into {rows} day rows in {rebuilt * 1000:.0f}ms"
+        )
+        stdout.write(
+            f"dashboard request: {rollup * 1000:.2f}ms ({len(ctx.captured_queries)} "
+            f"queries); legacy order aggregates alone: {legacy_time * 1000:.2f}ms"
+        )
+        return (
+            data["orders_today"]["count"] == orders_today
+            and data["today_revenue"]["amount"] == today_revenue
+            and trend_total == sum(trend.values(), Decimal("0.00"))
+        )
+    finally:
+        fixture.cleanup()
+
+
+@benchmark("deep-pagination")
+def deep_pagination(stdout, workers=1, iterations=20, size=100000):
+    """
+    Time the stock movement list at increasingly deep pages of a `size`-row
+    ledger, page-number (COUNT + OFFSET) against keyset cursors, and check
+    both return the same rows.
+    """
+    from django.conf import settings
+    from rest_framework.test import APIRequestFactory, force_authenticate
+
+    from config.pagination import KeysetPagination
+    from .views import StockMovementViewSet
+
+    fixture = Fixture()
+    try:
+        drug = fixture.drug("Ledger", batches=1)
+        batch = drug.batches.get()
+        StockMovement.objects.bulk_create(
+            (
+                StockMovement(
+                    pharmacy=fixture.pharmacy,
+                    drug=drug,
+                    batch=batch,
+                    quantity=1,
+                    reason=StockMovement.Reason.RESTOCK,
+                )
+                for _ in range(size)
+            ),
+            batch_size=5000,
+        )
+        # Planner statistics for the freshly loaded rows, as autovacuum would.
+        with connection.cursor() as cursor:
+            cursor.execute(f"ANALYZE {StockMovement._meta.db_table}")
+        keys = list(
+            StockMovement.objects.filter(pharmacy=fixture.pharmacy)
+            .order_by("-created_at", "-pk")
+            .values_list("created_at", "pk")
+        )
+
+        view = StockMovementViewSet.as_view({"get": "list"})
+        # Page links are absolute, so requests need a host the site accepts.
+        factory = APIRequestFactory(SERVER_NAME=settings.ALLOWED_HOSTS[0])
+        page_size = 50
+
+        def fetch(query):
+            request = factory.get("/pharmacies/stock-movements/", query)
+            force_authenticate(request, user=fixture.pharmacy.user)
+            return view(request).data
+
+        def timed(query):
+            started = time.perf_counter()
+            for _ in range(iterations):
+                data = fetch(query)
+            return data, (time.perf_counter() - started) / iterations
+
+        matches = True
+        depth = 1
+        while depth * page_size <= size:
+            offset = (depth - 1) * page_size
+            numbered, numbered_time = timed(
+                {"page": depth, "page_size": page_size, "ordering": "-created_at"}
+            )
+            cursor = (
+                KeysetPagination(page_size).encode_cursor(*keys[offset - 1])
+                if offset
+                else ""
+            )
+            keyset, keyset_time = timed(
+                {"cursor": cursor, "page_size": page_size, "count": "false"}
+            )
+            stdout.write(
+                f"page {depth} (offset {offset}): page-number "
+                f"{numbered_time * 1000:.2f}ms, cursor {keyset_time * 1000:.2f}ms"
+            )
+            matches = matches and [row["id"] for row in numbered["results"]] == [
+                row["id"] for row in keyset["results"]
+            ]
+            depth *= 10
+        return matches
+    finally:
+        fixture.cleanup()
+
+
+@benchmark("settlement-sync")
+def settlement_sync(stdout, workers=1, iterations=3, size=100000):
+    """
+    Time the set-based settlement sync over `size` paid orders spread across
+    ninety days: a cold sync that creates every settlement, a sync with
+    nothing to change, and one after 1% of the orders changed. Checks the
+    settlements match the settled order totals afterwards.
+    """
+    fixture = Fixture()
+    try:
+        drug = fixture.drug("Settlement")
+        now = timezone.now()
+        tag = uuid.uuid4().hex[:8].upper()
+        orders = Order.objects.bulk_create(
+            [
+                Order(
+                    order_number=f"BENCH-{tag}-{index}",
+                    user=fixture.buyer,
+                    payment_status=Order.PaymentStatus.PAID,
+                    subtotal=drug.unit_price * (index % 3 + 1),
+                    total_amount=drug.unit_price * (index % 3 + 1),
+                )
+                for index in range(size)
+            ],
+            batch_size=5000,
+        )
+        OrderItem.objects.bulk_create(
+            (
+                OrderItem(
+                    order=order,
+                    drug=drug,
+                    quantity=index % 3 + 1,
+                    unit_price=drug.unit_price,
+                    total_price=drug.unit_price * (index % 3 + 1),
+                )
+                for index, order in enumerate(orders)
+            ),
+            batch_size=5000,
+        )
+        PharmacyOrder.objects.bulk_create(
+            (
+                PharmacyOrder(
+                    pharmacy=fixture.pharmacy,
+                    order=order,
+                    status=(
+                        PharmacyOrder.Status.PROCESSING
+                        if index % 20 == 0
+                        else PharmacyOrder.Status.DELIVERED
+                    ),
+                )
+                for index, order in enumerate(orders)
+            ),
+            batch_size=5000,
+        )
+        for index, order in enumerate(orders):
+            order.created_at = now - timedelta(minutes=index * 90 * 24 * 60 // size)
+        Order.objects.bulk_update(orders, ["created_at"], batch_size=5000)
+        with connection.cursor() as cursor:
+            for model in (Order, OrderItem, PharmacyOrder):
+                cursor.execute(f"ANALYZE {model._meta.db_table}")
+
+        def timed(label, repeat=1):
+            best = None
+            for _ in range(repeat):
+                started = time.perf_counter()
+                with CaptureQueriesContext(connection) as ctx:
+                    stats = sync_settlements([fixture.pharmacy.pk])
+                elapsed = time.perf_counter() - started
+                best = elapsed if best is None else min(best, elapsed)
+            stdout.write(
+                f"{label} sync: {best * 1000:.0f}ms, {len(ctx.captured_queries)} "
+                f"queries, {stats}"
+            )
+
+        timed("cold")
+        timed("unchanged", repeat=iterations)
+        changed = [order.id for order in orders[1::100]]
+        OrderItem.objects.filter(order_id__in=changed).update(
+            total_price=F("total_price") + 1
+        )
+        timed("1% changed")
+
+        settled = OrderItem.objects.filter(
+            drug=drug,
+            order__pharmacy_orders__status=PharmacyOrder.Status.DELIVERED,
+        ).aggregate(total=Sum("total_price"))["total"]
+        stored = Settlement.objects.filter(pharmacy=fixture.pharmacy).aggregate(
+            total=Sum("total_amount")
+        )["total"]
+        stdout.write(f"settled {settled}, stored across settlements {stored}")
+        return settled == stored
+    finally:
+        fixture.cleanup()
+
+
+@benchmark("settlement-shards")
+def settlement_shards(stdout, workers=8, iterations=1, size=200):
+    """
+    Run the nightly settlement reconciliation in eager mode over `size`
+    pharmacies with forty delivered orders each and every checksum cleared,
+    first as one shard and then as `workers` shards, and check nothing is
+    left drifted. Eager mode runs shards one after another, so this times the
+    per-shard overhead and balance rather than the parallel speed-up.
+    """
+    from django.test import override_settings
+
+    from .settlement_service import find_drifted_settlements
+    from .tasks import calculate_daily_settlements
+
+    fixture = Fixture()
+    pharmacies = []
+    try:
+        tag = uuid.uuid4().hex[:8]
+        owners = CustomUser.objects.bulk_create(
+            CustomUser(
+                username=f"bench-{tag}-{index}",
+                email=f"bench-{tag}-{index}@example.com",
+            )
+            for index in range(size)
+        )
+        pharmacies = PharmacyProfile.objects.bulk_create(
+            PharmacyProfile(
+                user=owner,
+                pharmacy_name=f"Benchmark {tag} {index}",
+                pharmacy_license=f"BENCH-{tag}-{index}",
+                address="Benchmark",
+                phone_number="+233200000000",
+                is_verified=True,
+            )
+            for index, owner in enumerate(owners)
+        )
+        drugs = Drug.objects.bulk_create(
+            Drug(
+                pharmacy=pharmacy,
+                name="Settlement",
+                category=fixture.category,
+                base_unit=DrugUnit.TABLET,
+                unit_price=Decimal("5.00"),
+            )
+            for pharmacy in pharmacies
+        )
+        orders = Order.objects.bulk_create(
+            (
+                Order(
+                    order_number=f"BENCH-{tag}-{index}",
+                    user=fixture.buyer,
+                    payment_status=Order.PaymentStatus.PAID,
+                    subtotal=Decimal("5.00"),
+                    total_amount=Decimal("5.00"),
+                )
+                for index in range(size * 40)
+            ),
+            batch_size=5000,
+        )
+        OrderItem.objects.bulk_create(
+            (
+                OrderItem(
+                    order=order,
+                    drug=drugs[index % size],
+                    quantity=1,
+                    unit_price=Decimal("5.00"),
+                    total_price=Decimal("5.00"),
+                )
+                for index, order in enumerate(orders)
+            ),
+            batch_size=5000,
+        )
+        PharmacyOrder.objects.bulk_create(
+            (
+                PharmacyOrder(
+                    pharmacy=pharmacies[index % size],
+                    order=order,
+                    status=PharmacyOrder.Status.DELIVERED,
+                )
+                for index, order in enumerate(orders)
+            ),
+            batch_size=5000,
+        )
+        pharmacy_ids = [pharmacy.pk for pharmacy in pharmacies]
+        sync_settlements(pharmacy_ids)
+
+        with override_settings(CELERY_TASK_ALWAYS_EAGER=True):
+            for shards in (1, workers):
+                Settlement.objects.filter(pharmacy_id__in=pharmacy_ids).update(
+                    checksum=""
+                )
+                started = time.perf_counter()
+                calculate_daily_settlements(shards=shards)
+                elapsed = time.perf_counter() - started
+                stdout.write(f"{shards} shard(s): {elapsed * 1000:.0f}ms")
+        return not find_drifted_settlements(pharmacy_ids)
+    finally:
+        Order.objects.filter(user=fixture.buyer).delete()
+        for pharmacy in pharmacies:
+            pharmacy.user.delete()
+        fixture.cleanup()
+
+
+@benchmark("drug-search")
+def drug_search(stdout, workers=1, iterations=20, size=100000):
+    """
+    Time catalogue searches over `size` drugs: the indexed, ranked search
+    against the `icontains` scan it replaced, for a prefix, a multi-word, a
+    brand-name and a misspelled query (the last one includes the fallback
+    to corrected words). Reports the median latency of loading the first
+    page of twenty results; checks every query finds the drug it targets.
+    """
+    from statistics import median
+
+    from .search_service import index_drugs, search_drugs
+
+    generics = [
+        "Paracetamol",
+        "Ibuprofen",
+        "Amoxicillin",
+        "Metronidazole",
+        "Ciprofloxacin",
+        "Artemether Lumefantrine",
+        "Salbutamol",
+        "Metformin",
+        "Azithromycin",
+        "Diclofenac",
+        "Furosemide",
+        "Amlodipine",
+        "Cotrimoxazole",
+        "Omeprazole",
+        "Loratadine",
+        "Cetirizine",
+        "Prednisolone",
+        "Doxycycline",
+        "Fluconazole",
+        "Losartan",
+    ]
+    forms = ["Tablets", "Capsules", "Syrup", "Suspension", "Injection", "Cream"]
+    fixture = Fixture()
+    try:
+        started = time.perf_counter()
+        Drug.objects.bulk_create(
+            (
+                Drug(
+                    pharmacy=fixture.pharmacy,
+                    name=(
+                        f"{generics[index % len(generics)]} "
+                        f"{(index // len(generics)) % 50 * 50 + 50}mg "
+                        f"{forms[index % len(forms)]} {index}"
+                    ),
+                    category=fixture.category,
+                    base_unit=DrugUnit.TABLET,
+                    unit_price=Decimal("1.00"),
+                )
+                for index in range(size)
+            ),
+            batch_size=5000,
+        )
+        catalogue = Drug.objects.filter(pharmacy=fixture.pharmacy)
+        index_drugs(catalogue)
+        with connection.cursor() as cursor:
+            cursor.execute(f"ANALYZE {Drug._meta.db_table}")
+        stdout.write(
+            f"built and indexed {size} drugs in {time.perf_counter() - started:.1f}s"
+        )
+
+        def timed(run):
+            timings = []
+            for _ in range(iterations):
+                started = time.perf_counter()
+                rows = list(run()[:20])
+                timings.append(time.perf_counter() - started)
+            return median(timings) * 1000, rows
+
+        passed = True
+        for text, expected in (
+            ("amox", "Amoxicillin"),
+            ("paracetamol 500 syrup", "Paracetamol"),
+            ("panadol", "Paracetamol"),
+            ("metronidazol", "Metronidazole"),
+            ("ciprofloxacn", "Ciprofloxacin"),
+        ):
+            scan_ms, _ = timed(
+                lambda: catalogue.filter(
+                    Q(name__icontains=text) | Q(category__name__icontains=text)
+                ).order_by("name")
+            )
+            search_ms, rows = timed(lambda: search_drugs(catalogue, text))
+            found = bool(rows) and all(expected in drug.name for drug in rows)
+            passed = passed and found
+            stdout.write(
+                f"{text!r}: icontains {scan_ms:.1f}ms, search {search_ms:.1f}ms, "
+                f"top hit {rows[0].name if rows else None!r}"
+            )
+        return passed
+    finally:
+        fixture.cleanup()
@@ -1,18 +1,114 @@
 import json
-from typing import Dict, Optional
 from decimal import Decimal
-from django.core.cache import cache
+from typing import Dict, Optional
+
 from loguru import logger
 
+from helpers.redis_client import get_redis
+
 # Cart expires after 18 hours (in seconds)
 CART_TTL = 18 * 60 * 60  # 64800 seconds
 
+# Each cart is one Redis hash. Every line (keyed "<pharmacy_id>:<drug_id>")
+# owns four fields: qty:<line>, price:<line> (unit price in pesewas),
+# item:<line> (JSON display data) and pos:<line> (insertion order). The hash
+# also carries running total_items / total_cents, a version bumped by every
+# write, and the prescription_code. Writes run as Lua scripts so they are
+# atomic on the server and return the updated hash in the same round trip.
+_DROP_LINE = """
+local function drop_line(line)
+  local qty = tonumber(redis.call('HGET', KEYS[1], 'qty:' .. line) or '0')
+  if qty == 0 then return false end
+  local price = tonumber(redis.call('HGET', KEYS[1], 'price:' .. line) or '0')
+  redis.call('HDEL', KEYS[1], 'qty:' .. line, 'price:' .. line,
+             'item:' .. line, 'pos:' .. line)
+  redis.call('HINCRBY', KEYS[1], 'total_items', -qty)
+  redis.call('HINCRBY', KEYS[1], 'total_cents', -qty * price)
+  return true
+end
+"""
+
+# ARGV: line, quantity, price_cents, item_json, ttl
+_ADD_ITEM = """
+local line = ARGV[1]
+local qty = tonumber(ARGV[2])
+local version = redis.call('HINCRBY', KEYS[1], 'version', 1)
+if redis.call('HEXISTS', KEYS[1], 'qty:' .. line) == 0 then
+  redis.call('HSET', KEYS[1], 'price:' .. line, ARGV[3],
+             'item:' .. line, ARGV[4], 'pos:' .. line, version)
+end
+local price = tonumber(redis.call('HGET', KEYS[1], 'price:' .. line))
+redis.call('HINCRBY', KEYS[1], 'qty:' .. line, qty)
+redis.call('HINCRBY', KEYS[1], 'total_items', qty)
+redis.call('HINCRBY', KEYS[1], 'total_cents', qty * price)
+redis.call('EXPIRE', KEYS[1], ARGV[5])
+return redis.call('HGETALL', KEYS[1])
+"""
+
+# ARGV: line, quantity (0 removes the line), ttl
+_SET_QUANTITY = (
+    _DROP_LINE
+    + """
+local line = ARGV[1]
+local qty = tonumber(ARGV[2])
+local old = tonumber(redis.call('HGET', KEYS[1], 'qty:' .. line) or '0')
+if old > 0 then
+  if qty > 0 then
+    local price = tonumber(redis.call('HGET', KEYS[1], 'price:' .. line))
+    redis.call('HSET', KEYS[1], 'qty:' .. line, qty)
+    redis.call('HINCRBY', KEYS[1], 'total_items', qty - old)
+    redis.call('HINCRBY', KEYS[1], 'total_cents', (qty - old) * price)
+  else
+    drop_line(line)
+  end
+  redis.call('HINCRBY', KEYS[1], 'version', 1)
+  redis.call('EXPIRE', KEYS[1], ARGV[3])
+end
+return redis.call('HGETALL', KEYS[1])
+"""
+)
+
+# ARGV: pharmacy_id, ttl
+_CLEAR_PHARMACY = (
+    _DROP_LINE
+    + """
+local prefix = 'qty:' .. ARGV[1] .. ':'
+local changed = false
+for _, field in ipairs(redis.call('HKEYS', KEYS[1])) do
+  if string.sub(field, 1, #prefix) == prefix then
+    changed = drop_line(string.sub(field, 5)) or changed
+  end
+end
+if changed then
+  redis.call('HINCRBY', KEYS[1], 'version', 1)
+  redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 1
+"""
+)
+
+_scripts = {}
+
+
+def _script(source: str):
+    if source not in _scripts:
+        _scripts[source] = get_redis().register_script(source)
+    return _scripts[source]
+
+
+def _to_cents(amount: Decimal) -> int:
+    return int((Decimal(amount) * 100).to_integral_value())
+
+
+def _from_cents(cents) -> Decimal:
+    return (Decimal(int(cents)) / 100).quantize(Decimal("0.01"))
+
 
 class CartService:
     """
     Redis-based shopping cart service.
     Cart is tied to a user (not pharmacy) and can contain items from multiple pharmacies.
-    Cart items are stored in Redis with automatic expiration after 18 hours.
+    Cart items are stored in a Redis hash with automatic expiration after 18 hours.
     """
 
     @staticmethod
@@ -21,83 +117,56 @@ class CartService:
         return f"cart:{user_id}"
 
     @staticmethod
-    def _serialize_item(item: Dict) -> str:
-        """Serialize cart item to JSON string"""
-        # Convert Decimal to string for JSON serialization
-        serialized = {}
-        for key, value in item.items():
-            if isinstance(value, Decimal):
-                serialized[key] = str(value)
-            else:
-                serialized[key] = value
-        return json.dumps(serialized)
+    def _line(pharmacy_id: str, drug_id: str) -> str:
+        return f"{pharmacy_id}:{drug_id}"
 
     @staticmethod
-    def _deserialize_item(item_str: str) -> Dict:
-        """Deserialize JSON string to cart item"""
-        item = json.loads(item_str)
-        # Convert price strings back to Decimal
-        if "unit_price" in item:
-            item["unit_price"] = Decimal(item["unit_price"])
-        if "subtotal" in item:
-            item["subtotal"] = Decimal(item["subtotal"])
-        return item
-
-    @classmethod
-    def get_cart(cls, user_id: str) -> Dict:
+    def _build_cart(data) -> Dict:
         """
-        Get all items in the user's cart.
-        Returns cart data with items grouped by pharmacy, totals, and metadata.
+        Build the cart dict from the raw hash (a dict, or the flat field/value
+        list a script returns). Totals come from the maintained counters.
         """
-        cart_key = cls._get_cart_key(user_id)
-        cart_data = cache.get(cart_key)
-
-        if not cart_data:
-            return {
-                "items": [],
-                # "items_by_pharmacy": {},
-                "total_items": 0,
-                "total_amount": Decimal("0.00"),
-                "prescription_code": None,
-            }
-
-        # Deserialize items
+        if isinstance(data, list):
+            data = dict(zip(data[::2], data[1::2]))
+
+        lines = {}
+        for field, value in data.items():
+            kind, _, line = field.partition(":")
+            if kind in ("qty", "price", "item", "pos"):
+                lines.setdefault(line, {})[kind] = value
+
         items = []
-        for item_str in cart_data.get("items", []):
+        for line, parts in sorted(lines.items(), key=lambda x: int(x[1].get("pos", 0))):
             try:
-                items.append(cls._deserialize_item(item_str))
-            except (json.JSONDecodeError, KeyError) as e:
-                logger.error(f"Error deserializing cart item: {e}")
+                item = json.loads(parts["item"])
+                quantity = int(parts["qty"])
+                unit_price = _from_cents(parts["price"])
+            except (json.JSONDecodeError, KeyError, ValueError) as e:
+                logger.error(f"Error decoding cart line {line}: {e}")
                 continue
-
-        # Group items by pharmacy
-        # items_by_pharmacy = {}
-        # for item in items:
-        #     pharmacy_id = item.get("pharmacy_id")
-        #     if pharmacy_id not in items_by_pharmacy:
-        #         items_by_pharmacy[pharmacy_id] = {
-        #             "pharmacy_id": pharmacy_id,
-        #             "pharmacy_name": item.get("pharmacy_name"),
-        #             "items": [],
-        #             "subtotal": Decimal("0.00"),
-        #         }
-        #     items_by_pharmacy[pharmacy_id]["items"].append(item)
-        #     items_by_pharmacy[pharmacy_id]["subtotal"] += Decimal(
-        #         str(item.get("subtotal", 0))
-        #     )
-
-        # Calculate totals
-        total_items = sum(item.get("quantity", 0) for item in items)
-        total_amount = sum(Decimal(str(item.get("subtotal", 0))) for item in items)
+            item.update(
+                quantity=quantity,
+                unit_price=unit_price,
+                subtotal=unit_price * quantity,
+            )
+            items.append(item)
 
         return {
             "items": items,
-            # "items_by_pharmacy": list(items_by_pharmacy.values()),
-            "total_items": total_items,
-            "total_amount": total_amount,
-            "prescription_code": cart_data.get("prescription_code"),
+            "total_items": int(data.get("total_items", 0)),
+            "total_amount": _from_cents(data.get("total_cents", 0)),
+            "prescription_code": data.get("prescription_code"),
+            "version": int(data.get("version", 0)),
         }
 
+    @classmethod
+    def get_cart(cls, user_id: str) -> Dict:
+        """
+        Get all items in the user's cart (one HGETALL).
+        Returns cart data with items, totals, and metadata.
+        """
+        return cls._build_cart(get_redis().hgetall(cls._get_cart_key(user_id)))
+
     @classmethod
     def add_item(
         cls,
@@ -112,56 +181,29 @@ class CartService:
         base_unit: Optional[str] = None,
     ) -> Dict:
         """
-        Add an item to the cart or update quantity if it already exists.
+        Add an item to the cart or increase its quantity if it already exists
+        (the price captured when the line was first added is kept).
         Returns the updated cart.
         """
-        cart_key = cls._get_cart_key(user_id)
-        cart_data = cache.get(cart_key) or {"items": [], "prescription_code": None}
-
-        # Deserialize existing items
-        items = []
-        for item_str in cart_data.get("items", []):
-            try:
-                items.append(cls._deserialize_item(item_str))
-            except (json.JSONDecodeError, KeyError):
-                continue
-
-        # Check if item already exists (same drug AND same pharmacy)
-        existing_item = None
-        for item in items:
-            if (
-                item.get("drug_id") == drug_id
-                and item.get("pharmacy_id") == pharmacy_id
-            ):
-                existing_item = item
-                break
-
-        if existing_item:
-            # Update quantity
-            existing_item["quantity"] += quantity
-            existing_item["subtotal"] = (
-                existing_item["unit_price"] * existing_item["quantity"]
-            )
-        else:
-            # Add new item
-            new_item = {
-                "drug_id": drug_id,
-                "drug_name": drug_name,
-                "drug_image": drug_image,
-                "base_unit": base_unit,
-                "quantity": quantity,
-                "unit_price": unit_price,
-                "subtotal": unit_price * quantity,
-                "pharmacy_id": pharmacy_id,
-                "pharmacy_name": pharmacy_name,
-            }
-            items.append(new_item)
-
-        # Serialize and save
-        cart_data["items"] = [cls._serialize_item(item) for item in items]
-        cache.set(cart_key, cart_data, timeout=CART_TTL)
-
-        return cls.get_cart(user_id)
+        item = {
+            "drug_id": drug_id,
+            "drug_name": drug_name,
+            "drug_image": drug_image,
+            "base_unit": base_unit,
+            "pharmacy_id": pharmacy_id,
+            "pharmacy_name": pharmacy_name,
+        }
+        data = _script(_ADD_ITEM)(
+            keys=[cls._get_cart_key(user_id)],
+            args=[
+                cls._line(pharmacy_id, drug_id),
+                quantity,
+                _to_cents(unit_price),
+                json.dumps(item),
+                CART_TTL,
+            ],
+        )
+        return cls._build_cart(data)
 
     @classmethod
     def update_item_quantity(
@@ -176,38 +218,11 @@ class CartService:
         If quantity is 0 or less, the item is removed.
         Returns the updated cart.
         """
-        if quantity <= 0:
-            return cls.remove_item(user_id, pharmacy_id, drug_id)
-
-        cart_key = cls._get_cart_key(user_id)
-        cart_data = cache.get(cart_key)
-
-        if not cart_data:
-            return cls.get_cart(user_id)
-
-        # Deserialize existing items
-        items = []
-        for item_str in cart_data.get("items", []):
-            try:
-                items.append(cls._deserialize_item(item_str))
-            except (json.JSONDecodeError, KeyError):
-                continue
-
-        # Find and update item (match both drug_id and pharmacy_id)
-        for item in items:
-            if (
-                item.get("drug_id") == drug_id
-                and item.get("pharmacy_id") == pharmacy_id
-            ):
-                item["quantity"] = quantity
-                item["subtotal"] = item["unit_price"] * quantity
-                break
-
-        # Serialize and save
-        cart_data["items"] = [cls._serialize_item(item) for item in items]
-        cache.set(cart_key, cart_data, timeout=CART_TTL)
-
-        return cls.get_cart(user_id)
+        data = _script(_SET_QUANTITY)(
+            keys=[cls._get_cart_key(user_id)],
+            args=[cls._line(pharmacy_id, drug_id), max(quantity, 0), CART_TTL],
+        )
+        return cls._build_cart(data)
 
     @classmethod
     def remove_item(cls, user_id: str, pharmacy_id: str, drug_id: str) -> Dict:
@@ -215,35 +230,7 @@ class CartService:
         Remove an item from the cart.
         Returns the updated cart.
         """
-        cart_key = cls._get_cart_key(user_id)
-        cart_data = cache.get(cart_key)
-
-        if not cart_data:
-            return cls.get_cart(user_id)
-
-        # Deserialize existing items
-        items = []
-        for item_str in cart_data.get("items", []):
-            try:
-                items.append(cls._deserialize_item(item_str))
-            except (json.JSONDecodeError, KeyError):
-                continue
-
-        # Remove the item (match both drug_id and pharmacy_id)
-        items = [
-            item
-            for item in items
-            if not (
-                item.get("drug_id") == drug_id
-                and item.get("pharmacy_id") == pharmacy_id
-            )
-        ]
-
-        # Serialize and save
-        cart_data["items"] = [cls._serialize_item(item) for item in items]
-        cache.set(cart_key, cart_data, timeout=CART_TTL)
-
-        return cls.get_cart(user_id)
+        return cls.update_item_quantity(user_id, pharmacy_id, drug_id, 0)
 
     @classmethod
     def clear_cart(cls, user_id: str, pharmacy_id: Optional[str] = None) -> bool:
@@ -256,30 +243,10 @@ class CartService:
         cart_key = cls._get_cart_key(user_id)
 
         if pharmacy_id is None:
-            # Clear entire cart
-            cache.delete(cart_key)
+            get_redis().delete(cart_key)
             return True
 
-        # Clear only items from specific pharmacy
-        cart_data = cache.get(cart_key)
-        if not cart_data:
-            return True
-
-        # Deserialize existing items
-        items = []
-        for item_str in cart_data.get("items", []):
-            try:
-                items.append(cls._deserialize_item(item_str))
-            except (json.JSONDecodeError, KeyError):
-                continue
-
-        # Keep only items NOT from the specified pharmacy
-        items = [item for item in items if item.get("pharmacy_id") != pharmacy_id]
-
-        # Serialize and save
-        cart_data["items"] = [cls._serialize_item(item) for item in items]
-        cache.set(cart_key, cart_data, timeout=CART_TTL)
-
+        _script(_CLEAR_PHARMACY)(keys=[cart_key], args=[pharmacy_id, CART_TTL])
         return True
 
     @classmethod
@@ -289,10 +256,12 @@ class CartService:
         Returns the updated cart.
         """
         cart_key = cls._get_cart_key(user_id)
-        cart_data = cache.get(cart_key) or {"items": [], "prescription_code": None}
-        cart_data["prescription_code"] = prescription_code
-        cache.set(cart_key, cart_data, timeout=CART_TTL)
-        return cls.get_cart(user_id)
+        pipe = get_redis().pipeline(transaction=True)
+        pipe.hset(cart_key, "prescription_code", prescription_code)
+        pipe.hincrby(cart_key, "version", 1)
+        pipe.expire(cart_key, CART_TTL)
+        pipe.hgetall(cart_key)
+        return cls._build_cart(pipe.execute()[-1])
 
     @classmethod
     def refresh_cart_ttl(cls, user_id: str) -> bool:
@@ -300,21 +269,13 @@ class CartService:
         Refresh the cart's TTL (reset the 18-hour timer).
         Returns True if successful.
         """
-        cart_key = cls._get_cart_key(user_id)
-        cart_data = cache.get(cart_key)
-        if cart_data:
-            cache.set(cart_key, cart_data, timeout=CART_TTL)
-            return True
-        return False
+        return bool(get_redis().expire(cls._get_cart_key(user_id), CART_TTL))
 
     @classmethod
     def get_cart_ttl(cls, user_id: str) -> Optional[int]:
         """
-        Get the remaining TTL for the cart in seconds.
+        Get the remaining TTL for the cart in seconds, as reported by Redis.
         Returns None if cart doesn't exist.
         """
-        cart_key = cls._get_cart_key(user_id)
-        cart_data = cache.get(cart_key)
-        if cart_data:
-            return CART_TTL  # Approximate, as we can't get exact TTL from Django cache
-        return None
+        ttl = get_redis().ttl(cls._get_cart_key(user_id))
+        return ttl if ttl >= 0 else None
@@ -0,0 +1,118 @@
+"""
+Cart revalidation.
+
+Cart lines keep the price captured when they were added and know nothing about
+current stock. `revalidate_cart` reprices and stock-checks every line of a cart
+against `Drug` and the materialized stock levels in a single query, and reports
+a per-line diff. Results are cached briefly under a digest of the cart's lines,
+so the cart views can call it on every request: any change to the lines misses
+the cache (the cart version alone would not do, as clearing a cart deletes its
+hash and restarts the version), while price or stock changes are picked up
+within VALIDATION_CACHE_TTL seconds.
+"""
+
+import hashlib
+import json
+from decimal import Decimal
+from typing import Dict
+
+from django.core.cache import cache
+
+from .models import Drug
+from .stock_service import annotate_stock
+
+VALIDATION_CACHE_TTL = 30
+
+
+class LineIssue:
+    PRICE_CHANGED = "price_changed"
+    OUT_OF_STOCK = "out_of_stock"
+    INSUFFICIENT_STOCK = "insufficient_stock"
+    PHARMACY_UNVERIFIED = "pharmacy_unverified"
+    UNAVAILABLE = "unavailable"
+
+
+def _validation_cache_key(user_id: str, cart: Dict) -> str:
+    lines = [
+        [
+            item["pharmacy_id"],
+            item["drug_id"],
+            item["quantity"],
+            str(item["unit_price"]),
+        ]
+        for item in cart.get("items", [])
+    ]
+    digest = hashlib.sha1(json.dumps(lines).encode()).hexdigest()
+    return f"cart-validation:{user_id}:{digest}"
+
+
+def revalidate_cart(cart: Dict) -> Dict:
+    """
+    Diff every line of `cart` (as returned by CartService) against current
+    prices and stock. Each line reports its issues, the current unit price
+    and available quantity; `valid` is True only if no line has an issue.
+    """
+    items = cart.get("items", [])
+    current = {
+        str(row["id"]): row
+        for row in annotate_stock(
+            Drug.objects.filter(id__in=[item["drug_id"] for item in items])
+        ).values(
+            "id",
+            "unit_price",
+            "pharmacy_id",
+            "pharmacy__is_verified",
+            "available_quantity",
+        )
+    }
+
+    lines = []
+    total_amount = Decimal("0.00")
+    for item in items:
+        drug = current.get(item["drug_id"])
+        line = {
+            "drug_id": item["drug_id"],
+            "pharmacy_id": item["pharmacy_id"],
+            "quantity": item["quantity"],
+            "cart_unit_price": item["unit_price"],
+            "current_unit_price": None,
+            "available_quantity": 0,
+            "issues": [],
+        }
+        lines.append(line)
+
+        if drug is None or str(drug["pharmacy_id"]) != item["pharmacy_id"]:
+            line["issues"].append(LineIssue.UNAVAILABLE)
+            continue
+
+        available = drug["available_quantity"] or 0
+        line["current_unit_price"] = drug["unit_price"]
+        line["available_quantity"] = available
+        total_amount += drug["unit_price"] * item["quantity"]
+
+        if drug["unit_price"] != item["unit_price"]:
+            line["issues"].append(LineIssue.PRICE_CHANGED)
+        if available <= 0:
+            line["issues"].append(LineIssue.OUT_OF_STOCK)
+        elif available < item["quantity"]:
+            line["issues"].append(LineIssue.INSUFFICIENT_STOCK)
+        if not drug["pharmacy__is_verified"]:
+            line["issues"].append(LineIssue.PHARMACY_UNVERIFIED)
+
+    return {
+        "version": cart.get("version", 0),
+        "valid": not any(line["issues"] for line in lines),
+        "total_amount": total_amount,
+        "lines": lines,
+    }
+
+
+def get_cart_validation(user_id: str, cart: Dict) -> Dict:
+    """revalidate_cart, cached for a few seconds per set of cart lines."""
+    key = _validation_cache_key(user_id, cart)
+    result = cache.get(key)
+    if result is None:
+        result = revalidate_cart(cart)
+        cache.set(key, result, VALIDATION_CACHE_TTL)
+    # Another write (e.g. a prescription code) may have bumped the version.
+    return {**result, "version": cart.get("version", 0)}
@@ -5,6 +5,7 @@ from rest_framework import serializers
 from drf_spectacular.utils import extend_schema, OpenApiParameter
 
 from .cart_service import CartService
+from .cart_validation import get_cart_validation
 from .models import Drug
 
 
@@ -75,6 +76,29 @@ class PharmacyGroupSerializer(serializers.Serializer):
     subtotal = serializers.DecimalField(max_digits=10, decimal_places=2)
 
 
+class CartLineValidationSerializer(serializers.Serializer):
+    """Serializer for one line of a cart revalidation"""
+
+    drug_id = serializers.CharField()
+    pharmacy_id = serializers.CharField()
+    quantity = serializers.IntegerField()
+    cart_unit_price = serializers.DecimalField(max_digits=10, decimal_places=2)
+    current_unit_price = serializers.DecimalField(
+        max_digits=10, decimal_places=2, allow_null=True
+    )
+    available_quantity = serializers.IntegerField()
+    issues = serializers.ListField(child=serializers.CharField())
+
+
+class CartValidationSerializer(serializers.Serializer):
+    """Serializer for the current price/stock check of the whole cart"""
+
+    version = serializers.IntegerField()
+    valid = serializers.BooleanField()
+    total_amount = serializers.DecimalField(max_digits=10, decimal_places=2)
+    lines = CartLineValidationSerializer(many=True)
+
+
 class CartOutputSerializer(serializers.Serializer):
     """Serializer for cart output"""
 
@@ -83,6 +107,8 @@ class CartOutputSerializer(serializers.Serializer):
     total_items = serializers.IntegerField()
     total_amount = serializers.DecimalField(max_digits=10, decimal_places=2)
     prescription_code = serializers.CharField(allow_null=True)
+    version = serializers.IntegerField(required=False)
+    validation = CartValidationSerializer(required=False)
 
 
 class CartView(APIView):
@@ -98,9 +124,13 @@ class CartView(APIView):
         responses={200: CartOutputSerializer},
     )
     def get(self, request):
-        """Get all cart items for the authenticated user"""
+        """
+        Get all cart items for the authenticated user, with every line
+        rechecked against current prices and stock.
+        """
         user_id = str(request.user.id)
         cart = CartService.get_cart(user_id)
+        cart["validation"] = get_cart_validation(user_id, cart)
 
         return Response(
             CartOutputSerializer(cart).data,
@@ -0,0 +1,37 @@
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
+
+from .models import PharmacyProfile
+from .stock_service import stock_alert_group
+
+
+class StockAlertConsumer(AsyncJsonWebsocketConsumer):
+    """Pushes the connected pharmacy's stock alerts as they are recorded."""
+
+    async def connect(self):
+        user = self.scope["user"]
+        pharmacy_id = None
+        if user.is_authenticated:
+            pharmacy_id = await self.get_pharmacy_id(user)
+        if pharmacy_id is None:
+            await self.close()
+            return
+
+        self.group_name = stock_alert_group(pharmacy_id)
+        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        await self.accept()
+
+    async def disconnect(self, close_code):
+        if hasattr(self, "group_name"):
+            await self.channel_layer.group_discard(self.group_name, self.channel_name)
+
+    async def stock_alert(self, event):
+        await self.send_json({"alert": event["alert"]})
+
+    @database_sync_to_async
+    def get_pharmacy_id(self, user):
+        return (
+            PharmacyProfile.objects.filter(user=user)
+            .values_list("id", flat=True)
+            .first()
+        )
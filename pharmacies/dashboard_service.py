@@ -0,0 +1,137 @@
+"""
+Pharmacy dashboard rollups.
+
+PharmacyDailyStats keeps per pharmacy and day the counters the dashboard used
+to aggregate over orders and order items on every request. A day is
+recomputed (two small grouped queries and an upsert) whenever something that
+feeds it changes: an order is placed, paid or refunded, or a pharmacy order
+changes status. Recomputing the day instead of applying +/- deltas keeps every
+transition idempotent; the backfill task rebuilds whole ranges the same way.
+"""
+
+from collections import defaultdict
+from datetime import date as dt_date
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Count, Exists, F, OuterRef, Sum
+from django.db.models.functions import TruncDate
+
+from .models import (
+    Order,
+    OrderItem,
+    PharmacyDailyStats,
+    PharmacyOrder,
+    PharmacyProfile,
+)
+
+# Revenue of a pharmacy's items stops counting once its part of the order is
+# cancelled or refunded (mirrors the dashboard's original filter).
+NON_REVENUE_STATUSES = (PharmacyOrder.Status.CANCELLED, PharmacyOrder.Status.REFUNDED)
+
+
+def _empty_counters():
+    return {"orders_count": 0, "revenue": Decimal("0.00"), "units_sold": 0}
+
+
+def rebuild_daily_stats(
+    pharmacy_ids=None, start: dt_date = None, end: dt_date = None
+) -> int:
+    """
+    Recompute the rollups of `pharmacy_ids` (every pharmacy when None) for
+    each day in [start, end] (unbounded when None). Days in the range whose
+    activity has gone away are reset to zero. Returns the rows written.
+    """
+    pharmacy_orders = PharmacyOrder.objects.all()
+    items = OrderItem.objects.filter(
+        order__payment_status=Order.PaymentStatus.PAID
+    ).exclude(
+        Exists(
+            PharmacyOrder.objects.filter(
+                order=OuterRef("order_id"),
+                pharmacy=OuterRef("drug__pharmacy_id"),
+                status__in=NON_REVENUE_STATUSES,
+            )
+        )
+    )
+    existing = PharmacyDailyStats.objects.all()
+    if pharmacy_ids is not None:
+        pharmacy_orders = pharmacy_orders.filter(pharmacy_id__in=pharmacy_ids)
+        items = items.filter(drug__pharmacy_id__in=pharmacy_ids)
+        existing = existing.filter(pharmacy_id__in=pharmacy_ids)
+    if start:
+        pharmacy_orders = pharmacy_orders.filter(created_at__date__gte=start)
+        items = items.filter(order__created_at__date__gte=start)
+        existing = existing.filter(date__gte=start)
+    if end:
+        pharmacy_orders = pharmacy_orders.filter(created_at__date__lte=end)
+        items = items.filter(order__created_at__date__lte=end)
+        existing = existing.filter(date__lte=end)
+
+    counters = defaultdict(_empty_counters)
+    for key in existing.values_list("pharmacy_id", "date"):
+        counters[key] = _empty_counters()
+    for row in (
+        pharmacy_orders.values("pharmacy_id", day=TruncDate("created_at"))
+        .annotate(orders_count=Count("id"))
+        .order_by()
+    ):
+        counters[(row["pharmacy_id"], row["day"])]["orders_count"] = row["orders_count"]
+    for row in (
+        items.values(
+            pharmacy=F("drug__pharmacy_id"), day=TruncDate("order__created_at")
+        )
+        .annotate(revenue=Sum("total_price"), units_sold=Sum("quantity"))
+        .order_by()
+    ):
+        day = counters[(row["pharmacy"], row["day"])]
+        day["revenue"] = row["revenue"] or Decimal("0.00")
+        day["units_sold"] = row["units_sold"] or 0
+
+    rows = [
+        PharmacyDailyStats(pharmacy_id=pharmacy_id, date=day, **values)
+        for (pharmacy_id, day), values in counters.items()
+    ]
+    PharmacyDailyStats.objects.bulk_create(
+        rows,
+        batch_size=1000,
+        update_conflicts=True,
+        unique_fields=["pharmacy", "date"],
+        update_fields=["orders_count", "revenue", "units_sold", "updated_at"],
+    )
+    return len(rows)
+
+
+def refresh_daily_stats(pharmacy_ids, day: dt_date) -> int:
+    """
+    Recompute one day of the given pharmacies' rollups inside the caller's
+    transaction. The rollup rows are created if needed and locked first, so
+    two concurrent transitions on the same day serialize and the second one
+    aggregates after the first has committed.
+    """
+    pharmacy_ids = list(set(pharmacy_ids))
+    if not pharmacy_ids:
+        return 0
+
+    with transaction.atomic():
+        PharmacyDailyStats.objects.bulk_create(
+            [PharmacyDailyStats(pharmacy_id=pid, date=day) for pid in pharmacy_ids],
+            ignore_conflicts=True,
+        )
+        list(
+            PharmacyDailyStats.objects.select_for_update()
+            .filter(pharmacy_id__in=pharmacy_ids, date=day)
+            .order_by("pharmacy_id")
+            .values_list("id", flat=True)
+        )
+        return rebuild_daily_stats(pharmacy_ids, day, day)
+
+
+def daily_stats_since(pharmacy: PharmacyProfile, start: dt_date) -> dict:
+    """{date: {"orders_count", "revenue", "units_sold"}} from one indexed read."""
+    return {
+        row["date"]: row
+        for row in PharmacyDailyStats.objects.filter(
+            pharmacy=pharmacy, date__gte=start
+        ).values("date", "orders_count", "revenue", "units_sold")
+    }
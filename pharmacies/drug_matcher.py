@@ -0,0 +1,214 @@
+"""
+Prescription-to-inventory drug name matching.
+
+A DrugNameIndex is built once per pharmacy from its drug names. Every name is
+normalized (case, punctuation, dosage-form and unit words, known brand
+aliases) and indexed by whole name, by token and by character trigram, so a
+prescribed medication is resolved with a few dictionary lookups instead of a
+scan of the inventory. The built index is cached per pharmacy under a
+fingerprint of the pharmacy's drugs, so any Drug save or delete invalidates it.
+"""
+
+import re
+from collections import Counter, defaultdict
+
+from django.core.cache import cache
+from django.db.models import Count, Max
+
+from .models import Drug
+
+INDEX_CACHE_TTL = 60 * 60 * 6
+
+# Brand / alternative names mapped to the generic name drugs are stocked under.
+ALIASES = {
+    "acetaminophen": "paracetamol",
+    "panadol": "paracetamol",
+    "tylenol": "paracetamol",
+    "calpol": "paracetamol",
+    "advil": "ibuprofen",
+    "brufen": "ibuprofen",
+    "nurofen": "ibuprofen",
+    "amoxil": "amoxicillin",
+    "augmentin": "amoxicillin clavulanate",
+    "coamoxiclav": "amoxicillin clavulanate",
+    "flagyl": "metronidazole",
+    "cipro": "ciprofloxacin",
+    "ciprobay": "ciprofloxacin",
+    "coartem": "artemether lumefantrine",
+    "ventolin": "salbutamol",
+    "albuterol": "salbutamol",
+    "glucophage": "metformin",
+    "zithromax": "azithromycin",
+    "voltaren": "diclofenac",
+    "cataflam": "diclofenac",
+    "lasix": "furosemide",
+    "norvasc": "amlodipine",
+    "septrin": "cotrimoxazole",
+    "bactrim": "cotrimoxazole",
+}
+
+# Dosage forms and units carry no identity on their own.
+FORM_WORDS = {
+    "tab",
+    "tabs",
+    "tablet",
+    "tablets",
+    "cap",
+    "caps",
+    "capsule",
+    "capsules",
+    "syrup",
+    "susp",
+    "suspension",
+    "inj",
+    "injection",
+    "cream",
+    "ointment",
+    "drops",
+    "solution",
+    "mg",
+    "mcg",
+    "g",
+    "ml",
+    "iu",
+    "oral",
+}
+
+EXACT_SCORE = 1.0
+CONTAINED_SCORE = 0.8
+TRIGRAM_WEIGHT = 0.7
+MIN_TRIGRAM_SIMILARITY = 0.45
+
+_WORD = re.compile(r"[a-z]+|\d+(?:\.\d+)?")
+
+
+def normalize_name(name) -> str:
+    """Lower-cased, alias-resolved tokens of a drug name, without form/unit words."""
+    tokens = []
+    for word in _WORD.findall((name or "").lower()):
+        if word in FORM_WORDS:
+            continue
+        tokens.extend(ALIASES.get(word, word).split())
+    return " ".join(tokens)
+
+
+def _letters(normalized: str) -> str:
+    # Strengths would put the same few digit trigrams on most of the index.
+    return " ".join(token for token in normalized.split() if not token[0].isdigit())
+
+
+def trigrams(text: str) -> set:
+    padded = f"  {text} "
+    return {padded[i : i + 3] for i in range(len(padded) - 2)}
+
+
+class DrugNameIndex:
+    def __init__(self, drugs):
+        """drugs: iterable of (drug_id, name)."""
+        self.drug_ids = []
+        self.tokens = []
+        self.trigram_counts = []
+        self.exact = defaultdict(list)
+        self.by_token = defaultdict(list)
+        self.by_trigram = defaultdict(list)
+
+        for position, (drug_id, name) in enumerate(drugs):
+            normalized = normalize_name(name)
+            tokens = frozenset(normalized.split())
+            grams = trigrams(_letters(normalized))
+            self.drug_ids.append(drug_id)
+            self.tokens.append(tokens)
+            self.trigram_counts.append(len(grams))
+            self.exact[normalized].append(position)
+            for token in tokens:
+                if not token[0].isdigit():
+                    self.by_token[token].append(position)
+            for gram in grams:
+                self.by_trigram[gram].append(position)
+
+        # Plain dicts pickle smaller and can't grow on a missed lookup.
+        self.exact = dict(self.exact)
+        self.by_token = dict(self.by_token)
+        self.by_trigram = dict(self.by_trigram)
+
+    @classmethod
+    def for_pharmacy(cls, pharmacy_id):
+        return cls(
+            Drug.objects.filter(pharmacy_id=pharmacy_id)
+            .order_by("name")
+            .values_list("id", "name")
+        )
+
+    def __len__(self):
+        return len(self.drug_ids)
+
+    def match(self, medication, limit=5):
+        """Ranked [(drug_id, score), ...] for a prescribed medication name."""
+        normalized = normalize_name(medication)
+        if not normalized:
+            return []
+
+        scores = {}
+        for position in self.exact.get(normalized, ()):
+            scores[position] = EXACT_SCORE
+
+        # Candidates share at least one word; numeric tokens (strengths) aren't
+        # posted, but still have to agree for one name to contain the other.
+        query_tokens = frozenset(normalized.split())
+        candidates = set()
+        for token in query_tokens:
+            candidates.update(self.by_token.get(token, ()))
+        for position in candidates - scores.keys():
+            tokens = self.tokens[position]
+            shared = len(query_tokens & tokens)
+            if shared == len(query_tokens) or shared == len(tokens):
+                jaccard = shared / len(query_tokens | tokens)
+                scores[position] = CONTAINED_SCORE + 0.1 * jaccard
+
+        if not scores:
+            # Misspellings: rank by trigram similarity.
+            query_grams = trigrams(_letters(normalized))
+            common = Counter()
+            for gram in query_grams:
+                for position in self.by_trigram.get(gram, ()):
+                    common[position] += 1
+            for position, shared in common.items():
+                similarity = shared / (
+                    len(query_grams) + self.trigram_counts[position] - shared
+                )
+                if similarity >= MIN_TRIGRAM_SIMILARITY:
+                    scores[position] = TRIGRAM_WEIGHT * similarity
+
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+        return [
+            (self.drug_ids[position], round(score, 3))
+            for position, score in ranked[:limit]
+        ]
+
+    def match_many(self, medications, limit=5):
+        """{medication: ranked matches} for every distinct medication name."""
+        return {
+            medication: self.match(medication, limit) for medication in set(medications)
+        }
+
+
+def _index_cache_key(pharmacy_id):
+    fingerprint = Drug.objects.filter(pharmacy_id=pharmacy_id).aggregate(
+        count=Count("id"), latest=Max("updated_at")
+    )
+    latest = fingerprint["latest"].timestamp() if fingerprint["latest"] else 0
+    return f"drug-name-index:{pharmacy_id}:{fingerprint['count']}:{latest}"
+
+
+def get_drug_index(pharmacy_id) -> DrugNameIndex:
+    """
+    The pharmacy's name index, from cache when its drugs haven't changed.
+    Saving a drug bumps its updated_at and deleting one changes the count,
+    either of which moves the cache key.
+    """
+    key = _index_cache_key(pharmacy_id)
+    index = cache.get(key)
+    if index is None:
+        index = DrugNameIndex.for_pharmacy(pharmacy_id)
+        cache.set(key, index, INDEX_CACHE_TTL)
+    return index
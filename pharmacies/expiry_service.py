@@ -0,0 +1,201 @@
+"""
+Daily drug expiry alerts.
+
+One query groups the batches expiring within ALERT_WINDOW_DAYS by pharmacy,
+with each pharmacy's batches joined into a single column, and is streamed
+with `iterator()` so memory stays flat however many pharmacies there are.
+Alerts are handled CHUNK_SIZE pharmacies at a time: one query loads the
+chunk's ExpiryAlertDigest rows, the alerts whose batch list changed (or
+was last sent more than EXPIRY_ALERT_RESEND_DAYS ago) are rendered with the
+compiled body template and sent as one Celery chord, whose callback records
+the alerts that were mailed in one upsert. An unchanged alert is therefore not
+re-sent every day, and one whose mail failed is sent again the next day.
+"""
+
+import hashlib
+from dataclasses import dataclass
+from datetime import timedelta
+
+from celery import chord, group
+from django.conf import settings
+from django.db.models import CharField, Count, F, Value
+from django.db.models import StringAgg
+from django.db.models.functions import Cast, Coalesce, Concat, NullIf
+from django.utils import timezone
+from jinja2 import Environment
+
+from accounts.tasks import generic_send_mail
+from .models import DrugBatch, ExpiryAlertDigest
+
+ALERT_WINDOW_DAYS = 30
+CHUNK_SIZE = 200
+ALERT_TITLE = "⚠️ Drug Expiry Alert — Action Required"
+
+# Separators of the aggregated batch column; they can't appear in names.
+FIELD_SEPARATOR = "\x1f"
+BATCH_SEPARATOR = "\x1e"
+
+BODY_TEMPLATE = Environment(autoescape=True).from_string(
+    "<p>The following drug batches in your pharmacy are expiring within the next "
+    "{{ days }} days:</p>"
+    "<ul style='color:#333;line-height:1.8'>"
+    "{% for name, batch_number, expiry_date in batches %}"
+    "<li><strong>{{ name }}</strong> — Batch {{ batch_number }} expires on "
+    "<strong>{{ expiry_date }}</strong></li>"
+    "{% endfor %}</ul>"
+    "<p>Please take the necessary steps to manage these items (return, discount, "
+    "or dispose).</p>"
+)
+
+
+@dataclass
+class ExpiryAlert:
+    pharmacy_id: object
+    pharmacy_name: str
+    email: str
+    batch_count: int
+    batches: str
+
+    @property
+    def digest(self):
+        return hashlib.sha256(self.batches.encode()).hexdigest()
+
+    def batch_lines(self):
+        """(drug name, batch number, expiry date) of each batch, soonest first."""
+        return [
+            tuple(line.split(FIELD_SEPARATOR))
+            for line in self.batches.split(BATCH_SEPARATOR)
+        ]
+
+    def render(self):
+        return BODY_TEMPLATE.render(days=ALERT_WINDOW_DAYS, batches=self.batch_lines())
+
+
+def expiring_alerts(today=None):
+    """
+    Stream one ExpiryAlert per active pharmacy with batches expiring within
+    ALERT_WINDOW_DAYS of `today`, from a single grouped query.
+    """
+    today = today or timezone.localdate()
+    line = Concat(
+        "drug__name",
+        Value(FIELD_SEPARATOR),
+        "batch_number",
+        Value(FIELD_SEPARATOR),
+        Cast("expiry_date", CharField()),
+        output_field=CharField(),
+    )
+    rows = (
+        DrugBatch.objects.filter(
+            expiry_date__range=(today, today + timedelta(days=ALERT_WINDOW_DAYS)),
+            pharmacy__user__is_active=True,
+        )
+        .values(
+            "pharmacy_id",
+            pharmacy_name=F("pharmacy__pharmacy_name"),
+            email=Coalesce(
+                NullIf("pharmacy__email", Value("")), "pharmacy__user__email"
+            ),
+        )
+        .annotate(
+            batch_count=Count("id"),
+            batches=StringAgg(
+                line,
+                Value(BATCH_SEPARATOR),
+                order_by=("expiry_date", "drug__name", "batch_number"),
+            ),
+        )
+        .order_by("pharmacy_id")
+    )
+    for row in rows.iterator(chunk_size=CHUNK_SIZE):
+        yield ExpiryAlert(**row)
+
+
+def _due(alerts):
+    """The alerts of one chunk that differ from, or are older than, the last one sent."""
+    resend_before = timezone.now() - timedelta(days=settings.EXPIRY_ALERT_RESEND_DAYS)
+    last_sent = {
+        pharmacy_id: (digest, sent_at)
+        for pharmacy_id, digest, sent_at in ExpiryAlertDigest.objects.filter(
+            pharmacy_id__in=[alert.pharmacy_id for alert in alerts]
+        ).values_list("pharmacy_id", "digest", "sent_at")
+    }
+    due = []
+    for alert in alerts:
+        digest, sent_at = last_sent.get(alert.pharmacy_id, (None, None))
+        if digest != alert.digest or sent_at <= resend_before:
+            due.append(alert)
+    return due
+
+
+def _send(alerts):
+    from .tasks import record_expiry_alerts
+
+    chord(
+        group(
+            generic_send_mail.si(
+                recipient=alert.email,
+                title=ALERT_TITLE,
+                payload={"user_name": alert.pharmacy_name, "body": alert.render()},
+                email_type=None,
+            )
+            for alert in alerts
+        ),
+        record_expiry_alerts.s(
+            [
+                [str(alert.pharmacy_id), alert.digest, alert.batch_count]
+                for alert in alerts
+            ]
+        ),
+    ).apply_async()
+
+
+def record_sent(results, alerts) -> int:
+    """
+    Upsert the digests of the `alerts` ([pharmacy id, digest, batch count])
+    whose mail went out, given the send results in the same order;
+    generic_send_mail returns nothing when sending fails. Returns the count.
+    """
+    now = timezone.now()
+    sent = [
+        ExpiryAlertDigest(
+            pharmacy_id=pharmacy_id,
+            digest=digest,
+            batch_count=batch_count,
+            sent_at=now,
+        )
+        for result, (pharmacy_id, digest, batch_count) in zip(results, alerts)
+        if result
+    ]
+    ExpiryAlertDigest.objects.bulk_create(
+        sent,
+        update_conflicts=True,
+        unique_fields=["pharmacy"],
+        update_fields=["digest", "batch_count", "sent_at", "updated_at"],
+    )
+    return len(sent)
+
+
+def send_expiry_alerts(today=None) -> dict:
+    """Send the day's changed expiry alerts. Returns counts of pharmacies alerted and skipped."""
+    counts = {"sent": 0, "unchanged": 0, "no_email": 0}
+    chunk = []
+
+    def flush():
+        due = _due(chunk)
+        if due:
+            _send(due)
+        counts["sent"] += len(due)
+        counts["unchanged"] += len(chunk) - len(due)
+        chunk.clear()
+
+    for alert in expiring_alerts(today):
+        if not alert.email:
+            counts["no_email"] += 1
+            continue
+        chunk.append(alert)
+        if len(chunk) >= CHUNK_SIZE:
+            flush()
+    if chunk:
+        flush()
+    return counts
@@ -1,5 +1,8 @@
 import django_filters
+from rest_framework import filters
+
 from .models import Order
+from .search_service import search_drugs
 
 
 class OrderFilter(django_filters.FilterSet):
@@ -58,3 +61,20 @@ class OrderFilter(django_filters.FilterSet):
             "created_after",
             "created_before",
         ]
+
+
+class DrugSearchFilter(filters.SearchFilter):
+    """
+    ?search= over the drug search index (see search_service): prefix and
+    typo-tolerant matching, most relevant first unless ?ordering= is given.
+    Goes after OrderingFilter so its default ordering doesn't undo the ranking.
+    """
+
+    def filter_queryset(self, request, queryset, view):
+        text = request.query_params.get(self.search_param, "")
+        if not text.strip():
+            return queryset
+        ranked = search_drugs(queryset, text)
+        if filters.OrderingFilter.ordering_param in request.query_params:
+            return ranked.order_by(*queryset.query.order_by)
+        return ranked
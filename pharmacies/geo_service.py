@@ -0,0 +1,179 @@
+"""
+Location lookups for pharmacies without a spatial database extension.
+
+Every PharmacyProfile with coordinates carries an integer grid cell
+(`grid_lat`, `grid_lng`, GRID_CELL_DEGREES wide) kept in step with its
+latitude/longitude by `save()`. A radius query first narrows the table to the
+cells and the coordinate bounding box around the search circle (both plain
+indexed range filters), and only those candidates get the exact haversine
+distance, computed in SQL so results can be ordered and paginated by the
+database. k-nearest queries widen the radius ring by ring until they hold k
+results. A search with neither a radius nor k is bounded by DEFAULT_RADIUS_KM
+unless its caller passes no default radius (the nearby-pharmacies list,
+which has always returned every located pharmacy).
+"""
+
+import math
+
+from django.db.models import Case, F, FloatField, Value, When
+from django.db.models.functions import ASin, Cast, Cos, Least, Power, Radians, Sin, Sqrt
+
+EARTH_RADIUS_KM = 6371
+GRID_CELL_DEGREES = 0.1
+
+FIRST_RING_KM = 5
+DEFAULT_RADIUS_KM = 50
+MAX_SEARCH_RADIUS_KM = 500
+MAX_NEAREST = 100
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """Return distance in km between two lat/lng points."""
+    lat1, lon1, lat2, lon2 = map(
+        math.radians, [float(lat1), float(lon1), float(lat2), float(lon2)]
+    )
+    dlat, dlon = lat2 - lat1, lon2 - lon1
+    a = (
+        math.sin(dlat / 2) ** 2
+        + math.cos(lat1) * math.cos(lat2) * math.sin(dlon / 2) ** 2
+    )
+    return EARTH_RADIUS_KM * 2 * math.asin(math.sqrt(a))
+
+
+def grid_cell(lat, lng):
+    """The (grid_lat, grid_lng) cell a point falls in."""
+    return (
+        math.floor(float(lat) / GRID_CELL_DEGREES),
+        math.floor(float(lng) / GRID_CELL_DEGREES),
+    )
+
+
+def bounding_box(lat, lng, radius_km):
+    """(min_lat, max_lat, min_lng, max_lng) of the circle; longitudes may leave [-180, 180]."""
+    dlat = math.degrees(radius_km / EARTH_RADIUS_KM)
+    cos_lat = math.cos(math.radians(lat))
+    if cos_lat < 1e-9:
+        dlng = 360
+    else:
+        dlng = math.degrees(radius_km / (EARTH_RADIUS_KM * cos_lat))
+    return max(lat - dlat, -90), min(lat + dlat, 90), lng - dlng, lng + dlng
+
+
+def distance_km(lat, lng, prefix=""):
+    """SQL haversine distance (km) from (lat, lng) to the row's coordinates."""
+    lat1, lng1 = math.radians(lat), math.radians(lng)
+    lat2 = Radians(Cast(F(f"{prefix}latitude"), FloatField()))
+    lng2 = Radians(Cast(F(f"{prefix}longitude"), FloatField()))
+    a = Power(Sin((lat2 - Value(lat1)) / 2), 2) + Value(math.cos(lat1)) * Cos(
+        lat2
+    ) * Power(Sin((lng2 - Value(lng1)) / 2), 2)
+    # Rounding can push sqrt(a) a hair above 1 for antipodal points. Postgres'
+    # LEAST skips NULLs, so rows without coordinates are kept NULL explicitly.
+    return Case(
+        When(
+            **{f"{prefix}latitude__isnull": False, f"{prefix}longitude__isnull": False},
+            then=Value(2.0 * EARTH_RADIUS_KM) * ASin(Least(Sqrt(a), Value(1.0))),
+        ),
+        output_field=FloatField(),
+    )
+
+
+def _nearest_first(queryset):
+    # Ties keep the queryset's own ordering (e.g. by name).
+    return queryset.order_by(
+        F("distance_km").asc(nulls_last=True), *(queryset.query.order_by or ["pk"])
+    )
+
+
+def within_radius(queryset, lat, lng, radius_km, prefix=""):
+    """
+    Rows of `queryset` within `radius_km` of (lat, lng), annotated with
+    `distance_km`. `prefix` reaches the pharmacy through a relation, e.g.
+    "pharmacy__" for a Drug queryset.
+    """
+    min_lat, max_lat, min_lng, max_lng = bounding_box(lat, lng, radius_km)
+    (low_lat, low_lng), (high_lat, high_lng) = (
+        grid_cell(min_lat, min_lng),
+        grid_cell(max_lat, max_lng),
+    )
+    box = {
+        f"{prefix}grid_lat__range": (low_lat, high_lat),
+        f"{prefix}latitude__range": (min_lat, max_lat),
+    }
+    if min_lng >= -180 and max_lng <= 180:
+        # A box across the antimeridian is only bounded by latitude.
+        box[f"{prefix}grid_lng__range"] = (low_lng, high_lng)
+        box[f"{prefix}longitude__range"] = (min_lng, max_lng)
+    return (
+        queryset.filter(**box)
+        .annotate(distance_km=distance_km(lat, lng, prefix))
+        .filter(distance_km__lte=radius_km)
+    )
+
+
+def nearest(queryset, lat, lng, k, prefix="", max_radius_km=MAX_SEARCH_RADIUS_KM):
+    """
+    The `k` rows of `queryset` nearest to (lat, lng), closest first, with
+    `distance_km`. Searches rings of doubling radius: once a ring holds k
+    rows they are the global nearest, since anything closer lies inside it.
+    Gives up widening at `max_radius_km`.
+    """
+    radius = FIRST_RING_KM
+    while True:
+        radius = min(radius, max_radius_km)
+        rows = list(
+            _nearest_first(within_radius(queryset, lat, lng, radius, prefix))[:k]
+        )
+        if len(rows) >= k or radius >= max_radius_km:
+            return rows
+        radius *= 2
+
+
+def location_query(params):
+    """
+    (lat, lng, radius_km, k) from ?lat=&lng=&radius=&k= query params; the
+    point is None when lat/lng aren't given, radius and k when unbounded
+    (k is capped at MAX_NEAREST).
+    Raises ValueError for malformed or out-of-range values.
+    """
+    if not params.get("lat") or not params.get("lng"):
+        return None, None, None, None
+    lat, lng = float(params["lat"]), float(params["lng"])
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        raise ValueError("Coordinates out of range")
+    radius = float(params["radius"]) if params.get("radius") else None
+    k = int(params["k"]) if params.get("k") else None
+    if (radius is not None and radius <= 0) or (k is not None and k <= 0):
+        raise ValueError("radius and k must be positive")
+    return lat, lng, radius, k and min(k, MAX_NEAREST)
+
+
+def by_distance(
+    queryset,
+    lat,
+    lng,
+    radius_km=None,
+    k=None,
+    prefix="",
+    default_radius_km=DEFAULT_RADIUS_KM,
+):
+    """
+    `queryset` ordered nearest first with `distance_km`: the k nearest within
+    `radius_km` (or MAX_SEARCH_RADIUS_KM) when `k` is given, else every row
+    within `radius_km` (or `default_radius_km`; every row when that is None).
+    """
+    if k:
+        return nearest(
+            queryset,
+            lat,
+            lng,
+            k,
+            prefix,
+            max_radius_km=radius_km or MAX_SEARCH_RADIUS_KM,
+        )
+    radius_km = radius_km or default_radius_km
+    if radius_km is None:
+        return _nearest_first(
+            queryset.annotate(distance_km=distance_km(lat, lng, prefix))
+        )
+    return _nearest_first(within_radius(queryset, lat, lng, radius_km, prefix))
@@ -0,0 +1,31 @@
+"""
+Management command to run one of the benchmarks in pharmacies/benchmarks.py
+(or chat/benchmarks.py, which registers with it) against the configured
+database.
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+
+import chat.benchmarks  # noqa: F401  (registers the chat benchmarks)
+from pharmacies.benchmarks import BENCHMARKS
+
+
+class Command(BaseCommand):
+    help = "Run a pharmacy benchmark on throwaway data (never against production)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("name", choices=sorted(BENCHMARKS))
+        parser.add_argument("--workers", type=int, help="Parallel workers")
+        parser.add_argument("--iterations", type=int, help="Operations to time")
+        parser.add_argument("--size", type=int, help="Scenario size parameter")
+
+    def handle(self, *args, **options):
+        params = {
+            key: options[key]
+            for key in ("workers", "iterations", "size")
+            if options[key] is not None
+        }
+        passed = BENCHMARKS[options["name"]](self.stdout, **params)
+        if passed is False:
+            raise CommandError(f"Benchmark {options['name']} failed its checks")
+        self.stdout.write(self.style.SUCCESS(f"Benchmark {options['name']} passed"))
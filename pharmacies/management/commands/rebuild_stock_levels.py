@@ -0,0 +1,66 @@
+"""
+Management command to rebuild (or verify) the materialized stock levels
+from the StockMovement history.
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+
+from pharmacies.models import PharmacyProfile
+from pharmacies.stock_service import rebuild_stock_levels
+
+
+class Command(BaseCommand):
+    help = "Rebuild or verify per-batch and per-drug stock levels from stock movements"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--verify",
+            action="store_true",
+            help="Only report drift; do not write anything",
+        )
+        parser.add_argument(
+            "--pharmacy",
+            help="Limit to a single pharmacy (PharmacyProfile id)",
+        )
+
+    def handle(self, *args, **options):
+        pharmacies = PharmacyProfile.objects.order_by("pharmacy_name")
+        if options["pharmacy"]:
+            pharmacies = pharmacies.filter(id=options["pharmacy"])
+            if not pharmacies.exists():
+                raise CommandError(f"Pharmacy {options['pharmacy']} not found")
+
+        commit = not options["verify"]
+        total_batch_drift = 0
+        total_drug_drift = 0
+
+        for pharmacy in pharmacies.iterator():
+            report = rebuild_stock_levels(pharmacy, commit=commit)
+            batch_drift = len(report["batch_drift"])
+            drug_drift = len(report["drug_drift"])
+            total_batch_drift += batch_drift
+            total_drug_drift += drug_drift
+
+            if batch_drift or drug_drift:
+                self.stdout.write(
+                    self.style.WARNING(
+                        f"{pharmacy.pharmacy_name}: {batch_drift} batch(es) and "
+                        f"{drug_drift} drug(s) out of sync "
+                        f"({report['batches_checked']} batches checked)"
+                    )
+                )
+                for row in report["batch_drift"]:
+                    self.stdout.write(
+                        f"  batch {row['batch_id']}: expected={row['expected']} "
+                        f"actual={row['actual']}"
+                    )
+
+        action = "Found" if options["verify"] else "Repaired"
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"{action} {total_batch_drift} batch level(s) and "
+                f"{total_drug_drift} drug level(s) out of sync"
+            )
+        )
+        if options["verify"] and (total_batch_drift or total_drug_drift):
+            raise CommandError("Stock levels are out of sync with stock movements")
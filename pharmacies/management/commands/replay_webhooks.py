@@ -0,0 +1,75 @@
+"""
+Management command to replay stored Paystack webhook events.
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_datetime
+
+from pharmacies.models import CallBackData
+from pharmacies.webhook_service import replay_events
+
+
+class Command(BaseCommand):
+    help = "Replay stored Paystack webhook events (failed ones by default), in order"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--reference",
+            help="Only events for this payment or transfer reference",
+        )
+        parser.add_argument(
+            "--event",
+            help="Only events of this type, e.g. charge.success",
+        )
+        parser.add_argument(
+            "--since",
+            help="Only events received at or after this ISO datetime",
+        )
+        parser.add_argument(
+            "--status",
+            choices=CallBackData.Status.values,
+            help="Only events in this status (default: failed)",
+        )
+        parser.add_argument(
+            "--all",
+            action="store_true",
+            help="Replay matching events whatever their status",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Only list the events that would be replayed",
+        )
+
+    def handle(self, *args, **options):
+        callbacks = CallBackData.objects.filter(
+            callback_type=CallBackData.CallBackUrlType.PAYSTACK
+        )
+        if not options["all"]:
+            callbacks = callbacks.filter(
+                status=options["status"] or CallBackData.Status.FAILED
+            )
+        if options["reference"]:
+            callbacks = callbacks.filter(reference=options["reference"])
+        if options["event"]:
+            callbacks = callbacks.filter(event=options["event"])
+        if options["since"]:
+            since = parse_datetime(options["since"])
+            if since is None:
+                raise CommandError(f"Invalid --since datetime: {options['since']}")
+            callbacks = callbacks.filter(created_at__gte=since)
+
+        if options["dry_run"]:
+            for callback in callbacks.order_by("created_at"):
+                self.stdout.write(
+                    f"{callback.created_at:%Y-%m-%d %H:%M:%S} {callback.event} "
+                    f"{callback.reference} [{callback.status}, {callback.attempts} attempt(s)]"
+                )
+            self.stdout.write(self.style.SUCCESS(f"{callbacks.count()} event(s) match"))
+            return
+
+        matched = callbacks.count()
+        applied = replay_events(callbacks)
+        self.stdout.write(
+            self.style.SUCCESS(f"Replayed {matched} event(s), {applied} applied")
+        )
@@ -0,0 +1,106 @@
+# Generated by Django 6.0.4 on 2026-10-17 02:25
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Min, Sum
+from django.utils import timezone
+
+
+def backfill_stock_levels(apps, schema_editor):
+    """Seed the batch and drug stock levels from the existing movement history."""
+    DrugBatch = apps.get_model('pharmacies', 'DrugBatch')
+    StockMovement = apps.get_model('pharmacies', 'StockMovement')
+    BatchStockLevel = apps.get_model('pharmacies', 'BatchStockLevel')
+    DrugStockLevel = apps.get_model('pharmacies', 'DrugStockLevel')
+    today = timezone.localdate()
+
+    totals = dict(
+        StockMovement.objects.values('batch_id')
+        .annotate(total=Sum('quantity'))
+        .order_by()
+        .values_list('batch_id', 'total')
+    )
+    BatchStockLevel.objects.bulk_create(
+        (
+            BatchStockLevel(
+                batch_id=batch['id'],
+                drug_id=batch['drug_id'],
+                pharmacy_id=batch['pharmacy_id'],
+                expiry_date=batch['expiry_date'],
+                quantity=totals.get(batch['id']) or 0,
+            )
+            for batch in DrugBatch.objects.values(
+                'id', 'drug_id', 'pharmacy_id', 'expiry_date'
+            ).iterator()
+        ),
+        batch_size=1000,
+    )
+
+    rollups = {
+        row['drug_id']: row
+        for row in BatchStockLevel.objects.filter(expiry_date__gte=today)
+        .values('drug_id')
+        .annotate(total=Sum('quantity'), nearest=Min('expiry_date'))
+        .order_by()
+    }
+    DrugStockLevel.objects.bulk_create(
+        (
+            DrugStockLevel(
+                drug_id=row['drug_id'],
+                pharmacy_id=row['pharmacy_id'],
+                available_quantity=(rollups.get(row['drug_id']) or {}).get('total') or 0,
+                nearest_expiry=(rollups.get(row['drug_id']) or {}).get('nearest'),
+                as_of=today,
+            )
+            for row in BatchStockLevel.objects.values('drug_id', 'pharmacy_id')
+            .distinct()
+            .order_by()
+            .iterator()
+        ),
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pharmacies', '0013_settlementpayout_settlement_payout_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BatchStockLevel',
+            fields=[
+                ('batch', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stock_level', serialize=False, to='pharmacies.drugbatch')),
+                ('expiry_date', models.DateField()),
+                ('quantity', models.IntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('drug', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='batch_stock_levels', to='pharmacies.drug')),
+                ('pharmacy', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='batch_stock_levels', to='pharmacies.pharmacyprofile')),
+            ],
+            options={
+                'verbose_name': 'Batch Stock Level',
+                'verbose_name_plural': 'Batch Stock Levels',
+                'db_table': 'batch_stock_levels',
+                'indexes': [models.Index(fields=['drug', 'expiry_date'], name='batch_stock_drug_id_50bf25_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='DrugStockLevel',
+            fields=[
+                ('drug', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stock_level', serialize=False, to='pharmacies.drug')),
+                ('available_quantity', models.IntegerField(default=0)),
+                ('nearest_expiry', models.DateField(blank=True, null=True)),
+                ('as_of', models.DateField()),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('pharmacy', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='drug_stock_levels', to='pharmacies.pharmacyprofile')),
+            ],
+            options={
+                'verbose_name': 'Drug Stock Level',
+                'verbose_name_plural': 'Drug Stock Levels',
+                'db_table': 'drug_stock_levels',
+                'indexes': [models.Index(fields=['pharmacy', 'available_quantity'], name='drug_stock__pharmac_3878a7_idx'), models.Index(fields=['nearest_expiry'], name='drug_stock__nearest_4db1f4_idx')],
+            },
+        ),
+        migrations.RunPython(backfill_stock_levels, migrations.RunPython.noop),
+    ]
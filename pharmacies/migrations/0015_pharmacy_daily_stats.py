@@ -0,0 +1,92 @@
+# Generated by Django 6.0.4 on 2026-10-17 02:44
+
+import django.db.models.deletion
+import uuid
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db import migrations, models
+from django.db.models import Count, Exists, F, OuterRef, Sum
+from django.db.models.functions import TruncDate
+
+
+def backfill_daily_stats(apps, schema_editor):
+    """Seed the dashboard rollups from the existing orders."""
+    PharmacyOrder = apps.get_model('pharmacies', 'PharmacyOrder')
+    OrderItem = apps.get_model('pharmacies', 'OrderItem')
+    PharmacyDailyStats = apps.get_model('pharmacies', 'PharmacyDailyStats')
+
+    counters = defaultdict(
+        lambda: {'orders_count': 0, 'revenue': Decimal('0.00'), 'units_sold': 0}
+    )
+    for row in (
+        PharmacyOrder.objects.values('pharmacy_id', day=TruncDate('created_at'))
+        .annotate(orders_count=Count('id'))
+        .order_by()
+    ):
+        counters[(row['pharmacy_id'], row['day'])]['orders_count'] = row['orders_count']
+
+    paid_items = OrderItem.objects.filter(order__payment_status='paid').exclude(
+        Exists(
+            PharmacyOrder.objects.filter(
+                order=OuterRef('order_id'),
+                pharmacy=OuterRef('drug__pharmacy_id'),
+                status__in=['cancelled', 'refunded'],
+            )
+        )
+    )
+    for row in (
+        paid_items.values(pharmacy=F('drug__pharmacy_id'), day=TruncDate('order__created_at'))
+        .annotate(revenue=Sum('total_price'), units_sold=Sum('quantity'))
+        .order_by()
+    ):
+        counters[(row['pharmacy'], row['day'])].update(
+            revenue=row['revenue'] or Decimal('0.00'),
+            units_sold=row['units_sold'] or 0,
+        )
+
+    PharmacyDailyStats.objects.bulk_create(
+        (
+            PharmacyDailyStats(pharmacy_id=pharmacy_id, date=day, **values)
+            for (pharmacy_id, day), values in counters.items()
+        ),
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pharmacies', '0014_stock_levels'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PharmacyDailyStats',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('date', models.DateField()),
+                ('orders_count', models.PositiveIntegerField(default=0)),
+                ('revenue', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('units_sold', models.PositiveIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('pharmacy', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_stats', to='pharmacies.pharmacyprofile')),
+            ],
+            options={
+                'verbose_name': 'Pharmacy Daily Stats',
+                'verbose_name_plural': 'Pharmacy Daily Stats',
+                'db_table': 'pharmacy_daily_stats',
+                'ordering': ['-date'],
+                'unique_together': {('pharmacy', 'date')},
+            },
+        ),
+        migrations.AddIndex(
+            model_name='pharmacyorder',
+            index=models.Index(fields=['pharmacy', '-created_at'], name='pharmacy_or_pharmac_bee909_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='pharmacyorder',
+            index=models.Index(fields=['pharmacy', 'status'], name='pharmacy_or_pharmac_d18271_idx'),
+        ),
+        migrations.RunPython(backfill_daily_stats, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 6.0.4 on 2026-10-17 02:52
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0008_keyset_indexes'),
+        ('pharmacies', '0015_pharmacy_daily_stats'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['created_at', 'id'], name='orders_created_f67d2c_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='stockmovement',
+            index=models.Index(fields=['pharmacy', 'created_at'], name='stock_movem_pharmac_b6c0d8_idx'),
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 6.0.4 on 2026-10-17 02:59
+
+from django.conf import settings
+import math
+
+from django.db import migrations, models
+
+# geo_service.GRID_CELL_DEGREES when this migration was written.
+GRID_CELL_DEGREES = 0.1
+
+
+def backfill_grid_cells(apps, schema_editor):
+    PharmacyProfile = apps.get_model('pharmacies', 'PharmacyProfile')
+    pharmacies = list(
+        PharmacyProfile.objects.filter(latitude__isnull=False, longitude__isnull=False)
+    )
+    for pharmacy in pharmacies:
+        pharmacy.grid_lat = math.floor(float(pharmacy.latitude) / GRID_CELL_DEGREES)
+        pharmacy.grid_lng = math.floor(float(pharmacy.longitude) / GRID_CELL_DEGREES)
+    PharmacyProfile.objects.bulk_update(pharmacies, ['grid_lat', 'grid_lng'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pharmacies', '0016_keyset_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pharmacyprofile',
+            name='grid_lat',
+            field=models.IntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='pharmacyprofile',
+            name='grid_lng',
+            field=models.IntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='pharmacyprofile',
+            index=models.Index(fields=['grid_lat', 'grid_lng'], name='pharmacy_pr_grid_la_cc886e_idx'),
+        ),
+        migrations.RunPython(backfill_grid_cells, migrations.RunPython.noop),
+    ]
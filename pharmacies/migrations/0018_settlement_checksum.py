@@ -0,0 +1,18 @@
+# Generated by Django 6.0.4 on 2026-10-17 03:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pharmacies', '0017_pharmacy_grid_cells'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='settlement',
+            name='checksum',
+            field=models.CharField(blank=True, default='', max_length=32),
+        ),
+    ]
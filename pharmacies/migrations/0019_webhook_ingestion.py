@@ -0,0 +1,56 @@
+# Generated by Django 6.0.4 on 2026-10-17 03:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pharmacies', '0018_settlement_checksum'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='callbackdata',
+            name='attempts',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='callbackdata',
+            name='event',
+            field=models.CharField(blank=True, default='', max_length=100),
+        ),
+        migrations.AddField(
+            model_name='callbackdata',
+            name='idempotency_key',
+            field=models.CharField(blank=True, max_length=255, null=True, unique=True),
+        ),
+        migrations.AddField(
+            model_name='callbackdata',
+            name='last_error',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='callbackdata',
+            name='processed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='callbackdata',
+            name='reference',
+            field=models.CharField(blank=True, default='', max_length=100),
+        ),
+        migrations.AddField(
+            model_name='callbackdata',
+            name='status',
+            field=models.CharField(choices=[('received', 'Received'), ('processed', 'Processed'), ('failed', 'Failed')], default='processed', max_length=20),
+        ),
+        migrations.AddIndex(
+            model_name='callbackdata',
+            index=models.Index(fields=['reference', 'created_at'], name='pharmacies__referen_21d62a_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='callbackdata',
+            index=models.Index(fields=['status', 'created_at'], name='pharmacies__status_9133ab_idx'),
+        ),
+    ]
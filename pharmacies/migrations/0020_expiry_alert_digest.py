@@ -0,0 +1,29 @@
+# Generated by Django 6.0.4 on 2026-10-17 03:32
+
+import django.db.models.deletion
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pharmacies', '0019_webhook_ingestion'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExpiryAlertDigest',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('digest', models.CharField(max_length=64)),
+                ('batch_count', models.PositiveIntegerField(default=0)),
+                ('sent_at', models.DateTimeField()),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('pharmacy', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='expiry_alert_digest', to='pharmacies.pharmacyprofile')),
+            ],
+            options={
+                'db_table': 'expiry_alert_digests',
+            },
+        ),
+    ]
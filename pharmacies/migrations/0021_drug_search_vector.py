@@ -0,0 +1,40 @@
+# Generated by Django 6.0.4 on 2026-10-17 03:35
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.contrib.postgres.search import SearchVector
+from django.db import migrations
+from django.db.models import OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def index_drugs(apps, schema_editor):
+    # search_service.search_vector() when this migration was written.
+    Drug = apps.get_model('pharmacies', 'Drug')
+    DrugCategory = apps.get_model('pharmacies', 'DrugCategory')
+    category_name = DrugCategory.objects.filter(pk=OuterRef('category_id')).values('name')[:1]
+    Drug.objects.update(
+        search_vector=SearchVector('name', weight='A', config='simple')
+        + SearchVector(Coalesce(Subquery(category_name), Value('')), weight='B', config='simple')
+        + SearchVector('base_unit', weight='C', config='simple')
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pharmacies', '0020_expiry_alert_digest'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='drug',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='drug',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='drugs_search_vector_gin'),
+        ),
+        migrations.RunPython(index_drugs, migrations.RunPython.noop),
+    ]
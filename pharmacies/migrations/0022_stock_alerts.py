@@ -0,0 +1,69 @@
+# Generated by Django 6.0.4 on 2026-10-17 03:44
+
+import django.db.models.deletion
+import uuid
+from django.db import migrations, models
+from django.db.models import Case, OuterRef, Subquery, Value, When
+
+
+def backfill_stock_status(apps, schema_editor):
+    # stock_service.stock_status() when this migration was written.
+    Drug = apps.get_model('pharmacies', 'Drug')
+    DrugStockLevel = apps.get_model('pharmacies', 'DrugStockLevel')
+    threshold = Drug.objects.filter(pk=OuterRef('drug_id')).values('low_stock_threshold')[:1]
+    DrugStockLevel.objects.update(
+        stock_status=Case(
+            When(available_quantity__lte=0, then=Value('OUT_OF_STOCK')),
+            When(available_quantity__lte=Subquery(threshold), then=Value('LOW_STOCK')),
+            default=Value('IN_STOCK'),
+        )
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pharmacies', '0021_drug_search_vector'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockAlert',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('stock_status', models.CharField(choices=[('IN_STOCK', 'In stock'), ('LOW_STOCK', 'Low stock'), ('OUT_OF_STOCK', 'Out of stock')], max_length=20)),
+                ('previous_status', models.CharField(choices=[('IN_STOCK', 'In stock'), ('LOW_STOCK', 'Low stock'), ('OUT_OF_STOCK', 'Out of stock')], max_length=20)),
+                ('available_quantity', models.IntegerField()),
+                ('threshold', models.IntegerField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'db_table': 'stock_alerts',
+                'ordering': ['-created_at'],
+            },
+        ),
+        migrations.AddField(
+            model_name='drugstocklevel',
+            name='stock_status',
+            field=models.CharField(choices=[('IN_STOCK', 'In stock'), ('LOW_STOCK', 'Low stock'), ('OUT_OF_STOCK', 'Out of stock')], default='OUT_OF_STOCK', max_length=20),
+        ),
+        migrations.AddIndex(
+            model_name='drugstocklevel',
+            index=models.Index(fields=['pharmacy', 'stock_status'], name='drug_stock__pharmac_cb9ceb_idx'),
+        ),
+        migrations.AddField(
+            model_name='stockalert',
+            name='drug',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stock_alerts', to='pharmacies.drug'),
+        ),
+        migrations.AddField(
+            model_name='stockalert',
+            name='pharmacy',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stock_alerts', to='pharmacies.pharmacyprofile'),
+        ),
+        migrations.AddIndex(
+            model_name='stockalert',
+            index=models.Index(fields=['pharmacy', '-created_at'], name='stock_alert_pharmac_c41de4_idx'),
+        ),
+        migrations.RunPython(backfill_stock_status, migrations.RunPython.noop),
+    ]
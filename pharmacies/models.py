@@ -1,4 +1,7 @@
-from django.db import models
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
+from django.db import models, transaction
+from django.utils import timezone
 from accounts.models import Address, CustomUser
 from phonenumber_field.modelfields import PhoneNumberField
 import uuid
@@ -42,6 +45,9 @@ class PharmacyProfile(models.Model):
         blank=True,
         null=True,
     )
+    # Grid cell of the coordinates for location lookups (see geo_service).
+    grid_lat = models.IntegerField(blank=True, null=True, editable=False)
+    grid_lng = models.IntegerField(blank=True, null=True, editable=False)
 
     # Contact information
     phone_number = PhoneNumberField()
@@ -67,10 +73,25 @@ class PharmacyProfile(models.Model):
         db_table = "pharmacy_profiles"
         verbose_name = "Pharmacy Profile"
         verbose_name_plural = "Pharmacy Profiles"
+        indexes = [
+            models.Index(fields=["grid_lat", "grid_lng"]),
+        ]
 
     def __str__(self):
         return f"{self.user.email} - {self.pharmacy_name}"
 
+    def save(self, *args, **kwargs):
+        if self.latitude is not None and self.longitude is not None:
+            from .geo_service import grid_cell
+
+            self.grid_lat, self.grid_lng = grid_cell(self.latitude, self.longitude)
+        else:
+            self.grid_lat = self.grid_lng = None
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None and {"latitude", "longitude"} & set(update_fields):
+            kwargs["update_fields"] = {*update_fields, "grid_lat", "grid_lng"}
+        super().save(*args, **kwargs)
+
 
 class DrugCategory(models.Model):
     pharmacy = models.ForeignKey(
@@ -90,6 +111,15 @@ class DrugCategory(models.Model):
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        from .search_service import index_drugs
+
+        adding = self._state.adding
+        super().save(*args, **kwargs)
+        # The category name is part of its drugs' search index.
+        if not adding:
+            index_drugs(self.drugs.all())
+
 
 class DrugUnit(models.TextChoices):
     TABLET = "tablet", "Tablet"
@@ -135,6 +165,9 @@ class Drug(models.Model):
 
     low_stock_threshold = models.IntegerField(default=10)
 
+    # Name, category and unit for catalogue search (see search_service).
+    search_vector = SearchVectorField(null=True, blank=True, editable=False)
+
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -143,11 +176,41 @@ class Drug(models.Model):
         unique_together = ("pharmacy", "name")
         indexes = [
             models.Index(fields=["pharmacy", "name"]),
+            GinIndex(fields=["search_vector"], name="drugs_search_vector_gin"),
         ]
 
     def __str__(self):
         return self.name
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        drug = super().from_db(db, field_names, values)
+        # The stored threshold, so save() can tell whether it changed.
+        drug._saved_threshold = drug.__dict__.get("low_stock_threshold")
+        return drug
+
+    def save(self, *args, **kwargs):
+        from .search_service import index_drugs
+        from .stock_service import record_stock_crossings
+
+        update_fields = kwargs.get("update_fields")
+        threshold_changed = (
+            not self._state.adding
+            and (update_fields is None or "low_stock_threshold" in update_fields)
+            and "low_stock_threshold" in self.__dict__
+            and self.low_stock_threshold != getattr(self, "_saved_threshold", None)
+        )
+        super().save(*args, **kwargs)
+        self._saved_threshold = self.__dict__.get("low_stock_threshold")
+        # Re-index unless the save only touched fields the index doesn't hold.
+        if update_fields is None or {"name", "category", "base_unit"} & set(
+            update_fields
+        ):
+            index_drugs(Drug.objects.filter(pk=self.pk))
+        # A new threshold can put the current stock on the other side of it.
+        if threshold_changed:
+            record_stock_crossings([self.pk])
+
 
 class DrugSupplier(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
@@ -206,6 +269,14 @@ class DrugBatch(models.Model):
     def __str__(self):
         return f"{self.drug.name} - {self.batch_number}"
 
+    def save(self, *args, **kwargs):
+        from .stock_service import sync_batch_level
+
+        # Keep the batch's stock level row (and its expiry) in step with the batch.
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            sync_batch_level(self)
+
 
 class StockMovement(models.Model):
     class Reason(models.TextChoices):
@@ -251,6 +322,7 @@ class StockMovement(models.Model):
         db_table = "stock_movements"
         indexes = [
             models.Index(fields=["drug", "created_at"]),
+            models.Index(fields=["pharmacy", "created_at"]),
             models.Index(fields=["batch"]),
         ]
 
@@ -264,6 +336,160 @@ class StockMovement(models.Model):
     def __str__(self):
         return f"{self.drug.name} - {self.reason} ({self.quantity})"
 
+    def save(self, *args, **kwargs):
+        from .stock_service import apply_movements, revert_movement
+
+        # The stock ledger is updated in the same transaction as the movement,
+        # so a movement can never be committed without its balance change.
+        with transaction.atomic():
+            if not self._state.adding:
+                previous = StockMovement.objects.filter(pk=self.pk).first()
+                if previous:
+                    revert_movement(previous)
+            super().save(*args, **kwargs)
+            apply_movements([self])
+
+    def delete(self, *args, **kwargs):
+        from .stock_service import revert_movement
+
+        with transaction.atomic():
+            revert_movement(self)
+            return super().delete(*args, **kwargs)
+
+
+class BatchStockLevel(models.Model):
+    """
+    Materialized on-hand balance of a single batch: the sum of every
+    StockMovement recorded against it. Maintained by stock_service in the same
+    transaction as each movement write; `rebuild_stock_levels` recomputes it.
+    """
+
+    batch = models.OneToOneField(
+        DrugBatch,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name="stock_level",
+    )
+    pharmacy = models.ForeignKey(
+        PharmacyProfile,
+        on_delete=models.CASCADE,
+        related_name="batch_stock_levels",
+    )
+    drug = models.ForeignKey(
+        Drug,
+        on_delete=models.CASCADE,
+        related_name="batch_stock_levels",
+    )
+    # Denormalized from the batch so availability can be filtered without a join.
+    expiry_date = models.DateField()
+    quantity = models.IntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = "batch_stock_levels"
+        verbose_name = "Batch Stock Level"
+        verbose_name_plural = "Batch Stock Levels"
+        indexes = [
+            models.Index(fields=["drug", "expiry_date"]),
+        ]
+
+    def __str__(self):
+        return f"{self.batch_id} ({self.quantity})"
+
+
+class DrugStockLevel(models.Model):
+    """
+    Per-drug roll-up of the batch stock levels.
+
+    `available_quantity` is the stock held in batches that had not expired on
+    `as_of`, and `nearest_expiry` the earliest of those batches' expiry dates.
+    The roll-up therefore stays exact until `nearest_expiry` passes; after that
+    readers fall back to the batch levels (see stock_service.annotate_stock)
+    until the daily refresh task rolls it forward.
+
+    `stock_status` is `available_quantity` against the drug's
+    low_stock_threshold, updated whenever either changes; each change is
+    also recorded as a StockAlert.
+    """
+
+    class StockStatus(models.TextChoices):
+        IN_STOCK = "IN_STOCK", "In stock"
+        LOW_STOCK = "LOW_STOCK", "Low stock"
+        OUT_OF_STOCK = "OUT_OF_STOCK", "Out of stock"
+
+    drug = models.OneToOneField(
+        Drug,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name="stock_level",
+    )
+    pharmacy = models.ForeignKey(
+        PharmacyProfile,
+        on_delete=models.CASCADE,
+        related_name="drug_stock_levels",
+    )
+    available_quantity = models.IntegerField(default=0)
+    nearest_expiry = models.DateField(null=True, blank=True)
+    as_of = models.DateField()
+    stock_status = models.CharField(
+        max_length=20,
+        choices=StockStatus.choices,
+        default=StockStatus.OUT_OF_STOCK,
+    )
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = "drug_stock_levels"
+        verbose_name = "Drug Stock Level"
+        verbose_name_plural = "Drug Stock Levels"
+        indexes = [
+            models.Index(fields=["pharmacy", "available_quantity"]),
+            models.Index(fields=["nearest_expiry"]),
+            models.Index(fields=["pharmacy", "stock_status"]),
+        ]
+
+    def __str__(self):
+        return f"{self.drug_id} ({self.available_quantity})"
+
+
+class StockAlert(models.Model):
+    """
+    A drug's stock crossing its low-stock threshold (or running out, or
+    recovering), recorded when the stock level changes and pushed to the
+    pharmacy's stock alert channel (see stock_service.record_stock_crossings).
+    """
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    pharmacy = models.ForeignKey(
+        PharmacyProfile,
+        on_delete=models.CASCADE,
+        related_name="stock_alerts",
+    )
+    drug = models.ForeignKey(
+        Drug,
+        on_delete=models.CASCADE,
+        related_name="stock_alerts",
+    )
+    stock_status = models.CharField(
+        max_length=20, choices=DrugStockLevel.StockStatus.choices
+    )
+    previous_status = models.CharField(
+        max_length=20, choices=DrugStockLevel.StockStatus.choices
+    )
+    available_quantity = models.IntegerField()
+    threshold = models.IntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = "stock_alerts"
+        ordering = ["-created_at"]
+        indexes = [
+            models.Index(fields=["pharmacy", "-created_at"]),
+        ]
+
+    def __str__(self):
+        return f"{self.drug_id} {self.previous_status} -> {self.stock_status}"
+
 
 class Order(models.Model):
     """
@@ -351,17 +577,50 @@ class Order(models.Model):
         indexes = [
             models.Index(fields=["user", "status"]),
             models.Index(fields=["order_number"]),
+            models.Index(fields=["created_at", "id"]),
         ]
 
     def __str__(self):
         return f"Order {self.order_number} - {self.user.email}"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        if "payment_status" in field_names:
+            instance._loaded_payment_status = instance.payment_status
+        return instance
+
     def save(self, *args, **kwargs):
         if not self.order_number:
             from helpers.functions import generate_reference_id
 
             self.order_number = f"ORD-{generate_reference_id(8).upper()}"
-        super().save(*args, **kwargs)
+
+        # Paying (or refunding) an order moves its revenue in and out of the
+        # pharmacies' daily dashboard rollups.
+        # Settlements only count paid orders, so the order's settlement day
+        # is re-synced for the pharmacies that have delivered their part.
+        loaded = getattr(self, "_loaded_payment_status", None)
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if loaded is not None and loaded != self.payment_status:
+                from .dashboard_service import refresh_daily_stats
+
+                day = timezone.localdate(self.created_at)
+                refresh_daily_stats(
+                    self.pharmacy_orders.values_list("pharmacy_id", flat=True), day
+                )
+                if self.PaymentStatus.PAID in (loaded, self.payment_status):
+                    from .settlement_service import sync_settlements
+
+                    delivered = list(
+                        self.pharmacy_orders.filter(
+                            status=PharmacyOrder.Status.DELIVERED
+                        ).values_list("pharmacy_id", flat=True)
+                    )
+                    if delivered:
+                        sync_settlements(delivered, day)
+        self._loaded_payment_status = self.payment_status
 
 
 class PharmacyOrder(models.Model):
@@ -398,6 +657,43 @@ class PharmacyOrder(models.Model):
         db_table = "pharmacy_orders"
         verbose_name = "Pharmacy Order"
         verbose_name_plural = "Pharmacy Orders"
+        indexes = [
+            models.Index(fields=["pharmacy", "-created_at"]),
+            models.Index(fields=["pharmacy", "status"]),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        if "status" in field_names:
+            instance._loaded_status = instance.status
+        return instance
+
+    def save(self, *args, **kwargs):
+        # A new pharmacy order counts towards the day's orders, and cancelling
+        # or refunding it takes its revenue out of the dashboard rollups.
+        # Delivering it (or taking a delivery back) moves the pharmacy's share
+        # of a paid order in and out of that day's settlement.
+        loaded = getattr(self, "_loaded_status", None)
+        changed = self._state.adding or loaded != self.status
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if changed:
+                from .dashboard_service import refresh_daily_stats
+
+                # Orders are counted on this row's day, revenue on the order's.
+                order_day = timezone.localdate(self.order.created_at)
+                days = {timezone.localdate(self.created_at), order_day}
+                for day in sorted(days):
+                    refresh_daily_stats([self.pharmacy_id], day)
+                if (
+                    self.Status.DELIVERED in (loaded, self.status)
+                    and self.order.payment_status == Order.PaymentStatus.PAID
+                ):
+                    from .settlement_service import sync_settlements
+
+                    sync_settlements([self.pharmacy_id], order_day)
+        self._loaded_status = self.status
 
 
 class OrderItem(models.Model):
@@ -445,6 +741,63 @@ class OrderItem(models.Model):
         super().save(*args, **kwargs)
 
 
+class PharmacyDailyStats(models.Model):
+    """
+    Per-pharmacy, per-day dashboard counters: pharmacy orders placed, and the
+    revenue and units of paid, non-cancelled/refunded order items. Refreshed
+    for the affected day whenever an order is placed, paid or refunded, or a
+    pharmacy order changes status (see dashboard_service), and rebuilt by the
+    `backfill_dashboard_rollups` task.
+    """
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    pharmacy = models.ForeignKey(
+        PharmacyProfile,
+        on_delete=models.CASCADE,
+        related_name="daily_stats",
+    )
+    date = models.DateField()
+    orders_count = models.PositiveIntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    units_sold = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = "pharmacy_daily_stats"
+        verbose_name = "Pharmacy Daily Stats"
+        verbose_name_plural = "Pharmacy Daily Stats"
+        ordering = ["-date"]
+        unique_together = ("pharmacy", "date")
+
+    def __str__(self):
+        return f"{self.pharmacy_id} {self.date}"
+
+
+class ExpiryAlertDigest(models.Model):
+    """
+    The last expiry alert emailed to a pharmacy: a digest of the batches it
+    listed, so the daily run only re-sends when the list has changed (or the
+    resend interval has passed). See expiry_service.
+    """
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    pharmacy = models.OneToOneField(
+        PharmacyProfile,
+        on_delete=models.CASCADE,
+        related_name="expiry_alert_digest",
+    )
+    digest = models.CharField(max_length=64)
+    batch_count = models.PositiveIntegerField(default=0)
+    sent_at = models.DateTimeField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = "expiry_alert_digests"
+
+    def __str__(self):
+        return f"{self.pharmacy_id} {self.sent_at}"
+
+
 class Payment(models.Model):
     class Status(models.TextChoices):
         INITIATED = "INITIATED"
@@ -572,6 +925,11 @@ class CallBackData(models.Model):
         MOOLRE = "moolre"
         PAYSTACK = "paystack"
 
+    class Status(models.TextChoices):
+        RECEIVED = "received", "Received"
+        PROCESSED = "processed", "Processed"
+        FAILED = "failed", "Failed"
+
     callback_type = models.CharField(
         choices=CallBackUrlType.choices,
         max_length=20,
@@ -584,11 +942,31 @@ class CallBackData(models.Model):
         default=uuid.uuid4,
     )
     data = models.JSONField(null=True)
+    # Webhook events are stored before they are processed (see
+    # webhook_service); a redelivered event maps to the same idempotency key
+    # and is not stored or processed twice.
+    event = models.CharField(max_length=100, blank=True, default="")
+    reference = models.CharField(max_length=100, blank=True, default="")
+    idempotency_key = models.CharField(
+        max_length=255, null=True, blank=True, unique=True
+    )
+    status = models.CharField(
+        max_length=20,
+        choices=Status.choices,
+        default=Status.PROCESSED,
+    )
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True, default="")
+    processed_at = models.DateTimeField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
         ordering = ("-created_at",)
+        indexes = [
+            models.Index(fields=["reference", "created_at"]),
+            models.Index(fields=["status", "created_at"]),
+        ]
 
     def __str__(self):
         return str(self.uuid)
@@ -607,6 +985,10 @@ class Settlement(models.Model):
     )
     settlement_date = models.DateField()
     total_amount = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    # MD5 of the settled order items behind this settlement as of its last
+    # sync (see settlement_service.settlement_checksums); a mismatch with the
+    # live items means the settlement has drifted.
+    checksum = models.CharField(max_length=32, blank=True, default="")
     status = models.CharField(
         max_length=20,
         choices=Status.choices,
@@ -276,16 +276,48 @@ def mark_payout_failed(
     return locked
 
 
+FINAL_PAYOUT_STATUSES = (
+    SettlementPayout.Status.SUCCESS,
+    SettlementPayout.Status.FAILED,
+    SettlementPayout.Status.REVERSED,
+)
+
+
 def reconcile_payout(payout: SettlementPayout) -> SettlementPayout:
     """Fallback reconciliation via the verify-transfer API (e.g. missed webhook)."""
-    if payout.status in (
-        SettlementPayout.Status.SUCCESS,
-        SettlementPayout.Status.FAILED,
-        SettlementPayout.Status.REVERSED,
-    ):
+    if payout.status in FINAL_PAYOUT_STATUSES:
         return payout
 
     success, data = PayStack().verify_transfer(payout.reference)
+    return _apply_verified_transfer(payout, success, data)
+
+
+def reconcile_payouts(payouts, max_workers=None) -> list:
+    """
+    reconcile_payout for many payouts: the transfers are verified with
+    Paystack concurrently (at most `max_workers` calls in flight), then the
+    results are applied one by one on this thread's database connection.
+    """
+    payouts = [
+        payout for payout in payouts if payout.status not in FINAL_PAYOUT_STATUSES
+    ]
+    if not payouts:
+        return []
+    verified = PayStack().verify_transfers(
+        [payout.reference for payout in payouts], max_workers=max_workers
+    )
+    reconciled = []
+    for payout in payouts:
+        try:
+            reconciled.append(
+                _apply_verified_transfer(payout, *verified[payout.reference])
+            )
+        except Exception as exc:
+            logger.error(f"Failed to reconcile payout {payout.id}: {exc}")
+    return reconciled
+
+
+def _apply_verified_transfer(payout, success, data) -> SettlementPayout:
     if not success:
         return payout
 
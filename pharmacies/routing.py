@@ -0,0 +1,10 @@
+from django.urls import path
+from . import consumers
+
+websocket_urlpatterns = [
+    path(
+        "ws/pharmacies/stock-alerts/",
+        consumers.StockAlertConsumer.as_asgi(),
+        name="stock-alert-consumer",
+    ),
+]
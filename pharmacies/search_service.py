@@ -0,0 +1,169 @@
+"""
+Drug catalogue search.
+
+Every Drug carries a `search_vector` (Postgres tsvector, GIN-indexed) of its
+name, category and unit, weighted in that order and kept up to date by
+`Drug.save()` and `DrugCategory.save()`; `index_drugs` rebuilds it in bulk.
+A search is one indexed tsquery in which every word of the query is a
+prefix, so "amox 500" finds "Amoxicillin 500mg", and brand names also match
+the generic name they are stocked under (see drug_matcher.ALIASES). Rows are
+ranked with ts_rank, exact name matches first.
+
+Typos are handled without a trigram extension: when the prefix query finds
+nothing, the words that aren't a prefix of anything in the catalogue are
+replaced by their closest catalogue words, found in a trigram index of the
+catalogue's vocabulary that is built in process and cached for
+VOCABULARY_CACHE_TTL. A new drug is found by prefix straight away, and by a
+misspelling of its name once the cached vocabulary has expired; checking a
+fingerprint of the whole catalogue on every search would cost more than the
+search itself.
+"""
+
+import bisect
+import re
+from collections import Counter, defaultdict
+
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector
+from django.core.cache import cache
+from django.db.models import Case, F, FloatField, OuterRef, Subquery, Value, When
+from django.db.models.functions import Coalesce
+
+from .drug_matcher import ALIASES, trigrams
+from .models import Drug, DrugCategory
+
+CONFIG = "simple"
+MAX_TERMS = 8
+MAX_CORRECTIONS = 3
+MIN_TERM_SIMILARITY = 0.4
+EXACT_NAME_BOOST = 1.0
+VOCABULARY_CACHE_TTL = 60 * 10
+VOCABULARY_CACHE_KEY = "drug-search-vocabulary"
+
+_WORD = re.compile(r"[^\W_]+")
+
+
+def search_vector():
+    """The tsvector expression `Drug.search_vector` holds: name, category, unit."""
+    category_name = DrugCategory.objects.filter(pk=OuterRef("category_id")).values(
+        "name"
+    )[:1]
+    return (
+        SearchVector("name", weight="A", config=CONFIG)
+        + SearchVector(
+            Coalesce(Subquery(category_name), Value("")), weight="B", config=CONFIG
+        )
+        + SearchVector("base_unit", weight="C", config=CONFIG)
+    )
+
+
+def index_drugs(queryset) -> int:
+    """Recompute `search_vector` for every drug in `queryset` in one UPDATE."""
+    return queryset.update(search_vector=search_vector())
+
+
+def search_terms(text) -> list:
+    """Lower-cased words of a search query, at most MAX_TERMS of them."""
+    return _WORD.findall((text or "").lower())[:MAX_TERMS]
+
+
+class Vocabulary:
+    """Sorted distinct words (not numbers) of drug names, with a trigram index."""
+
+    def __init__(self, names):
+        words = {word for name in names for word in search_terms(name)}
+        self.words = sorted(
+            {word for word in words if not word[0].isdigit()} | ALIASES.keys()
+        )
+        self.by_trigram = defaultdict(list)
+        for position, word in enumerate(self.words):
+            for gram in trigrams(word):
+                self.by_trigram[gram].append(position)
+        self.by_trigram = dict(self.by_trigram)
+
+    def has_prefix(self, term) -> bool:
+        position = bisect.bisect_left(self.words, term)
+        return position < len(self.words) and self.words[position].startswith(term)
+
+    def corrections(self, term, limit=MAX_CORRECTIONS) -> list:
+        """The catalogue words most similar to `term`, most similar first."""
+        grams = trigrams(term)
+        common = Counter()
+        for gram in grams:
+            for position in self.by_trigram.get(gram, ()):
+                common[position] += 1
+        scored = []
+        for position, shared in common.items():
+            word_grams = len(trigrams(self.words[position]))
+            similarity = shared / (len(grams) + word_grams - shared)
+            if similarity >= MIN_TERM_SIMILARITY:
+                scored.append((-similarity, self.words[position]))
+        return [word for _, word in sorted(scored)[:limit]]
+
+
+def get_vocabulary() -> Vocabulary:
+    """The catalogue vocabulary, rebuilt at most every VOCABULARY_CACHE_TTL."""
+    vocabulary = cache.get(VOCABULARY_CACHE_KEY)
+    if vocabulary is None:
+        vocabulary = Vocabulary(Drug.objects.values_list("name", flat=True).distinct())
+        cache.set(VOCABULARY_CACHE_KEY, vocabulary, VOCABULARY_CACHE_TTL)
+    return vocabulary
+
+
+def _alternatives(term) -> list:
+    """tsquery alternatives for one query word: itself and its generic name, as prefixes."""
+    alternatives = [f"{term}:*"]
+    if term in ALIASES:
+        alternatives.append(" & ".join(f"{word}:*" for word in ALIASES[term].split()))
+    return alternatives
+
+
+def _tsquery(groups) -> SearchQuery:
+    """AND of ORs: each group lists the alternatives for one query word."""
+    raw = " & ".join(
+        "(" + " | ".join(f"({alternative})" for alternative in group) + ")"
+        for group in groups
+    )
+    return SearchQuery(raw, search_type="raw", config=CONFIG)
+
+
+def _matching(queryset, query, text):
+    return (
+        queryset.filter(search_vector=query)
+        .annotate(
+            relevance=SearchRank(F("search_vector"), query)
+            + Case(
+                When(name__iexact=text.strip(), then=Value(EXACT_NAME_BOOST)),
+                default=Value(0.0),
+                output_field=FloatField(),
+            )
+        )
+        .order_by("-relevance", "name")
+    )
+
+
+def search_drugs(queryset, text):
+    """
+    Drugs of `queryset` matching the search `text`, annotated with
+    `relevance` and ordered most relevant first. Falls back to typo-corrected
+    words when the words as typed match nothing.
+    """
+    terms = search_terms(text)
+    if not terms:
+        return queryset
+    matches = _matching(queryset, _tsquery(_alternatives(term) for term in terms), text)
+    if matches.exists():
+        return matches
+
+    vocabulary = get_vocabulary()
+    groups = []
+    for term in terms:
+        if vocabulary.has_prefix(term) or term[0].isdigit():
+            groups.append(_alternatives(term))
+            continue
+        corrected = vocabulary.corrections(term)
+        if not corrected:
+            return matches
+        groups.append(
+            [alternative for word in corrected for alternative in _alternatives(word)]
+        )
+    return _matching(queryset, _tsquery(groups), text)
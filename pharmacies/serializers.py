@@ -5,6 +5,7 @@ from .models import (
     DrugBatch,
     DrugSupplier,
     DrugCategory,
+    StockAlert,
     StockMovement,
     Order,
     OrderItem,
@@ -16,7 +17,8 @@ from .models import (
 )
 from accounts.serializers import UserSerializer
 from django.utils import timezone
-from django.db.models import Sum, Q
+from .batch_allocation import OUTFLOW_REASONS
+from .stock_service import annotate_stock
 from helpers import exceptions
 
 
@@ -64,17 +66,15 @@ class PharmacyProfileSerializer(serializers.ModelSerializer):
         least one drug with positive, non-expired stock. Delivery settings
         control whether nearby customers see those drugs as deliverable.
         """
-        today = timezone.now().date()
-        has_stock = (
-            obj.drugs.annotate(
-                available_quantity=Sum(
-                    "movements__quantity",
-                    filter=Q(movements__batch__expiry_date__gte=today),
-                )
+        has_stock = getattr(obj, "has_stock", None)
+        if has_stock is None:
+            # Not annotated by stock_service.annotate_has_stock
+            today = timezone.now().date()
+            has_stock = (
+                annotate_stock(obj.drugs.all(), today)
+                .filter(available_quantity__gt=0)
+                .exists()
             )
-            .filter(available_quantity__gt=0)
-            .exists()
-        )
         has_location = obj.latitude is not None and obj.longitude is not None
 
         requirements = [
@@ -131,6 +131,18 @@ class PharmacyProfileSerializer(serializers.ModelSerializer):
         }
 
 
+class NearbyPharmacySerializer(PharmacyProfileSerializer):
+    """
+    Pharmacy profile with its distance from the searched point (annotated by
+    geo_service; None when the pharmacy has no coordinates).
+    """
+
+    distance_km = serializers.FloatField(read_only=True, allow_null=True)
+
+    class Meta(PharmacyProfileSerializer.Meta):
+        fields = PharmacyProfileSerializer.Meta.fields + ("distance_km",)
+
+
 class ShortPharmacyProfileSerializer(serializers.ModelSerializer):
     """
     Pharmacy profile serializer
@@ -233,27 +245,11 @@ class DrugStockHistorySerializer(serializers.ModelSerializer):
     Drug stock history serializer
     """
 
-    previsous_quantity = serializers.SerializerMethodField()
-
-    def get_previsous_quantity(self, obj):
-        """
-        Get the quantity from the previous StockMovement record (created before this one).
-        Returns None if this is the first movement for the drug.
-        """
-        # Get the previous StockMovement for the same drug and pharmacy, ordered by creation time
-        previous_movement = (
-            StockMovement.objects.filter(
-                drug=obj.drug,
-                pharmacy=obj.pharmacy,
-                created_at__lt=obj.created_at,
-            )
-            .order_by("-created_at")
-            .first()
-        )
-
-        if previous_movement:
-            return previous_movement.quantity
-        return None
+    # Annotated by stock_service.movement_history.
+    previsous_quantity = serializers.IntegerField(
+        source="previous_quantity", read_only=True, allow_null=True
+    )
+    balance = serializers.IntegerField(read_only=True)
 
     class Meta:
         model = StockMovement
@@ -263,6 +259,7 @@ class DrugStockHistorySerializer(serializers.ModelSerializer):
             "batch",
             "quantity",
             "previsous_quantity",
+            "balance",
             "reason",
             "note",
             "created_at",
@@ -270,6 +267,28 @@ class DrugStockHistorySerializer(serializers.ModelSerializer):
         read_only_fields = ("id", "created_at")
 
 
+class StockAlertSerializer(serializers.ModelSerializer):
+    """
+    Stock alert serializer
+    """
+
+    drug_name = serializers.CharField(source="drug.name", read_only=True)
+
+    class Meta:
+        model = StockAlert
+        fields = (
+            "id",
+            "drug",
+            "drug_name",
+            "stock_status",
+            "previous_status",
+            "available_quantity",
+            "threshold",
+            "created_at",
+        )
+        read_only_fields = fields
+
+
 class GetPrescriptionSerializer(serializers.Serializer):
     """
     Get prescription serializer
@@ -444,6 +463,29 @@ class StockMovementSerializer(serializers.ModelSerializer):
 
 
 class StockMovementCreateSerializer(serializers.ModelSerializer):
+    # Without a batch, stock-outs are split FEFO across batches and returns are
+    # booked onto the latest-expiring batch (see batch_allocation).
+    batch = serializers.PrimaryKeyRelatedField(
+        queryset=DrugBatch.objects.all(), required=False
+    )
+
+    def validate(self, attrs):
+        if attrs.get("batch") is None:
+            reason = attrs.get("reason")
+            if reason == StockMovement.Reason.RESTOCK:
+                raise serializers.ValidationError(
+                    {"batch": "A batch is required to restock."}
+                )
+            if reason in OUTFLOW_REASONS and attrs["quantity"] >= 0:
+                raise serializers.ValidationError(
+                    {"quantity": "Stock-out quantities must be negative."}
+                )
+            if reason not in OUTFLOW_REASONS and attrs["quantity"] <= 0:
+                raise serializers.ValidationError(
+                    {"quantity": "Return quantities must be positive."}
+                )
+        return attrs
+
     def to_representation(self, instance):
         return StockMovementSerializer(instance).data
 
@@ -496,13 +538,9 @@ class VerifyPaymentSerializer(serializers.Serializer):
 
 
 class PlaceOrderItemSerializer(serializers.Serializer):
+    # Drug existence and stock are checked in bulk by order_service.place_order.
     drug = serializers.UUIDField()
-    quantity = serializers.IntegerField()
-
-    def validate_drug(self, value):
-        if not Drug.objects.filter(id=value):
-            raise exceptions.GeneralException(detail="One or more drug does not exist")
-        return value
+    quantity = serializers.IntegerField(min_value=1)
 
 
 class PlaceOrderSerializer(serializers.Serializer):
@@ -545,10 +583,8 @@ class SettlementOrderSerializer(serializers.ModelSerializer):
 
 
 class SettlementListSerializer(serializers.ModelSerializer):
-    order_count = serializers.SerializerMethodField()
-
-    def get_order_count(self, obj):
-        return obj.settlement_orders.count()
+    # Annotated by settlement_service.annotate_settlements.
+    order_count = serializers.IntegerField(read_only=True)
 
     class Meta:
         model = Settlement
@@ -565,12 +601,11 @@ class SettlementListSerializer(serializers.ModelSerializer):
 
 
 class SettlementDetailSerializer(serializers.ModelSerializer):
-    order_count = serializers.SerializerMethodField()
+    # Annotated by settlement_service.annotate_settlements; orders are read
+    # through settlement_service.settlement_orders_prefetch.
+    order_count = serializers.IntegerField(read_only=True)
     orders = SettlementOrderSerializer(source="settlement_orders", many=True)
 
-    def get_order_count(self, obj):
-        return obj.settlement_orders.count()
-
     class Meta:
         model = Settlement
         fields = (
@@ -1,6 +1,47 @@
+"""
+Settlement sync.
+
+A pharmacy is owed, per order day, the value of its items in orders that are
+paid and whose pharmacy order is DELIVERED. `sync_settlements` computes those
+target (pharmacy, settlement_date, order, amount) rows for any set of
+pharmacies and days in one aggregate query, diffs them against the stored
+SettlementOrder rows and applies the difference in bulk: the query count does
+not depend on how many orders or pharmacies are synced.
+
+Each settlement also stores a checksum of the order items behind it. The
+checksums are computed by the database, grouped per settlement, so the
+nightly reconciliation can compare them without fetching or re-summing order
+rows, and it only re-syncs the days that have drifted. Order state changes
+sync their own day as they happen (see Order.save and PharmacyOrder.save).
+
+Paid settlements are immutable snapshots, and settlements locked into an
+in-flight payout must not change mid-transfer; both are left untouched. The
+settlements that may change are locked for the duration of the sync, the same
+rows `payout_service.create_payout` locks, so a payout can't pick up a
+settlement halfway through being rewritten.
+"""
+
+from collections import defaultdict
 from datetime import date as dt_date
 from decimal import Decimal
-from django.db.models import Sum, Count
+
+from django.db import transaction
+from django.db.models import (
+    CharField,
+    Count,
+    Exists,
+    F,
+    Min,
+    Max,
+    OuterRef,
+    Prefetch,
+    Q,
+    StringAgg,
+    Sum,
+    Value,
+)
+from django.db.models.functions import MD5, Cast, Concat, TruncDate
+from django.utils import timezone
 
 from .models import (
     PharmacyProfile,
@@ -11,126 +52,267 @@ from .models import (
     SettlementOrder,
 )
 
+BATCH_SIZE = 1000
 
-def sync_settlements_for_pharmacy(pharmacy: PharmacyProfile):
-    # Only fulfilled orders are eligible: the pharmacy's portion (PharmacyOrder)
-    # must be DELIVERED (delivered or picked up) AND the order must be paid.
-    fulfilled_order_ids = PharmacyOrder.objects.filter(
-        pharmacy=pharmacy,
-        status=PharmacyOrder.Status.DELIVERED,
-    ).values_list("order_id", flat=True)
-
-    rows = (
-        OrderItem.objects.filter(
-            drug__pharmacy=pharmacy,
-            order__payment_status=Order.PaymentStatus.PAID,
-            order_id__in=fulfilled_order_ids,
+
+def _settled_items(
+    pharmacy_ids=None, settlement_date: dt_date = None, since: dt_date = None
+):
+    """Order items whose value is owed to their pharmacy."""
+    items = OrderItem.objects.filter(
+        order__payment_status=Order.PaymentStatus.PAID,
+    ).filter(
+        Exists(
+            PharmacyOrder.objects.filter(
+                order=OuterRef("order_id"),
+                pharmacy=OuterRef("drug__pharmacy_id"),
+                status=PharmacyOrder.Status.DELIVERED,
+            )
+        )
+    )
+    if pharmacy_ids is not None:
+        items = items.filter(drug__pharmacy_id__in=pharmacy_ids)
+    if settlement_date:
+        items = items.filter(order__created_at__date=settlement_date)
+    if since:
+        items = items.filter(order__created_at__date__gte=since)
+    return items
+
+
+def _target_rows(pharmacy_ids=None, settlement_date: dt_date = None) -> dict:
+    """{(pharmacy_id, settlement_date): {order_id: amount}} of settled orders."""
+    target = defaultdict(dict)
+    for row in (
+        _settled_items(pharmacy_ids, settlement_date)
+        .values(
+            "order_id",
+            pharmacy=F("drug__pharmacy_id"),
+            day=TruncDate("order__created_at"),
         )
-        .values("order_id", "order__created_at__date")
         .annotate(amount=Sum("total_price"))
         .order_by()
+    ):
+        target[(row["pharmacy"], row["day"])][row["order_id"]] = row[
+            "amount"
+        ] or Decimal("0.00")
+    return target
+
+
+def settlement_checksums(
+    pharmacy_ids=None, settlement_date: dt_date = None, since: dt_date = None
+) -> dict:
+    """
+    {(pharmacy_id, settlement_date): checksum} of the settled order items,
+    an MD5 over each item's id, order and price computed in one grouped query.
+    """
+    line = Concat(
+        Cast("id", CharField()),
+        Value(":"),
+        Cast("order_id", CharField()),
+        Value(":"),
+        Cast("total_price", CharField()),
+        output_field=CharField(),
     )
+    return {
+        (row["pharmacy"], row["day"]): row["checksum"]
+        for row in _settled_items(pharmacy_ids, settlement_date, since)
+        .values(pharmacy=F("drug__pharmacy_id"), day=TruncDate("order__created_at"))
+        .annotate(checksum=MD5(StringAgg(line, Value(","), order_by="id")))
+        .order_by()
+    }
+
+
+def sync_settlements(pharmacy_ids=None, settlement_date: dt_date = None) -> dict:
+    """
+    Bring the settlements of `pharmacy_ids` (every pharmacy when None) in line
+    with their settled orders, for one `settlement_date` or every day.
+    Returns counts of what changed.
+    """
+    settlements = Settlement.objects.all()
+    if pharmacy_ids is not None:
+        settlements = settlements.filter(pharmacy_id__in=pharmacy_ids)
+    if settlement_date:
+        settlements = settlements.filter(settlement_date=settlement_date)
 
-    grouped_by_date = {}
-    for row in rows:
-        settlement_date = row["order__created_at__date"]
-        grouped_by_date.setdefault(settlement_date, []).append(row)
+    with transaction.atomic():
+        target = _target_rows(pharmacy_ids, settlement_date)
+        checksums = settlement_checksums(pharmacy_ids, settlement_date)
 
-    for settlement_date, date_rows in grouped_by_date.items():
-        settlement, _ = Settlement.objects.get_or_create(
-            pharmacy=pharmacy,
-            settlement_date=settlement_date,
-            defaults={"status": Settlement.Status.PENDING},
+        existing_keys = set(settlements.values_list("pharmacy_id", "settlement_date"))
+        missing = [
+            Settlement(pharmacy_id=pharmacy_id, settlement_date=day)
+            for pharmacy_id, day in target.keys() - existing_keys
+        ]
+        Settlement.objects.bulk_create(
+            missing, batch_size=BATCH_SIZE, ignore_conflicts=True
         )
 
-        # Paid settlements are immutable snapshots; settlements locked into an
-        # in-flight payout must not change mid-transfer.
-        if settlement.status == Settlement.Status.PAID or settlement.payout_id:
-            continue
-
-        current_order_ids = set()
-        for row in date_rows:
-            current_order_ids.add(row["order_id"])
-            SettlementOrder.objects.update_or_create(
-                settlement=settlement,
-                order_id=row["order_id"],
-                defaults={"amount": row["amount"] or Decimal("0.00")},
+        mutable = {
+            (settlement.pharmacy_id, settlement.settlement_date): settlement
+            for settlement in settlements.select_for_update()
+            .filter(status=Settlement.Status.PENDING, payout__isnull=True)
+            .order_by("pk")
+            .only("id", "pharmacy_id", "settlement_date", "total_amount", "checksum")
+        }
+        stored = defaultdict(dict)
+        for row in SettlementOrder.objects.filter(
+            settlement_id__in=[settlement.pk for settlement in mutable.values()]
+        ).values("id", "settlement_id", "order_id", "amount"):
+            stored[row["settlement_id"]][row["order_id"]] = row
+
+        to_create, to_update, to_delete = [], [], []
+        changed, emptied = [], []
+        now = timezone.now()
+        for key, settlement in mutable.items():
+            orders = target.get(key, {})
+            current = stored[settlement.pk]
+            for order_id, amount in orders.items():
+                row = current.get(order_id)
+                if row is None:
+                    to_create.append(
+                        SettlementOrder(
+                            settlement_id=settlement.pk,
+                            order_id=order_id,
+                            amount=amount,
+                        )
+                    )
+                elif row["amount"] != amount:
+                    to_update.append(SettlementOrder(id=row["id"], amount=amount))
+            to_delete.extend(
+                row["id"] for order_id, row in current.items() if order_id not in orders
             )
 
-        settlement.settlement_orders.exclude(order_id__in=current_order_ids).delete()
+            if not orders:
+                emptied.append(settlement.pk)
+                continue
+            total_amount = sum(orders.values(), Decimal("0.00"))
+            checksum = checksums.get(key, "")
+            if (total_amount, checksum) != (
+                settlement.total_amount,
+                settlement.checksum,
+            ):
+                settlement.total_amount = total_amount
+                settlement.checksum = checksum
+                settlement.updated_at = now
+                changed.append(settlement)
 
-        total_amount = settlement.settlement_orders.aggregate(total=Sum("amount"))[
-            "total"
-        ] or Decimal("0.00")
-        settlement.total_amount = total_amount
-        settlement.save(update_fields=["total_amount", "updated_at"])
-
-    # Remove empty pending settlements that aren't locked into a payout.
-    (
-        Settlement.objects.filter(
-            pharmacy=pharmacy,
-            status=Settlement.Status.PENDING,
-            payout__isnull=True,
+        SettlementOrder.objects.bulk_create(to_create, batch_size=BATCH_SIZE)
+        SettlementOrder.objects.bulk_update(
+            to_update, ["amount"], batch_size=BATCH_SIZE
         )
-        .annotate(order_count=Count("settlement_orders"))
-        .filter(order_count=0)
-        .delete()
-    )
+        for start in range(0, len(to_delete), BATCH_SIZE):
+            SettlementOrder.objects.filter(
+                id__in=to_delete[start : start + BATCH_SIZE]
+            ).delete()
+        Settlement.objects.bulk_update(
+            changed, ["total_amount", "checksum", "updated_at"], batch_size=BATCH_SIZE
+        )
+        # Pending settlements left without orders (and not in a payout) go away.
+        Settlement.objects.filter(id__in=emptied).delete()
+
+    return {
+        "settlements_created": len(missing),
+        "settlements_updated": len(changed),
+        "settlements_deleted": len(emptied),
+        "orders_created": len(to_create),
+        "orders_updated": len(to_update),
+        "orders_deleted": len(to_delete),
+    }
+
+
+def sync_settlements_for_pharmacy(pharmacy: PharmacyProfile):
+    return sync_settlements([pharmacy.pk])
 
 
 def sync_settlement_for_pharmacy_date(
     pharmacy: PharmacyProfile, settlement_date: dt_date
 ):
-    fulfilled_order_ids = PharmacyOrder.objects.filter(
-        pharmacy=pharmacy,
-        status=PharmacyOrder.Status.DELIVERED,
-    ).values_list("order_id", flat=True)
-
-    rows = (
-        OrderItem.objects.filter(
-            drug__pharmacy=pharmacy,
-            order__payment_status=Order.PaymentStatus.PAID,
-            order__created_at__date=settlement_date,
-            order_id__in=fulfilled_order_ids,
-        )
-        .values("order_id")
-        .annotate(amount=Sum("total_price"))
-        .order_by()
-    )
+    sync_settlements([pharmacy.pk], settlement_date)
+    return Settlement.objects.filter(
+        pharmacy=pharmacy, settlement_date=settlement_date
+    ).first()
 
-    settlement, _ = Settlement.objects.get_or_create(
-        pharmacy=pharmacy,
-        settlement_date=settlement_date,
-        defaults={"status": Settlement.Status.PENDING},
-    )
 
-    # Paid settlements are immutable; payout-locked settlements must not change.
-    if settlement.status == Settlement.Status.PAID or settlement.payout_id:
-        return settlement
-
-    current_order_ids = set()
-    for row in rows:
-        current_order_ids.add(row["order_id"])
-        SettlementOrder.objects.update_or_create(
-            settlement=settlement,
-            order_id=row["order_id"],
-            defaults={"amount": row["amount"] or Decimal("0.00")},
-        )
+def sync_settlements_for_all_pharmacies():
+    return sync_settlements()
 
-    settlement.settlement_orders.exclude(order_id__in=current_order_ids).delete()
 
-    if not current_order_ids:
-        settlement.delete()
-        return None
+def find_drifted_settlements(pharmacy_ids=None, since: dt_date = None) -> set:
+    """
+    (pharmacy_id, settlement_date) keys whose stored checksum no longer
+    matches their settled items: changed days, days with newly settled orders
+    and days whose orders are no longer settled. Paid and payout-locked
+    settlements are never reported, since they can't be changed.
+    """
+    current = settlement_checksums(pharmacy_ids, since=since)
+    settlements = Settlement.objects.all()
+    if pharmacy_ids is not None:
+        settlements = settlements.filter(pharmacy_id__in=pharmacy_ids)
+    if since:
+        settlements = settlements.filter(settlement_date__gte=since)
 
-    total_amount = settlement.settlement_orders.aggregate(total=Sum("amount"))[
-        "total"
-    ] or Decimal("0.00")
-    settlement.total_amount = total_amount
-    settlement.save(update_fields=["total_amount", "updated_at"])
-    return settlement
+    drifted = set()
+    frozen = set()
+    for pharmacy_id, day, status, payout_id, checksum in settlements.values_list(
+        "pharmacy_id", "settlement_date", "status", "payout_id", "checksum"
+    ):
+        key = (pharmacy_id, day)
+        if status == Settlement.Status.PAID or payout_id:
+            frozen.add(key)
+        elif current.pop(key, "") != checksum:
+            drifted.add(key)
+    return drifted | (current.keys() - frozen)
 
 
-def sync_settlements_for_all_pharmacies():
-    for pharmacy in PharmacyProfile.objects.all().iterator():
-        sync_settlements_for_pharmacy(pharmacy)
+def reconcile_settlements(pharmacy_ids=None, since: dt_date = None) -> dict:
+    """
+    Re-sync only the settlement days found by find_drifted_settlements.
+    Returns the number of drifted days and the summed sync_settlements counts.
+    """
+    drifted = find_drifted_settlements(pharmacy_ids, since)
+    by_day = defaultdict(set)
+    for pharmacy_id, day in drifted:
+        by_day[day].add(pharmacy_id)
+    result = defaultdict(int, drifted_days=len(drifted))
+    for day, day_pharmacy_ids in sorted(by_day.items()):
+        for name, count in sync_settlements(day_pharmacy_ids, day).items():
+            result[name] += count
+    return dict(result)
+
+
+def annotate_settlements(queryset):
+    """`queryset` with each settlement's `order_count`, counted in the same query."""
+    return queryset.annotate(order_count=Count("settlement_orders"))
+
+
+def settlement_orders_prefetch():
+    """Prefetch of settlement orders with the order and customer SettlementOrderSerializer reads."""
+    return Prefetch(
+        "settlement_orders",
+        queryset=SettlementOrder.objects.select_related("order__user").order_by(
+            "order__created_at"
+        ),
+    )
+
+
+def settlement_summary(queryset) -> dict:
+    """Aggregate totals of the settlements in `queryset`, in two queries."""
+    totals = queryset.aggregate(
+        settlement_count=Count("id"),
+        amount=Sum("total_amount"),
+        pending_amount=Sum("total_amount", filter=Q(status=Settlement.Status.PENDING)),
+        paid_amount=Sum("total_amount", filter=Q(status=Settlement.Status.PAID)),
+        first_date=Min("settlement_date"),
+        last_date=Max("settlement_date"),
+    )
+    return {
+        "settlement_count": totals["settlement_count"],
+        "order_count": SettlementOrder.objects.filter(
+            settlement__in=queryset.values("id")
+        ).count(),
+        "total_amount": totals["amount"] or Decimal("0.00"),
+        "pending_amount": totals["pending_amount"] or Decimal("0.00"),
+        "paid_amount": totals["paid_amount"] or Decimal("0.00"),
+        "first_date": totals["first_date"],
+        "last_date": totals["last_date"],
+    }
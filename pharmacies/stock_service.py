@@ -0,0 +1,459 @@
+"""
+Materialized stock ledger.
+
+`StockMovement` stays the append-only history; this module maintains the
+current balance of every batch (`BatchStockLevel`) and its roll-up per drug
+(`DrugStockLevel`) in the same transaction as each movement write, so
+inventory reads never have to re-aggregate the movement history.
+
+Whenever a roll-up changes, its stock status (in stock / low / out, against
+the drug's low_stock_threshold) is re-evaluated; a drug that crossed the
+threshold gets a StockAlert row, pushed to the pharmacy's stock alert
+channel group once the transaction commits.
+"""
+
+from collections import defaultdict
+from datetime import date as dt_date
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import transaction
+from django.db.models import (
+    Case,
+    Exists,
+    F,
+    IntegerField,
+    Min,
+    OuterRef,
+    Q,
+    Subquery,
+    Sum,
+    Value,
+    When,
+    Window,
+)
+from django.db.models.expressions import RowRange
+from django.db.models.functions import FirstValue, Lag
+from django.utils import timezone
+from loguru import logger
+
+from .models import (
+    BatchStockLevel,
+    Drug,
+    DrugBatch,
+    DrugStockLevel,
+    PharmacyProfile,
+    StockAlert,
+    StockMovement,
+)
+
+StockStatus = DrugStockLevel.StockStatus
+
+
+def stock_status(quantity: int, threshold: int) -> str:
+    if quantity <= 0:
+        return StockStatus.OUT_OF_STOCK
+    if quantity <= threshold:
+        return StockStatus.LOW_STOCK
+    return StockStatus.IN_STOCK
+
+
+def stock_alert_group(pharmacy_id) -> str:
+    """Channels group a pharmacy's stock alerts are pushed to."""
+    return f"pharmacy_stock_{pharmacy_id}"
+
+
+def publish_stock_alerts(alerts):
+    """Push alerts to their pharmacies' channel groups; a layer outage only logs."""
+    from .serializers import StockAlertSerializer
+
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+    for alert in alerts:
+        try:
+            async_to_sync(channel_layer.group_send)(
+                stock_alert_group(alert.pharmacy_id),
+                {"type": "stock.alert", "alert": StockAlertSerializer(alert).data},
+            )
+        except Exception as exc:
+            logger.warning(f"Could not push stock alert {alert.pk}: {exc}")
+
+
+def record_stock_crossings(drug_ids) -> list:
+    """
+    Re-evaluate the stock status of the given drugs' roll-ups and record a
+    StockAlert for each one that changed. Costs one query when nothing
+    crossed and three when something did, however many drugs are checked.
+    Returns the new alerts.
+    """
+    drug_ids = list(drug_ids)
+    if not drug_ids:
+        return []
+    changed, alerts = [], []
+    for level in (
+        DrugStockLevel.objects.filter(drug_id__in=drug_ids)
+        .select_related("drug")
+        .only(
+            "drug_id",
+            "pharmacy_id",
+            "available_quantity",
+            "stock_status",
+            "drug__name",
+            "drug__low_stock_threshold",
+        )
+    ):
+        threshold = level.drug.low_stock_threshold
+        status = stock_status(level.available_quantity, threshold)
+        if status == level.stock_status:
+            continue
+        alerts.append(
+            StockAlert(
+                pharmacy_id=level.pharmacy_id,
+                drug=level.drug,
+                stock_status=status,
+                previous_status=level.stock_status,
+                available_quantity=level.available_quantity,
+                threshold=threshold,
+            )
+        )
+        level.stock_status = status
+        changed.append(level)
+    if changed:
+        DrugStockLevel.objects.bulk_update(changed, ["stock_status"])
+        StockAlert.objects.bulk_create(alerts)
+        transaction.on_commit(lambda: publish_stock_alerts(alerts))
+    return alerts
+
+
+def sync_batch_level(batch: DrugBatch):
+    """Create (or re-point) the level row of a batch and refresh its drug."""
+    BatchStockLevel.objects.update_or_create(
+        batch_id=batch.pk,
+        defaults={
+            "drug_id": batch.drug_id,
+            "pharmacy_id": batch.pharmacy_id,
+            "expiry_date": batch.expiry_date,
+        },
+    )
+    refresh_drug_levels([batch.drug_id])
+
+
+def refresh_drug_levels(drug_ids, today: dt_date = None) -> int:
+    """
+    Recompute the roll-up of the given drugs from their batch levels as of
+    `today`. Existing roll-up rows are locked first so a concurrent movement
+    increment can't be lost between the aggregate and the write.
+    """
+    drug_ids = list(drug_ids)
+    if not drug_ids:
+        return 0
+    today = today or timezone.localdate()
+
+    with transaction.atomic():
+        list(
+            DrugStockLevel.objects.select_for_update()
+            .filter(drug_id__in=drug_ids)
+            .values_list("drug_id", flat=True)
+        )
+        totals = {
+            row["drug_id"]: row
+            for row in BatchStockLevel.objects.filter(
+                drug_id__in=drug_ids, expiry_date__gte=today
+            )
+            .values("drug_id")
+            .annotate(total=Sum("quantity"), nearest=Min("expiry_date"))
+            .order_by()
+        }
+        pharmacy_by_drug = dict(
+            Drug.objects.filter(id__in=drug_ids).values_list("id", "pharmacy_id")
+        )
+        rows = [
+            DrugStockLevel(
+                drug_id=drug_id,
+                pharmacy_id=pharmacy_id,
+                available_quantity=(totals.get(drug_id) or {}).get("total") or 0,
+                nearest_expiry=(totals.get(drug_id) or {}).get("nearest"),
+                as_of=today,
+            )
+            for drug_id, pharmacy_id in pharmacy_by_drug.items()
+        ]
+        DrugStockLevel.objects.bulk_create(
+            rows,
+            update_conflicts=True,
+            unique_fields=["drug"],
+            update_fields=[
+                "available_quantity",
+                "nearest_expiry",
+                "as_of",
+                "updated_at",
+            ],
+        )
+        record_stock_crossings(pharmacy_by_drug)
+    return len(rows)
+
+
+def apply_movements(movements, sign: int = 1):
+    """
+    Apply the quantities of `movements` (saved or about to be bulk-inserted)
+    to the batch and drug levels. Costs a fixed number of queries regardless
+    of how many movements are applied. Must run inside the transaction that
+    writes the movements.
+    """
+    deltas = defaultdict(int)
+    for movement in movements:
+        deltas[movement.batch_id] += sign * movement.quantity
+    deltas = {batch_id: delta for batch_id, delta in deltas.items() if delta}
+    if not deltas:
+        return
+
+    levels = {
+        row["batch_id"]: row
+        for row in BatchStockLevel.objects.filter(batch_id__in=deltas).values(
+            "batch_id", "drug_id", "expiry_date"
+        )
+    }
+    missing = [batch_id for batch_id in deltas if batch_id not in levels]
+    if missing:
+        # Batches written without going through DrugBatch.save (e.g. bulk loads).
+        for batch in DrugBatch.objects.filter(id__in=missing):
+            sync_batch_level(batch)
+        levels.update(
+            {
+                row["batch_id"]: row
+                for row in BatchStockLevel.objects.filter(batch_id__in=missing).values(
+                    "batch_id", "drug_id", "expiry_date"
+                )
+            }
+        )
+
+    BatchStockLevel.objects.filter(batch_id__in=deltas).update(
+        quantity=F("quantity")
+        + Case(
+            *[
+                When(batch_id=batch_id, then=Value(delta))
+                for batch_id, delta in deltas.items()
+            ],
+            default=Value(0),
+            output_field=IntegerField(),
+        )
+    )
+
+    # A batch only counts towards a drug's roll-up if it had not expired on the
+    # roll-up's `as_of` date.
+    drug_deltas = defaultdict(int)
+    for batch_id, delta in deltas.items():
+        level = levels[batch_id]
+        drug_deltas[(level["drug_id"], level["expiry_date"])] += delta
+    drug_ids = {drug_id for drug_id, _ in drug_deltas}
+    increment = Value(0)
+    for (drug_id, expiry_date), delta in drug_deltas.items():
+        increment = increment + Case(
+            When(drug_id=drug_id, as_of__lte=expiry_date, then=Value(delta)),
+            default=Value(0),
+            output_field=IntegerField(),
+        )
+    updated = DrugStockLevel.objects.filter(drug_id__in=drug_ids).update(
+        available_quantity=F("available_quantity") + increment
+    )
+    if updated < len(drug_ids):
+        existing = set(
+            DrugStockLevel.objects.filter(drug_id__in=drug_ids).values_list(
+                "drug_id", flat=True
+            )
+        )
+        refresh_drug_levels(drug_ids - existing)
+    record_stock_crossings(drug_ids)
+
+
+def revert_movement(movement: StockMovement):
+    """Undo a movement's effect on the levels (edit or delete)."""
+    apply_movements([movement], sign=-1)
+
+
+def annotate_stock(queryset, today: dt_date = None):
+    """
+    Annotate a Drug queryset with `available_quantity` (stock in non-expired
+    batches) and `nearest_expiry`, read from the materialized levels.
+
+    The roll-up row is used while it is current (no counted batch has expired
+    since it was computed); otherwise the drug's batch levels are summed, which
+    is still one small indexed lookup rather than a scan of its movements.
+    """
+    today = today or timezone.localdate()
+    live_batches = (
+        BatchStockLevel.objects.filter(drug=OuterRef("pk"), expiry_date__gte=today)
+        .values("drug")
+        .order_by()
+    )
+    rollup_is_current = Q(stock_level__nearest_expiry__isnull=True) | Q(
+        stock_level__nearest_expiry__gte=today
+    )
+    return queryset.annotate(
+        available_quantity=Case(
+            When(rollup_is_current, then=F("stock_level__available_quantity")),
+            default=Subquery(
+                live_batches.annotate(total=Sum("quantity")).values("total")
+            ),
+            output_field=IntegerField(),
+        ),
+        nearest_expiry=Case(
+            When(rollup_is_current, then=F("stock_level__nearest_expiry")),
+            default=Subquery(
+                live_batches.annotate(nearest=Min("expiry_date")).values("nearest")
+            ),
+        ),
+    )
+
+
+def annotate_has_stock(queryset, today: dt_date = None):
+    """
+    Annotate a PharmacyProfile queryset with `has_stock`: whether any of the
+    pharmacy's drugs has stock in a non-expired batch (see annotate_stock).
+    """
+    in_stock = annotate_stock(
+        Drug.objects.filter(pharmacy=OuterRef("pk")), today
+    ).filter(available_quantity__gt=0)
+    return queryset.annotate(has_stock=Exists(in_stock))
+
+
+def movement_history(drug: Drug, exclude_reasons=()):
+    """
+    A drug's movements, newest first, each annotated in the same query with
+    `previous_quantity` (the quantity of the movement before it, None for the
+    first) and `balance` (the drug's ledger total once it was applied).
+
+    Both are window functions over the whole ledger in (created_at, id) order.
+    `exclude_reasons` is applied after the windows, so hidden movements still
+    count towards their neighbours' previous quantity and balance, and any
+    upper bound on created_at (a keyset cursor) leaves every older row in the
+    windows.
+    """
+    ledger = {"partition_by": [F("drug_id")], "order_by": [F("created_at"), F("id")]}
+    queryset = StockMovement.objects.filter(drug=drug).annotate(
+        previous_quantity=Window(Lag("quantity"), **ledger),
+        balance=Window(Sum("quantity"), frame=RowRange(end=0), **ledger),
+    )
+    if exclude_reasons:
+        # Filtering on a window value defers the filter to the outer query.
+        queryset = queryset.alias(
+            movement_reason=Window(FirstValue("reason"), partition_by=[F("id")])
+        ).exclude(movement_reason__in=exclude_reasons)
+    return queryset.order_by("-created_at", "-id")
+
+
+def refresh_stale_drug_levels(today: dt_date = None, chunk_size: int = 500) -> int:
+    """Roll forward every drug whose roll-up includes a batch that has since expired."""
+    today = today or timezone.localdate()
+    stale_ids = list(
+        DrugStockLevel.objects.filter(nearest_expiry__lt=today).values_list(
+            "drug_id", flat=True
+        )
+    )
+    refreshed = 0
+    for start in range(0, len(stale_ids), chunk_size):
+        refreshed += refresh_drug_levels(stale_ids[start : start + chunk_size], today)
+    return refreshed
+
+
+def rebuild_stock_levels(pharmacy: PharmacyProfile, commit: bool = True) -> dict:
+    """
+    Recompute a pharmacy's levels from its full movement history and report
+    any drift against the materialized rows. With commit=False nothing is written.
+    """
+    today = timezone.localdate()
+    movement_totals = dict(
+        StockMovement.objects.filter(pharmacy=pharmacy)
+        .values("batch_id")
+        .annotate(total=Sum("quantity"))
+        .order_by()
+        .values_list("batch_id", "total")
+    )
+    current_batches = {
+        row["batch_id"]: row
+        for row in BatchStockLevel.objects.filter(batch__pharmacy=pharmacy).values(
+            "batch_id", "quantity", "expiry_date"
+        )
+    }
+    current_drugs = {
+        row["drug_id"]: row
+        for row in DrugStockLevel.objects.filter(drug__pharmacy=pharmacy).values(
+            "drug_id", "available_quantity", "nearest_expiry"
+        )
+    }
+
+    batch_drift = []
+    expected_drugs = {}
+    batches_checked = 0
+    for batch in DrugBatch.objects.filter(pharmacy=pharmacy).values(
+        "id", "drug_id", "expiry_date"
+    ):
+        batches_checked += 1
+        expected = movement_totals.get(batch["id"]) or 0
+        current = current_batches.get(batch["id"])
+        if (
+            current is None
+            or current["quantity"] != expected
+            or current["expiry_date"] != batch["expiry_date"]
+        ):
+            batch_drift.append(
+                {
+                    "batch_id": batch["id"],
+                    "expected": expected,
+                    "actual": current["quantity"] if current else None,
+                }
+            )
+        drug = expected_drugs.setdefault(
+            batch["drug_id"], {"available_quantity": 0, "nearest_expiry": None}
+        )
+        if batch["expiry_date"] >= today:
+            drug["available_quantity"] += expected
+            if (
+                drug["nearest_expiry"] is None
+                or batch["expiry_date"] < drug["nearest_expiry"]
+            ):
+                drug["nearest_expiry"] = batch["expiry_date"]
+
+    drug_drift = [
+        drug_id
+        for drug_id, expected in expected_drugs.items()
+        if current_drugs.get(drug_id) is None
+        or current_drugs[drug_id]["available_quantity"]
+        != expected["available_quantity"]
+        or current_drugs[drug_id]["nearest_expiry"] != expected["nearest_expiry"]
+    ]
+
+    if commit and (batch_drift or drug_drift):
+        with transaction.atomic():
+            batches = DrugBatch.objects.filter(
+                id__in=[row["batch_id"] for row in batch_drift]
+            ).values("id", "drug_id", "pharmacy_id", "expiry_date")
+            BatchStockLevel.objects.bulk_create(
+                [
+                    BatchStockLevel(
+                        batch_id=batch["id"],
+                        drug_id=batch["drug_id"],
+                        pharmacy_id=batch["pharmacy_id"],
+                        expiry_date=batch["expiry_date"],
+                        quantity=movement_totals.get(batch["id"]) or 0,
+                    )
+                    for batch in batches
+                ],
+                update_conflicts=True,
+                unique_fields=["batch"],
+                update_fields=[
+                    "drug",
+                    "pharmacy",
+                    "expiry_date",
+                    "quantity",
+                    "updated_at",
+                ],
+            )
+            refresh_drug_levels(expected_drugs.keys(), today)
+
+    return {
+        "batches_checked": batches_checked,
+        "drugs_checked": len(expected_drugs),
+        "batch_drift": batch_drift,
+        "drug_drift": drug_drift,
+    }
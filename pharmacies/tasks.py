@@ -1,13 +1,13 @@
 from api.paystack import PayStack
 from . import models
 from .settlement_service import (
-    sync_settlements_for_all_pharmacies,
+    reconcile_settlements,
     sync_settlements_for_pharmacy,
 )
 from config import celery_app
 from django.utils import timezone
-from datetime import timedelta
-from accounts.tasks import generic_send_mail
+from datetime import datetime, timedelta
+import time
 from loguru import logger
 
 
@@ -50,30 +50,132 @@ def initiate_settlement_payout(payout_id):
 
 
 @celery_app.task
-def reconcile_pending_payouts():
+def reconcile_pending_payouts(chunk_size=100, max_workers=None):
     """
     Fallback reconciliation for payouts stuck in PROCESSING (e.g. a missed
-    webhook): verify each against Paystack and finalize. Safe to run on a beat.
+    webhook): verify each against Paystack and finalize. Payouts are verified
+    a chunk at a time, up to `max_workers` (settings.PAYSTACK_MAX_CONCURRENCY)
+    concurrently. Safe to run on a beat.
     """
-    from .payout_service import reconcile_payout
+    from .payout_service import reconcile_payouts
 
     pending = models.SettlementPayout.objects.filter(
         status=models.SettlementPayout.Status.PROCESSING
-    )
-    for payout in pending.iterator():
-        try:
-            reconcile_payout(payout)
-        except Exception as exc:
-            logger.error(f"Failed to reconcile payout {payout.id}: {exc}")
+    ).order_by("requested_at")
+    chunk = []
+    for payout in pending.iterator(chunk_size=chunk_size):
+        chunk.append(payout)
+        if len(chunk) == chunk_size:
+            reconcile_payouts(chunk, max_workers)
+            chunk = []
+    if chunk:
+        reconcile_payouts(chunk, max_workers)
+
+
+@celery_app.task
+def process_webhook_events(reference):
+    """Apply the stored Paystack webhook events of one reference, in order."""
+    from .webhook_service import process_pending_events
+
+    return process_pending_events(reference)
+
+
+@celery_app.task
+def retry_webhook_events():
+    """
+    Sweep for Paystack webhook events whose task was lost or that failed with
+    attempts left, and process them again.
+    """
+    from .webhook_service import process_pending_events, stale_references
+
+    references = stale_references()
+    applied = sum(process_pending_events(reference) for reference in references)
+    if references:
+        logger.info(
+            f"Retried webhook events for {len(references)} reference(s), applied {applied}"
+        )
+    return applied
+
+
+def settlement_shard_pharmacy_ids(shards):
+    """Pharmacy ids split into `shards` lists by hash, from one scan of the table."""
+    pharmacy_ids = [[] for _ in range(shards)]
+    for pharmacy_id in models.PharmacyProfile.objects.values_list("id", flat=True):
+        pharmacy_ids[pharmacy_id.int % shards].append(pharmacy_id)
+    return pharmacy_ids
 
 
 @celery_app.task
-def calculate_daily_settlements():
+def calculate_daily_settlements(shards=None):
     """
-    Recalculate settlements for all pharmacies.
+    Reconcile settlements for all pharmacies. Order state changes keep their
+    settlement day in sync as they happen, so this only re-syncs days whose
+    checksum shows drift. Pharmacies are hashed into `shards` (default
+    settings.SETTLEMENT_SYNC_SHARDS) reconciled in parallel, and a summary
+    is logged once every shard has finished. The pharmacy table is read
+    once here and each shard is handed its ids.
     Intended to run once daily at 11:55 PM.
     """
-    sync_settlements_for_all_pharmacies()
+    from celery import chord, group
+    from django.conf import settings
+
+    shards = shards or settings.SETTLEMENT_SYNC_SHARDS
+    run = chord(
+        group(
+            reconcile_settlement_shard.s(shard, [str(pk) for pk in pharmacy_ids])
+            for shard, pharmacy_ids in enumerate(settlement_shard_pharmacy_ids(shards))
+        ),
+        summarize_settlement_run.s(timezone.now().isoformat()),
+    ).apply_async()
+    return run.id
+
+
+@celery_app.task
+def reconcile_settlement_shard(shard, pharmacy_ids):
+    """
+    Reconcile one shard's settlements (those of `pharmacy_ids`) in a single
+    transaction. Failures are reported in the result instead of raised, so
+    the other shards and the summary still run.
+    """
+    from django.db import transaction
+
+    started = time.perf_counter()
+    result = {"shard": shard, "pharmacies": len(pharmacy_ids), "error": None}
+    try:
+        if pharmacy_ids:
+            with transaction.atomic():
+                result.update(reconcile_settlements(pharmacy_ids))
+    except Exception as exc:
+        logger.exception(f"Settlement shard {shard} failed: {exc}")
+        result["error"] = str(exc)
+    result["duration"] = round(time.perf_counter() - started, 3)
+    return result
+
+
+@celery_app.task
+def summarize_settlement_run(results, started_at):
+    """Log duration, row counts and failures of a sharded settlement run."""
+    started = datetime.fromisoformat(started_at)
+    failed = [result for result in results if result["error"]]
+    summary = {
+        "duration": round((timezone.now() - started).total_seconds(), 3),
+        "shards": len(results),
+        "failed_shards": [result["shard"] for result in failed],
+        "pharmacies": sum(result["pharmacies"] for result in results),
+        "drifted_days": sum(result.get("drifted_days", 0) for result in results),
+        "orders_written": sum(
+            result.get(name, 0)
+            for result in results
+            for name in ("orders_created", "orders_updated", "orders_deleted")
+        ),
+    }
+    for result in sorted(results, key=lambda result: result["shard"]):
+        logger.info(f"Settlement shard {result['shard']}: {result}")
+    if failed:
+        logger.error(f"Settlement run finished with failed shards: {summary}")
+    else:
+        logger.info(f"Settlement run finished: {summary}")
+    return summary
 
 
 @celery_app.task
@@ -88,54 +190,67 @@ def calculate_pharmacy_settlements(pharmacy_id):
 
 
 @celery_app.task
-def send_expiry_alerts():
+def refresh_expired_stock_levels():
     """
-    Daily task: email pharmacies about drug batches expiring within 30 days.
-    Runs at 08:00 UTC each day.
-    """
-    today = timezone.now().date()
-    threshold = today + timedelta(days=30)
-
-    pharmacies = models.PharmacyProfile.objects.filter(user__is_active=True).select_related("user")
-
-    for pharmacy in pharmacies:
-        expiring_batches = (
-            models.DrugBatch.objects.filter(
-                pharmacy=pharmacy,
-                expiry_date__gte=today,
-                expiry_date__lte=threshold,
-            )
-            .select_related("drug")
-            .order_by("expiry_date")
-        )
+    Roll the per-drug stock levels forward past batches that expired since
+    they were last computed. Runs shortly after midnight; until then readers
+    fall back to the batch levels, so this only keeps the fast path warm.
+    """
+    from .stock_service import refresh_stale_drug_levels
 
-        if not expiring_batches.exists():
-            continue
+    refreshed = refresh_stale_drug_levels()
+    logger.info(f"Refreshed {refreshed} drug stock level(s) after batch expiry")
+
+
+@celery_app.task
+def backfill_dashboard_rollups(days=None, chunk_size=200):
+    """
+    Rebuild the pharmacy dashboard rollups from orders, a chunk of pharmacies
+    at a time. `days` limits the rebuild to the last N days (the nightly run
+    reconciles the last two); without it every day is rebuilt.
+    """
+    from .dashboard_service import rebuild_daily_stats
+
+    start = timezone.localdate() - timedelta(days=days - 1) if days else None
+    pharmacy_ids = list(
+        models.PharmacyProfile.objects.order_by("id").values_list("id", flat=True)
+    )
+    written = 0
+    for i in range(0, len(pharmacy_ids), chunk_size):
+        written += rebuild_daily_stats(pharmacy_ids[i : i + chunk_size], start=start)
+    logger.info(
+        f"Rebuilt {written} dashboard rollup row(s) for {len(pharmacy_ids)} pharmacies"
+    )
+    return written
 
-        items_html = "".join(
-            f"<li><strong>{b.drug.name}</strong> — Batch {b.batch_number} expires on <strong>{b.expiry_date}</strong></li>"
-            for b in expiring_batches
-        )
-        body = (
-            f"<p>The following drug batches in your pharmacy are expiring within the next 30 days:</p>"
-            f"<ul style='color:#333;line-height:1.8'>{items_html}</ul>"
-            "<p>Please take the necessary steps to manage these items (return, discount, or dispose).</p>"
-        )
 
-        email = pharmacy.email or pharmacy.user.email
-        if not email:
-            continue
-
-        try:
-            generic_send_mail.delay(
-                recipient=email,
-                title="⚠️ Drug Expiry Alert — Action Required",
-                payload={
-                    "user_name": pharmacy.pharmacy_name,
-                    "body": body,
-                },
-                email_type=None,
-            )
-            logger.info(f"Expiry alert sent to {pharmacy.pharmacy_name} ({email})")
-        except Exception as exc:
-            logger.error(f"Failed to send expiry alert to {email}: {exc}")
+@celery_app.task
+def record_expiry_alerts(results, alerts):
+    """
+    Chord callback of the expiry alert mails: record the alerts that were
+    sent, so a failed mail is retried the next day instead of suppressed.
+    """
+    from . import expiry_service
+
+    recorded = expiry_service.record_sent(results, alerts)
+    if recorded < len(alerts):
+        logger.warning(f"{len(alerts) - recorded} expiry alert mail(s) failed")
+    return recorded
+
+
+@celery_app.task
+def send_expiry_alerts():
+    """
+    Daily task: email pharmacies about drug batches expiring within 30 days.
+    Runs at 08:00 UTC each day. An alert listing the same batches as the one
+    last sent is skipped until EXPIRY_ALERT_RESEND_DAYS have passed (see
+    expiry_service).
+    """
+    from . import expiry_service
+
+    counts = expiry_service.send_expiry_alerts()
+    logger.info(
+        f"Expiry alerts: {counts['sent']} sent, {counts['unchanged']} unchanged, "
+        f"{counts['no_email']} pharmacies without an email address"
+    )
+    return counts
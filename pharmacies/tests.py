@@ -1,25 +1,68 @@
+from datetime import timedelta
 from decimal import Decimal
-from unittest.mock import patch
+from io import StringIO
+from concurrent.futures import ThreadPoolExecutor
+import uuid
+from unittest import skipUnless
+from unittest.mock import Mock, patch
 
-from django.test import TestCase
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 
 from accounts.models import CustomUser
+from config.pagination import KeysetPagination
+from helpers import exceptions
+from helpers.redis_client import get_redis
 from .models import (
+    CallBackData,
     PharmacyProfile,
     PaymentMethod,
     DrugCategory,
     Drug,
+    DrugBatch,
+    DrugStockLevel,
     DrugUnit,
+    BatchStockLevel,
+    ExpiryAlertDigest,
+    StockAlert,
     Order,
     OrderItem,
     PharmacyOrder,
     Payment,
+    PharmacyDailyStats,
     Settlement,
     SettlementPayout,
+    StockMovement,
 )
 from . import payout_service
+from .cart_service import CartService
+from .expiry_service import send_expiry_alerts
+from .cart_validation import LineIssue, get_cart_validation, revalidate_cart
 from . import payment_service
-from .settlement_service import sync_settlements_for_pharmacy
+from .tasks import (
+    backfill_dashboard_rollups,
+    calculate_daily_settlements,
+    reconcile_settlement_shard,
+    settlement_shard_pharmacy_ids,
+    summarize_settlement_run,
+)
+from .batch_allocation import deduct_stock, return_stock
+from .drug_matcher import get_drug_index, normalize_name
+from .search_service import search_drugs
+from .geo_service import grid_cell, haversine_km
+from .order_service import place_order
+from .settlement_service import (
+    find_drifted_settlements,
+    reconcile_settlements,
+    settlement_checksums,
+    sync_settlements,
+    sync_settlements_for_pharmacy,
+)
+from .stock_service import annotate_stock, stock_alert_group
 
 
 def make_pharmacy(email, license_no):
@@ -36,6 +79,13 @@ def make_pharmacy(email, license_no):
     )
 
 
+def redis_available():
+    try:
+        return get_redis().ping()
+    except Exception:
+        return False
+
+
 def make_paid_order(user, drug, quantity, status):
     order = Order.objects.create(
         user=user,
@@ -78,6 +128,241 @@ class SettlementEligibilityTests(TestCase):
         self.assertEqual(settlement.total_amount, Decimal("30.00"))
         self.assertEqual(settlement.status, Settlement.Status.PENDING)
 
+    def test_sync_applies_the_diff_and_keeps_locked_settlements(self):
+        kept = make_paid_order(
+            self.pharmacy.user, self.drug, 3, PharmacyOrder.Status.DELIVERED
+        )
+        dropped = make_paid_order(
+            self.pharmacy.user, self.drug, 1, PharmacyOrder.Status.DELIVERED
+        )
+        sync_settlements_for_pharmacy(self.pharmacy)
+        settlement = Settlement.objects.get(pharmacy=self.pharmacy)
+        self.assertEqual(settlement.total_amount, Decimal("40.00"))
+
+        OrderItem.objects.filter(order=kept).update(total_price=Decimal("25.00"))
+        PharmacyOrder.objects.filter(order=dropped).update(
+            status=PharmacyOrder.Status.CANCELLED
+        )
+        stats = sync_settlements([self.pharmacy.pk])
+        settlement.refresh_from_db()
+        self.assertEqual(settlement.total_amount, Decimal("25.00"))
+        self.assertEqual(
+            list(settlement.settlement_orders.values_list("order_id", "amount")),
+            [(kept.id, Decimal("25.00"))],
+        )
+        self.assertEqual((stats["orders_updated"], stats["orders_deleted"]), (1, 1))
+
+        Settlement.objects.filter(pk=settlement.pk).update(
+            status=Settlement.Status.PAID
+        )
+        OrderItem.objects.filter(order=kept).update(total_price=Decimal("1.00"))
+        sync_settlements([self.pharmacy.pk])
+        settlement.refresh_from_db()
+        self.assertEqual(settlement.total_amount, Decimal("25.00"))
+
+        PharmacyOrder.objects.filter(order=kept).update(
+            status=PharmacyOrder.Status.CANCELLED
+        )
+        sync_settlements([self.pharmacy.pk])
+        self.assertTrue(Settlement.objects.filter(pk=settlement.pk).exists())
+
+    def test_state_changes_sync_their_settlement_day(self):
+        order = make_paid_order(
+            self.pharmacy.user, self.drug, 2, PharmacyOrder.Status.PENDING
+        )
+        self.assertFalse(Settlement.objects.exists())
+
+        pharmacy_order = PharmacyOrder.objects.get(order=order)
+        pharmacy_order.status = PharmacyOrder.Status.DELIVERED
+        pharmacy_order.save()
+        settlement = Settlement.objects.get(pharmacy=self.pharmacy)
+        self.assertEqual(settlement.total_amount, Decimal("20.00"))
+        self.assertEqual(
+            settlement.checksum,
+            settlement_checksums()[(self.pharmacy.pk, settlement.settlement_date)],
+        )
+
+        order = Order.objects.get(pk=order.pk)
+        order.payment_status = Order.PaymentStatus.REFUNDED
+        order.save()
+        self.assertFalse(Settlement.objects.exists())
+
+    def test_reconciliation_only_resyncs_drifted_days(self):
+        order = make_paid_order(
+            self.pharmacy.user, self.drug, 3, PharmacyOrder.Status.DELIVERED
+        )
+        settlement = Settlement.objects.get(pharmacy=self.pharmacy)
+        self.assertEqual(find_drifted_settlements(), set())
+
+        # Changes that bypass save() leave the settlement behind.
+        OrderItem.objects.filter(order=order).update(total_price=Decimal("12.00"))
+        key = (self.pharmacy.pk, settlement.settlement_date)
+        self.assertEqual(find_drifted_settlements(), {key})
+
+        result = reconcile_settlements()
+        self.assertEqual((result["drifted_days"], result["orders_updated"]), (1, 1))
+        settlement.refresh_from_db()
+        self.assertEqual(settlement.total_amount, Decimal("12.00"))
+        self.assertEqual(reconcile_settlements(), {"drifted_days": 0})
+
+        Settlement.objects.filter(pk=settlement.pk).update(
+            status=Settlement.Status.PAID
+        )
+        OrderItem.objects.filter(order=order).update(total_price=Decimal("1.00"))
+        self.assertEqual(find_drifted_settlements(), set())
+
+    @override_settings(CELERY_TASK_ALWAYS_EAGER=True)
+    def test_sharded_run_reconciles_every_pharmacy_once(self):
+        pharmacies = [self.pharmacy] + [
+            make_pharmacy(f"shard{index}@x.com", f"LIC-SHARD-{index}")
+            for index in range(6)
+        ]
+        with self.assertNumQueries(1):
+            shards = settlement_shard_pharmacy_ids(3)
+        self.assertCountEqual(sum(shards, []), [pharmacy.pk for pharmacy in pharmacies])
+
+        order = make_paid_order(
+            self.pharmacy.user, self.drug, 2, PharmacyOrder.Status.DELIVERED
+        )
+        OrderItem.objects.filter(order=order).update(total_price=Decimal("5.00"))
+        with patch("pharmacies.tasks.summarize_settlement_run.run") as summarize:
+            calculate_daily_settlements(shards=3)
+        results, started_at = summarize.call_args.args
+
+        summary = summarize_settlement_run(results, started_at)
+        self.assertEqual(
+            {key: summary[key] for key in ("shards", "pharmacies", "failed_shards")},
+            {"shards": 3, "pharmacies": 7, "failed_shards": []},
+        )
+        self.assertEqual(summary["drifted_days"], 1)
+        self.assertEqual(
+            Settlement.objects.get(pharmacy=self.pharmacy).total_amount, Decimal("5.00")
+        )
+
+    def test_failed_shard_is_reported_not_raised(self):
+        other = make_pharmacy("other-shard@x.com", "LIC-OTHER-SHARD")
+        order = make_paid_order(
+            self.pharmacy.user, self.drug, 2, PharmacyOrder.Status.DELIVERED
+        )
+        OrderItem.objects.filter(order=order).update(total_price=Decimal("5.00"))
+
+        with patch(
+            "pharmacies.tasks.reconcile_settlements", side_effect=RuntimeError("boom")
+        ):
+            failed = reconcile_settlement_shard(0, [str(other.pk)])
+        succeeded = reconcile_settlement_shard(1, [str(self.pharmacy.pk)])
+        self.assertEqual(failed["error"], "boom")
+
+        summary = summarize_settlement_run(
+            [failed, succeeded], timezone.now().isoformat()
+        )
+        summary.pop("duration")
+        self.assertEqual(
+            summary,
+            {
+                "shards": 2,
+                "failed_shards": [0],
+                "pharmacies": 2,
+                "drifted_days": 1,
+                "orders_written": 1,
+            },
+        )
+
+    def test_sync_query_count_does_not_grow_with_pharmacies(self):
+        def count_queries():
+            Settlement.objects.all().delete()
+            with CaptureQueriesContext(connection) as ctx:
+                sync_settlements()
+            return len(ctx.captured_queries)
+
+        make_paid_order(
+            self.pharmacy.user, self.drug, 1, PharmacyOrder.Status.DELIVERED
+        )
+        small = count_queries()
+        for index in range(5):
+            pharmacy = make_pharmacy(f"elig{index}@x.com", f"LIC-ELIG-{index}")
+            drug = Drug.objects.create(
+                pharmacy=pharmacy,
+                name="Paracetamol",
+                category=self.drug.category,
+                unit_price=Decimal("2.00"),
+            )
+            for quantity in (1, 2):
+                make_paid_order(
+                    pharmacy.user, drug, quantity, PharmacyOrder.Status.DELIVERED
+                )
+        large = count_queries()
+        self.assertEqual(small, large)
+
+
+class SettlementListTests(TestCase):
+    def setUp(self):
+        from rest_framework.test import APIClient
+
+        self.pharmacy = make_pharmacy("list@x.com", "LIC-LIST")
+        self.drug = Drug.objects.create(
+            pharmacy=self.pharmacy,
+            name="Paracetamol",
+            category=DrugCategory.objects.create(pharmacy=self.pharmacy, name="Cat"),
+            unit_price=Decimal("10.00"),
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.pharmacy.user)
+
+    def settle(self, days_ago, *quantities):
+        for quantity in quantities:
+            order = make_paid_order(
+                self.pharmacy.user, self.drug, quantity, PharmacyOrder.Status.DELIVERED
+            )
+            Order.objects.filter(pk=order.pk).update(
+                created_at=timezone.now() - timedelta(days=days_ago)
+            )
+        sync_settlements([self.pharmacy.pk])
+
+    def fetch(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response.data, len(queries)
+
+    def test_list_query_count_is_constant_per_page(self):
+        self.settle(1, 1)
+        _, baseline = self.fetch("/pharmacies/settlements/")
+        for days_ago in range(2, 12):
+            self.settle(days_ago, 1, 2)
+        data, queries = self.fetch("/pharmacies/settlements/")
+
+        self.assertEqual(queries, baseline)
+        self.assertEqual(len(data["settlements"]), 11)
+        self.assertEqual(
+            [row["order_count"] for row in data["settlements"]], [1] + [2] * 10
+        )
+
+    def test_detail_lists_orders_with_customers(self):
+        self.settle(1, 1, 2, 3)
+        settlement = Settlement.objects.get()
+        data, queries = self.fetch(f"/pharmacies/settlements/{settlement.pk}/")
+        self.assertEqual(data["order_count"], 3)
+        self.assertEqual(len(data["orders"]), 3)
+        self.assertEqual(data["orders"][0]["customer"], "list@x.com")
+        self.assertLessEqual(queries, 4)
+
+    def test_summary_mode_returns_only_totals(self):
+        self.settle(1, 1, 2)
+        self.settle(2, 3)
+        Settlement.objects.filter(
+            settlement_date=timezone.localdate() - timedelta(days=2)
+        ).update(status=Settlement.Status.PAID)
+        data, _ = self.fetch("/pharmacies/settlements/?summary=true")
+        self.assertNotIn("settlements", data)
+        self.assertEqual(data["settlement_count"], 2)
+        self.assertEqual(data["order_count"], 3)
+        self.assertEqual(data["total_amount"], Decimal("60.00"))
+        self.assertEqual(data["paid_amount"], Decimal("30.00"))
+
+        data, _ = self.fetch("/pharmacies/settlements/?summary=true&status=pending")
+        self.assertEqual((data["settlement_count"], data["order_count"]), (1, 2))
+
 
 class PayoutFlowTests(TestCase):
     def setUp(self):
@@ -181,6 +466,151 @@ class PayoutFlowTests(TestCase):
         self.assertEqual(response.data["payout"]["status"], "processing")
 
 
+class PaystackStub:
+    """
+    Local HTTP/1.1 (keep-alive) stand-in for the Paystack API. `responses`
+    maps a path to a list of (status, body) replies, the last one repeating.
+    """
+
+    def __init__(self, responses):
+        import json
+        import threading
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        self.responses = responses
+        self.requests = []
+        self.connections = set()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                stub.requests.append(self.path)
+                stub.connections.add(self.client_address)
+                replies = stub.responses.get(
+                    self.path, [(404, {"status": False, "message": "Not found"})]
+                )
+                status, body = replies.pop(0) if len(replies) > 1 else replies[0]
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@override_settings(PAYSTACK_MAX_CONCURRENCY=3, PAYSTACK_RETRY_BACKOFF=0)
+class PayoutReconciliationTests(TestCase):
+    def setUp(self):
+        import api.paystack
+
+        self.pharmacy = make_pharmacy("recon@x.com", "LIC-RECON")
+        self.method = PaymentMethod.objects.create(
+            user=self.pharmacy.user,
+            payment_method_type=PaymentMethod.PaymentMethodType.MOBILE_MONEY,
+            account_number="0240000000",
+            account_name="Pharm Recon",
+            provider="MTN",
+            paystack_recipient_code="RCP_recon",
+        )
+        self.stub = None
+        api.paystack._session = None
+        self.addCleanup(setattr, api.paystack, "_session", None)
+
+    def serve(self, responses):
+        from api.paystack import PayStack
+
+        self.stub = PaystackStub(responses)
+        self.addCleanup(self.stub.close)
+        base_url = patch.object(PayStack, "base_url", self.stub.url)
+        base_url.start()
+        self.addCleanup(base_url.stop)
+
+    def payout(self, reference):
+        return SettlementPayout.objects.create(
+            pharmacy=self.pharmacy,
+            payment_method=self.method,
+            reference=reference,
+            status=SettlementPayout.Status.PROCESSING,
+        )
+
+    def verify_path(self, reference):
+        return f"/transfer/verify/{reference}"
+
+    def test_pending_payouts_are_verified_concurrently_over_pooled_connections(self):
+        from .tasks import reconcile_pending_payouts
+
+        outcomes = ["success", "failed", "pending", "reversed"] * 5
+        responses = {}
+        for index, outcome in enumerate(outcomes):
+            self.payout(f"REF-{index}")
+            responses[self.verify_path(f"REF-{index}")] = [
+                (200, {"status": True, "data": {"status": outcome}})
+            ]
+        self.serve(responses)
+
+        reconcile_pending_payouts(chunk_size=8)
+
+        statuses = dict(SettlementPayout.objects.values_list("reference", "status"))
+        expected = {
+            "success": SettlementPayout.Status.SUCCESS,
+            "failed": SettlementPayout.Status.FAILED,
+            "pending": SettlementPayout.Status.PROCESSING,
+            "reversed": SettlementPayout.Status.REVERSED,
+        }
+        self.assertEqual(
+            statuses,
+            {
+                f"REF-{index}": expected[outcome]
+                for index, outcome in enumerate(outcomes)
+            },
+        )
+        self.assertEqual(len(self.stub.requests), 20)
+        # Connections are kept alive and shared: never more than the cap.
+        self.assertLessEqual(len(self.stub.connections), 3)
+
+    def test_transient_errors_are_retried_and_hard_failures_reported(self):
+        self.payout("REF-RETRY")
+        self.payout("REF-DOWN")
+        self.serve(
+            {
+                self.verify_path("REF-RETRY"): [
+                    (503, {"status": False, "message": "Unavailable"}),
+                    (200, {"status": True, "data": {"status": "success"}}),
+                ],
+                self.verify_path("REF-DOWN"): [
+                    (502, {"status": False, "message": "Bad gateway"})
+                ],
+            }
+        )
+
+        reconciled = payout_service.reconcile_payouts(
+            SettlementPayout.objects.order_by("reference")
+        )
+
+        self.assertEqual(
+            {payout.reference: payout.status for payout in reconciled},
+            {
+                "REF-DOWN": SettlementPayout.Status.PROCESSING,
+                "REF-RETRY": SettlementPayout.Status.SUCCESS,
+            },
+        )
+        self.assertEqual(self.stub.requests.count(self.verify_path("REF-RETRY")), 2)
+        self.assertEqual(self.stub.requests.count(self.verify_path("REF-DOWN")), 4)
+
+
 class ChargeWebhookTests(TestCase):
     def setUp(self):
         self.pharmacy = make_pharmacy("charge@x.com", "LIC-CHG")
@@ -223,3 +653,1253 @@ class ChargeWebhookTests(TestCase):
         )
         self.order.refresh_from_db()
         self.assertEqual(self.order.payment_status, Order.PaymentStatus.PENDING)
+
+
+@override_settings(
+    PAYSTACK_PRIVATE_KEY="sk_test_webhook", CELERY_TASK_ALWAYS_EAGER=True
+)
+class WebhookIngestionTests(TestCase):
+    def setUp(self):
+        from rest_framework.test import APIClient
+
+        self.client = APIClient()
+        self.pharmacy = make_pharmacy("hook@x.com", "LIC-HOOK")
+        self.order = Order.objects.create(
+            user=self.pharmacy.user,
+            subtotal=Decimal("30.00"),
+            total_amount=Decimal("30.00"),
+        )
+        self.payment = Payment.objects.create(
+            user=self.pharmacy.user, order=self.order, amount=Decimal("30.00")
+        )
+
+    def post(self, event, data):
+        import hashlib
+        import hmac
+        import json
+
+        body = json.dumps({"event": event, "data": data}).encode()
+        signature = hmac.new(b"sk_test_webhook", body, hashlib.sha512).hexdigest()
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                "/pharmacies/paystack/webhook/",
+                body,
+                content_type="application/json",
+                HTTP_X_PAYSTACK_SIGNATURE=signature,
+            )
+        self.assertEqual(response.status_code, 200)
+
+    def charge(self):
+        return {
+            "reference": self.payment.reference,
+            "status": "success",
+            "amount": self.payment.amount_value(),
+            "currency": "GHS",
+        }
+
+    def test_event_is_stored_once_and_applied(self):
+        self.post("charge.success", self.charge())
+        self.post("charge.success", self.charge())
+
+        callback = CallBackData.objects.get()
+        self.assertEqual(callback.status, CallBackData.Status.PROCESSED)
+        self.assertEqual(callback.attempts, 1)
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.payment_status, Order.PaymentStatus.PAID)
+
+    def test_failed_event_holds_back_later_events_until_replayed(self):
+        with patch(
+            "pharmacies.webhook_service.payment_service.apply_charge_event",
+            side_effect=RuntimeError("db down"),
+        ):
+            self.post("charge.success", self.charge())
+        failed = CallBackData.objects.get()
+        self.assertEqual(
+            (failed.status, failed.last_error), (CallBackData.Status.FAILED, "db down")
+        )
+
+        with patch("pharmacies.webhook_service.dispatch_event") as dispatch:
+            self.post("charge.failed", self.charge())
+            self.assertEqual(
+                [call.args[0] for call in dispatch.call_args_list],
+                ["charge.success", "charge.failed"],
+            )
+
+        CallBackData.objects.update(status=CallBackData.Status.FAILED)
+        out = StringIO()
+        call_command("replay_webhooks", stdout=out)
+        self.assertIn("Replayed 2 event(s), 2 applied", out.getvalue())
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.payment_status, Order.PaymentStatus.PAID)
+
+    def test_invalid_signature_is_not_stored(self):
+        response = self.client.post(
+            "/pharmacies/paystack/webhook/",
+            {"event": "charge.success", "data": self.charge()},
+            format="json",
+            HTTP_X_PAYSTACK_SIGNATURE="forged",
+        )
+        self.assertEqual(response.status_code, 401)
+        self.assertFalse(CallBackData.objects.exists())
+
+
+@override_settings(CELERY_TASK_ALWAYS_EAGER=True, AWS_EMAIL_URL="http://mail.test/send")
+class ExpiryAlertTests(TestCase):
+    def setUp(self):
+        self.today = timezone.localdate()
+        self.pharmacies = [
+            make_pharmacy(f"expiry{index}@x.com", f"LIC-EXP-{index}")
+            for index in range(3)
+        ]
+        for index, pharmacy in enumerate(self.pharmacies):
+            self.add_batch(pharmacy, f"Drug <{index}> & co", "B-1", days=20)
+            self.add_batch(pharmacy, "Paracetamol", "B-2", days=5)
+            self.add_batch(pharmacy, "Ibuprofen", "B-3", days=60)
+
+    def add_batch(self, pharmacy, name, batch_number, days):
+        category, _ = DrugCategory.objects.get_or_create(
+            pharmacy=pharmacy, name=f"Expiry {pharmacy.pharmacy_license}"
+        )
+        drug, _ = Drug.objects.get_or_create(
+            pharmacy=pharmacy,
+            name=name,
+            defaults={
+                "category": category,
+                "base_unit": DrugUnit.TABLET,
+                "unit_price": Decimal("1.00"),
+            },
+        )
+        return DrugBatch.objects.create(
+            pharmacy=pharmacy,
+            drug=drug,
+            batch_number=batch_number,
+            expiry_date=self.today + timedelta(days=days),
+        )
+
+    def run_alerts(self):
+        with patch("accounts.tasks.requests.post") as post:
+            counts = send_expiry_alerts()
+        sent = [call.kwargs["json"] for call in post.call_args_list]
+        return counts, {mail["recipient"]: mail["body"] for mail in sent}
+
+    def test_alert_lists_expiring_batches_soonest_first(self):
+        self.pharmacies[2].user.is_active = False
+        self.pharmacies[2].user.save()
+
+        counts, sent = self.run_alerts()
+
+        self.assertEqual(counts, {"sent": 2, "unchanged": 0, "no_email": 0})
+        self.assertEqual(set(sent), {"expiry0@x.com", "expiry1@x.com"})
+        body = sent["expiry0@x.com"]
+        self.assertIn("Drug &lt;0&gt; &amp; co", body)
+        self.assertLess(body.index("Paracetamol"), body.index("Drug &lt;0&gt;"))
+        self.assertNotIn("Ibuprofen", body)
+
+    def test_unchanged_alert_is_not_resent_until_due(self):
+        self.run_alerts()
+        counts, sent = self.run_alerts()
+        self.assertEqual((counts["sent"], counts["unchanged"], sent), (0, 3, {}))
+
+        self.add_batch(self.pharmacies[1], "Paracetamol", "B-4", days=10)
+        counts, sent = self.run_alerts()
+        self.assertEqual(list(sent), ["expiry1@x.com"])
+        self.assertIn("B-4", sent["expiry1@x.com"])
+
+        ExpiryAlertDigest.objects.filter(pharmacy=self.pharmacies[0]).update(
+            sent_at=timezone.now() - timedelta(days=8)
+        )
+        counts, sent = self.run_alerts()
+        self.assertEqual(list(sent), ["expiry0@x.com"])
+
+    def test_failed_mail_is_sent_again_next_run(self):
+        def post(url, json, headers):
+            if json["recipient"] == "expiry1@x.com":
+                raise ConnectionError("mail service down")
+            return Mock(text="queued")
+
+        with patch("accounts.tasks.requests.post", side_effect=post):
+            send_expiry_alerts()
+        self.assertEqual(
+            set(ExpiryAlertDigest.objects.values_list("pharmacy", flat=True)),
+            {self.pharmacies[0].pk, self.pharmacies[2].pk},
+        )
+
+        counts, sent = self.run_alerts()
+        self.assertEqual((counts["sent"], list(sent)), (1, ["expiry1@x.com"]))
+
+    def test_query_count_does_not_grow_with_pharmacies(self):
+        def queries():
+            ExpiryAlertDigest.objects.all().delete()
+            with patch("accounts.tasks.requests.post"):
+                with CaptureQueriesContext(connection) as ctx:
+                    send_expiry_alerts()
+            return len(ctx.captured_queries)
+
+        few = queries()
+        for index in range(3, 8):
+            pharmacy = make_pharmacy(f"expiry{index}@x.com", f"LIC-EXP-{index}")
+            self.add_batch(pharmacy, "Paracetamol", "B-2", days=5)
+        self.assertEqual(queries(), few)
+
+
+class StockLevelTests(TestCase):
+    def setUp(self):
+        self.pharmacy = make_pharmacy("stock@x.com", "LIC-STK")
+        category = DrugCategory.objects.create(pharmacy=self.pharmacy, name="Stock")
+        self.drug = Drug.objects.create(
+            pharmacy=self.pharmacy,
+            name="Amoxicillin",
+            category=category,
+            base_unit=DrugUnit.CAPSULE,
+            unit_price=Decimal("2.50"),
+        )
+        today = timezone.localdate()
+        self.batch = DrugBatch.objects.create(
+            pharmacy=self.pharmacy,
+            drug=self.drug,
+            batch_number="B-1",
+            expiry_date=today + timedelta(days=90),
+        )
+
+    def move(self, batch, quantity, reason=StockMovement.Reason.RESTOCK):
+        return StockMovement.objects.create(
+            pharmacy=self.pharmacy,
+            drug=self.drug,
+            batch=batch,
+            quantity=quantity,
+            reason=reason,
+        )
+
+    def available(self, today=None):
+        return annotate_stock(Drug.objects.filter(pk=self.drug.pk), today).get()
+
+    def test_movements_update_batch_and_drug_levels(self):
+        self.move(self.batch, 50)
+        self.move(self.batch, -8, StockMovement.Reason.SALE)
+
+        self.assertEqual(BatchStockLevel.objects.get(batch=self.batch).quantity, 42)
+        level = DrugStockLevel.objects.get(drug=self.drug)
+        self.assertEqual(level.available_quantity, 42)
+        self.assertEqual(level.nearest_expiry, self.batch.expiry_date)
+        self.assertEqual(self.available().available_quantity, 42)
+
+    def test_editing_and_deleting_a_movement_adjusts_levels(self):
+        movement = self.move(self.batch, 20)
+        movement.quantity = 15
+        movement.save()
+        self.assertEqual(self.available().available_quantity, 15)
+
+        movement.delete()
+        self.assertEqual(self.available().available_quantity, 0)
+
+    def test_expired_batch_drops_out_before_refresh(self):
+        today = timezone.localdate()
+        short = DrugBatch.objects.create(
+            pharmacy=self.pharmacy,
+            drug=self.drug,
+            batch_number="B-SHORT",
+            expiry_date=today + timedelta(days=1),
+        )
+        self.move(self.batch, 10)
+        self.move(short, 5)
+        self.assertEqual(self.available().available_quantity, 15)
+
+        # Two days later the short batch has expired but the roll-up is stale;
+        # readers must fall back to the batch levels.
+        later = today + timedelta(days=2)
+        drug = self.available(later)
+        self.assertEqual(drug.available_quantity, 10)
+        self.assertEqual(drug.nearest_expiry, self.batch.expiry_date)
+
+    def test_rebuild_command_verifies_and_repairs_drift(self):
+        self.move(self.batch, 30)
+        BatchStockLevel.objects.filter(batch=self.batch).update(quantity=999)
+        DrugStockLevel.objects.filter(drug=self.drug).update(available_quantity=999)
+
+        with self.assertRaises(Exception):
+            call_command("rebuild_stock_levels", "--verify", stdout=StringIO())
+
+        call_command("rebuild_stock_levels", stdout=StringIO())
+        self.assertEqual(BatchStockLevel.objects.get(batch=self.batch).quantity, 30)
+        self.assertEqual(self.available().available_quantity, 30)
+
+
+class StockedPharmacyTestCase(TestCase):
+    def setUp(self):
+        self.pharmacy = make_pharmacy("checkout@x.com", "LIC-CHK")
+        self.buyer = CustomUser.objects.create(
+            username="buyer@x.com", email="buyer@x.com"
+        )
+        self.category = DrugCategory.objects.create(pharmacy=self.pharmacy, name="Chk")
+        self.today = timezone.localdate()
+
+    def stocked_drug(self, name, *batches):
+        """batches: (days_to_expiry, quantity) pairs."""
+        drug = Drug.objects.create(
+            pharmacy=self.pharmacy,
+            name=name,
+            category=self.category,
+            base_unit=DrugUnit.TABLET,
+            unit_price=Decimal("4.00"),
+        )
+        for index, (days, quantity) in enumerate(batches):
+            batch = DrugBatch.objects.create(
+                pharmacy=self.pharmacy,
+                drug=drug,
+                batch_number=f"{name}-{index}",
+                expiry_date=self.today + timedelta(days=days),
+            )
+            StockMovement.objects.create(
+                pharmacy=self.pharmacy,
+                drug=drug,
+                batch=batch,
+                quantity=quantity,
+                reason=StockMovement.Reason.RESTOCK,
+            )
+        return drug
+
+
+@override_settings(
+    CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+)
+class StockAlertTests(StockedPharmacyTestCase):
+    def setUp(self):
+        super().setUp()
+        self.drug = self.stocked_drug("Metformin")
+        self.batch = DrugBatch.objects.create(
+            pharmacy=self.pharmacy,
+            drug=self.drug,
+            batch_number="MET-1",
+            expiry_date=self.today + timedelta(days=90),
+        )
+
+    def move(self, quantity, reason=StockMovement.Reason.SALE):
+        return StockMovement.objects.create(
+            pharmacy=self.pharmacy,
+            drug=self.drug,
+            batch=self.batch,
+            quantity=quantity,
+            reason=reason,
+        )
+
+    def alerts(self):
+        return list(
+            StockAlert.objects.order_by("created_at").values_list(
+                "previous_status", "stock_status", "available_quantity"
+            )
+        )
+
+    def test_crossings_are_recorded_once(self):
+        self.move(15, StockMovement.Reason.RESTOCK)
+        self.move(-3)
+        self.move(-4)
+        self.move(-2)
+        self.move(-6)
+
+        self.assertEqual(
+            self.alerts(),
+            [
+                ("OUT_OF_STOCK", "IN_STOCK", 15),
+                ("IN_STOCK", "LOW_STOCK", 8),
+                ("LOW_STOCK", "OUT_OF_STOCK", 0),
+            ],
+        )
+        self.assertEqual(
+            self.drug.stock_level.stock_status, DrugStockLevel.StockStatus.OUT_OF_STOCK
+        )
+
+    def test_threshold_change_is_a_crossing(self):
+        self.move(15, StockMovement.Reason.RESTOCK)
+        self.drug.low_stock_threshold = 20
+        self.drug.save(update_fields=["low_stock_threshold"])
+        self.assertEqual(self.alerts()[-1], ("IN_STOCK", "LOW_STOCK", 15))
+
+    def test_unchanged_threshold_is_not_rechecked(self):
+        self.move(15, StockMovement.Reason.RESTOCK)
+        drug = Drug.objects.get(pk=self.drug.pk)
+        with self.assertNumQueries(1):
+            drug.save(update_fields=["low_stock_threshold"])
+        drug.low_stock_threshold = 20
+        with self.assertNumQueries(4):
+            drug.save(update_fields=["low_stock_threshold"])
+        self.assertEqual(self.alerts()[-1], ("IN_STOCK", "LOW_STOCK", 15))
+
+    def test_dashboard_lists_drugs_never_stocked_as_out_of_stock(self):
+        from rest_framework.test import APIClient
+
+        self.move(15, StockMovement.Reason.RESTOCK)
+        self.stocked_drug("Amlodipine")
+
+        client = APIClient()
+        client.force_authenticate(user=self.pharmacy.user)
+        data = client.get("/pharmacies/dashboard-statistics/").data
+        self.assertEqual(data["low_stock_alerts"]["count"], 1)
+        self.assertEqual(
+            [
+                (item["drug_name"], item["quantity_left"])
+                for item in data["low_stock_alerts"]["items"]
+            ],
+            [("Amlodipine", 0)],
+        )
+
+    def test_alert_is_pushed_on_commit_and_listed_on_dashboard(self):
+        from asgiref.sync import async_to_sync
+        from channels.layers import get_channel_layer
+        from rest_framework.test import APIClient
+
+        layer = get_channel_layer()
+        channel = async_to_sync(layer.new_channel)()
+        async_to_sync(layer.group_add)(stock_alert_group(self.pharmacy.pk), channel)
+
+        self.move(15, StockMovement.Reason.RESTOCK)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.move(-10)
+        event = async_to_sync(layer.receive)(channel)
+        self.assertEqual(event["type"], "stock.alert")
+        self.assertEqual(
+            (event["alert"]["drug_name"], event["alert"]["stock_status"]),
+            ("Metformin", "LOW_STOCK"),
+        )
+
+        client = APIClient()
+        client.force_authenticate(user=self.pharmacy.user)
+        data = client.get("/pharmacies/dashboard-statistics/").data
+        self.assertEqual(data["low_stock_alerts"]["count"], 1)
+        self.assertEqual(data["low_stock_alerts"]["items"][0]["quantity_left"], 5)
+        response = client.get(
+            "/pharmacies/stock-alerts/", {"stock_status": "LOW_STOCK"}
+        )
+        self.assertEqual(response.data["count"], 1)
+
+
+class PlaceOrderTests(StockedPharmacyTestCase):
+    def test_sells_earliest_expiry_first_across_batches(self):
+        drug = self.stocked_drug("Ibuprofen", (60, 10), (20, 3), (-1, 50))
+
+        order = place_order(self.buyer, [{"drug": drug.id, "quantity": 5}], "pickup")
+
+        self.assertEqual(order.total_amount, Decimal("20.00"))
+        self.assertEqual(order.pharmacy_orders.count(), 1)
+        sales = dict(
+            StockMovement.objects.filter(reason=StockMovement.Reason.SALE).values_list(
+                "batch__batch_number", "quantity"
+            )
+        )
+        self.assertEqual(sales, {"Ibuprofen-1": -3, "Ibuprofen-0": -2})
+        self.assertEqual(DrugStockLevel.objects.get(drug=drug).available_quantity, 8)
+
+    def test_insufficient_stock_rejects_whole_order(self):
+        plenty = self.stocked_drug("Plenty", (30, 100))
+        scarce = self.stocked_drug("Scarce", (30, 2))
+
+        with self.assertRaises(exceptions.InsufficientStockException):
+            place_order(
+                self.buyer,
+                [
+                    {"drug": plenty.id, "quantity": 1},
+                    {"drug": scarce.id, "quantity": 3},
+                ],
+                "pickup",
+            )
+
+        self.assertFalse(Order.objects.filter(user=self.buyer).exists())
+        self.assertEqual(
+            DrugStockLevel.objects.get(drug=plenty).available_quantity, 100
+        )
+
+    def test_unknown_drug_is_rejected(self):
+        drug = self.stocked_drug("Known", (30, 5))
+        with self.assertRaises(exceptions.GeneralException):
+            place_order(
+                self.buyer,
+                [
+                    {"drug": drug.id, "quantity": 1},
+                    {"drug": self.pharmacy.id, "quantity": 1},
+                ],
+                "pickup",
+            )
+
+    def test_query_count_does_not_grow_with_cart_size(self):
+        drugs = [self.stocked_drug(f"D{i}", (30, 5), (40, 5)) for i in range(12)]
+
+        def count_queries(cart):
+            with CaptureQueriesContext(connection) as ctx:
+                place_order(self.buyer, cart, "pickup")
+            return len(ctx.captured_queries)
+
+        small = count_queries([{"drug": drugs[0].id, "quantity": 1}])
+        large = count_queries([{"drug": drug.id, "quantity": 7} for drug in drugs[1:]])
+        self.assertEqual(small, large)
+
+
+class BatchAllocationTests(StockedPharmacyTestCase):
+    def batch_quantities(self, drug):
+        return dict(
+            BatchStockLevel.objects.filter(drug=drug).values_list(
+                "batch__batch_number", "quantity"
+            )
+        )
+
+    def test_adjustment_splits_across_batches_fefo(self):
+        drug = self.stocked_drug("Split", (90, 10), (10, 4), (30, 4))
+
+        movements = deduct_stock(drug, 10, StockMovement.Reason.ADJUSTMENT)
+
+        self.assertEqual([m.quantity for m in movements], [-4, -4, -2])
+        self.assertEqual(
+            self.batch_quantities(drug), {"Split-0": 8, "Split-1": 0, "Split-2": 0}
+        )
+
+    def test_insufficient_stock_writes_nothing(self):
+        drug = self.stocked_drug("Short", (30, 3))
+        with self.assertRaises(exceptions.InsufficientStockException):
+            deduct_stock(drug, 4, StockMovement.Reason.EXPIRED)
+        self.assertEqual(self.batch_quantities(drug), {"Short-0": 3})
+
+    def test_return_goes_back_to_the_batches_sold_from(self):
+        drug = self.stocked_drug("Back", (10, 2), (20, 2), (90, 5))
+        order = place_order(self.buyer, [{"drug": drug.id, "quantity": 3}], "pickup")
+
+        return_stock(drug, 4, sold_note=f"Order {order.order_number}")
+
+        # 1 unit back to Back-1 (all it gave), 2 to Back-0, the extra unit to
+        # the latest-expiring batch.
+        self.assertEqual(
+            self.batch_quantities(drug), {"Back-0": 2, "Back-1": 2, "Back-2": 6}
+        )
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+)
+class DrugMatcherTests(StockedPharmacyTestCase):
+    def setUp(self):
+        super().setUp()
+        names = [
+            "Paracetamol 500mg Tablets",
+            "Paracetamol 1000mg Tablets",
+            "Amoxicillin 250mg Capsules",
+            "Metronidazole 200mg",
+            "Vitamin C",
+        ]
+        self.drugs = {name: self.stocked_drug(name, (30, 5)).id for name in names}
+
+    def test_normalization_drops_forms_and_resolves_aliases(self):
+        self.assertEqual(normalize_name("PANADOL 500 mg Tabs"), "paracetamol 500")
+        self.assertEqual(normalize_name("Co-Amoxiclav"), "co amoxiclav")
+
+    def test_matches_are_ranked(self):
+        index = get_drug_index(self.pharmacy.pk)
+        matches = index.match_many(
+            ["Panadol 500mg", "paracetamol", "Amoxil", "Metronidazol", "Insulin"]
+        )
+
+        self.assertEqual(
+            matches["Panadol 500mg"][0], (self.drugs["Paracetamol 500mg Tablets"], 1.0)
+        )
+        # Both strengths contain "paracetamol"; neither is an exact match.
+        self.assertEqual(len(matches["paracetamol"]), 2)
+        self.assertLess(matches["paracetamol"][0][1], 1.0)
+        self.assertEqual(
+            matches["Amoxil"][0][0], self.drugs["Amoxicillin 250mg Capsules"]
+        )
+        # Misspelling falls through to trigram similarity.
+        self.assertEqual(
+            matches["Metronidazol"][0][0], self.drugs["Metronidazole 200mg"]
+        )
+        self.assertEqual(matches["Insulin"], [])
+
+    def test_prescription_falls_back_to_a_match_the_view_holds(self):
+        from patients.models import PatientProfile, Prescription, Visitation
+        from rest_framework.test import APIClient
+
+        patient = PatientProfile.objects.create(
+            user=self.buyer, first_name="Ama", patient_id="rx-patient"
+        )
+        visitation = Visitation.objects.create(patient=patient, title="Fever")
+        Prescription.objects.create(visitation=visitation, medication="Paracetamol")
+        # Both strengths match; the top-ranked one leaves the expiring filter.
+        (top, _), (runner_up, _) = get_drug_index(self.pharmacy.pk).match("Paracetamol")
+        DrugStockLevel.objects.filter(drug_id=top).update(
+            nearest_expiry=self.today + timedelta(days=90)
+        )
+
+        client = APIClient()
+        client.force_authenticate(user=self.pharmacy.user)
+        response = client.post(
+            "/pharmacies/inventory/get-prescription/?expiry_filter=expiring_soon",
+            {"prescription_code": visitation.prescription_code},
+            format="json",
+        )
+
+        self.assertEqual(response.status_code, 200)
+        available = response.data["available_drugs"]
+        self.assertEqual([drug["id"] for drug in available], [str(runner_up)])
+
+    def test_cached_index_is_rebuilt_after_a_drug_save(self):
+        self.assertEqual(get_drug_index(self.pharmacy.pk).match("Ibuprofen"), [])
+        # Served from cache: only the fingerprint query runs.
+        with self.assertNumQueries(1):
+            get_drug_index(self.pharmacy.pk)
+
+        drug = self.stocked_drug("Ibuprofen 400mg", (30, 5))
+
+        matches = get_drug_index(self.pharmacy.pk).match("Ibuprofen")
+        self.assertEqual(matches[0][0], drug.id)
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+)
+class CartValidationTests(StockedPharmacyTestCase):
+    def line(self, drug, quantity, price=None, pharmacy_id=None):
+        return {
+            "drug_id": str(drug.id),
+            "pharmacy_id": str(pharmacy_id or drug.pharmacy_id),
+            "quantity": quantity,
+            "unit_price": Decimal(price) if price else drug.unit_price,
+        }
+
+    def test_each_line_is_diffed_in_one_query(self):
+        fine = self.stocked_drug("Fine", (30, 10))
+        repriced = self.stocked_drug("Repriced", (30, 10))
+        scarce = self.stocked_drug("Scarce", (30, 2))
+        empty = self.stocked_drug("Empty")
+        cart = {
+            "version": 3,
+            "items": [
+                self.line(fine, 2),
+                self.line(repriced, 1, price="3.00"),
+                self.line(scarce, 5),
+                self.line(empty, 1),
+                self.line(fine, 1, pharmacy_id=uuid.uuid4()),
+            ],
+        }
+
+        with self.assertNumQueries(1):
+            result = revalidate_cart(cart)
+
+        self.assertFalse(result["valid"])
+        self.assertEqual(
+            [line["issues"] for line in result["lines"]],
+            [
+                [],
+                [LineIssue.PRICE_CHANGED],
+                [LineIssue.INSUFFICIENT_STOCK],
+                [LineIssue.OUT_OF_STOCK],
+                [LineIssue.UNAVAILABLE],
+            ],
+        )
+        self.assertEqual(result["lines"][1]["current_unit_price"], Decimal("4.00"))
+        self.assertEqual(result["total_amount"], Decimal("36.00"))
+
+    def test_unverified_pharmacy_and_cached_result(self):
+        drug = self.stocked_drug("Pending", (30, 10))
+        PharmacyProfile.objects.filter(pk=self.pharmacy.pk).update(is_verified=False)
+        cart = {"version": 7, "items": [self.line(drug, 1)]}
+
+        result = get_cart_validation("user-1", cart)
+        self.assertEqual(result["lines"][0]["issues"], [LineIssue.PHARMACY_UNVERIFIED])
+        with self.assertNumQueries(0):
+            self.assertEqual(get_cart_validation("user-1", cart), result)
+
+    def test_cleared_cart_is_not_served_the_old_validation(self):
+        first = self.stocked_drug("First", (30, 10))
+        second = self.stocked_drug("Second", (30, 10))
+        user_id = f"validation-{uuid.uuid4()}"
+        self.addCleanup(CartService.clear_cart, user_id)
+
+        def add(drug):
+            return CartService.add_item(
+                user_id,
+                str(drug.pharmacy_id),
+                "Pharmacy",
+                str(drug.id),
+                drug.name,
+                1,
+                drug.unit_price,
+            )
+
+        before = get_cart_validation(user_id, add(first))
+        CartService.clear_cart(user_id)
+        cart = add(second)
+        self.assertEqual(cart["version"], before["version"])
+
+        result = get_cart_validation(user_id, cart)
+        self.assertEqual(
+            [line["drug_id"] for line in result["lines"]], [str(second.id)]
+        )
+
+
+class StockHistoryTests(StockedPharmacyTestCase):
+    def setUp(self):
+        super().setUp()
+        from rest_framework.test import APIClient
+
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.pharmacy.user)
+
+    def restock(self, drug, quantity):
+        StockMovement.objects.create(
+            pharmacy=self.pharmacy,
+            drug=drug,
+            batch=drug.batches.first(),
+            quantity=quantity,
+            reason=StockMovement.Reason.RESTOCK,
+        )
+
+    def fetch(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response.data, len(queries)
+
+    def test_previous_quantity_and_balance_count_hidden_sales(self):
+        drug = self.stocked_drug("Ibuprofen", (60, 10))
+        deduct_stock(drug, 3, StockMovement.Reason.ADJUSTMENT)
+        place_order(self.buyer, [{"drug": drug.id, "quantity": 2}], "pickup")
+        self.restock(drug, 5)
+
+        data, _ = self.fetch(f"/pharmacies/inventory/{drug.id}/history/")
+
+        self.assertEqual(
+            [
+                (row["quantity"], row["previsous_quantity"], row["balance"])
+                for row in data
+            ],
+            [(5, -2, 10), (-3, 10, 7), (10, None, 10)],
+        )
+
+    def test_query_count_is_constant_and_cursor_walks_every_row(self):
+        drug = self.stocked_drug("Ibuprofen", (60, 1))
+        url = f"/pharmacies/inventory/{drug.id}/history/"
+        _, small = self.fetch(url)
+        for quantity in range(2, 13):
+            self.restock(drug, quantity)
+        data, large = self.fetch(url)
+        self.assertEqual(len(data), 12)
+        self.assertEqual(large, small)
+
+        page, first_page_queries = self.fetch(f"{url}?cursor=&page_size=5")
+        seen = [row["balance"] for row in page["results"]]
+        while page["next"]:
+            page, queries = self.fetch(page["next"])
+            self.assertEqual(queries, first_page_queries)
+            self.assertIsNone(page["previous"])
+            seen.extend(row["balance"] for row in page["results"])
+        self.assertEqual(seen, [row["balance"] for row in data])
+
+
+class KeysetPaginationTests(StockedPharmacyTestCase):
+    def setUp(self):
+        super().setUp()
+        from rest_framework.test import APIClient
+
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.pharmacy.user)
+        self.drug = self.stocked_drug("Ibuprofen", *[(60, n) for n in range(1, 8)])
+        self.newest_first = list(
+            StockMovement.objects.order_by("-created_at", "-id").values_list(
+                "quantity", flat=True
+            )
+        )
+
+    def get(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_cursor_pages_walk_forward_and_back(self):
+        page = self.get("/pharmacies/stock-movements/?cursor=&page_size=3")
+        self.assertEqual(page["count"], 7)
+        self.assertIsNone(page["previous"])
+        pages = [[row["quantity"] for row in page["results"]]]
+        while page["next"]:
+            page = self.get(page["next"])
+            pages.append([row["quantity"] for row in page["results"]])
+        self.assertEqual(sum(pages, []), self.newest_first)
+        self.assertEqual([len(p) for p in pages], [3, 3, 1])
+
+        page = self.get(page["previous"])
+        self.assertEqual([row["quantity"] for row in page["results"]], pages[1])
+        page = self.get(page["previous"])
+        self.assertEqual([row["quantity"] for row in page["results"]], pages[0])
+        self.assertIsNone(page["previous"])
+
+    def test_count_can_be_skipped_and_page_numbers_still_work(self):
+        page = self.get("/pharmacies/stock-movements/?cursor=&count=false")
+        self.assertNotIn("count", page)
+        self.assertEqual(len(page["results"]), 7)
+
+        page = self.get("/pharmacies/stock-movements/?page=2&page_size=5")
+        self.assertEqual(page["count"], 7)
+        self.assertEqual(len(page["results"]), 2)
+
+    def test_invalid_cursor_is_rejected(self):
+        response = self.client.get("/pharmacies/stock-movements/?cursor=not-a-cursor")
+        self.assertEqual(response.status_code, 404)
+        # Well-formed, but not a (created_at, pk) position.
+        cursor = KeysetPagination(5).encode_cursor("yesterday", "not-a-pk")
+        response = self.client.get(f"/pharmacies/stock-movements/?cursor={cursor}")
+        self.assertEqual(response.status_code, 404)
+
+
+class PharmacyOrderListTests(StockedPharmacyTestCase):
+    def setUp(self):
+        super().setUp()
+        from rest_framework.test import APIClient
+
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.pharmacy.user)
+        self.drug = self.stocked_drug("Ibuprofen", (60, 100))
+        other = make_pharmacy("other@x.com", "LIC-OTH")
+        self.other_drug = Drug.objects.create(
+            pharmacy=other,
+            name="Other",
+            category=DrugCategory.objects.create(pharmacy=other, name="Oth"),
+            unit_price=Decimal("9.00"),
+        )
+
+    def place(self, buyer):
+        order = place_order(buyer, [{"drug": self.drug.id, "quantity": 1}], "pickup")
+        OrderItem.objects.create(
+            order=order,
+            drug=self.other_drug,
+            quantity=1,
+            unit_price=self.other_drug.unit_price,
+            total_price=self.other_drug.unit_price,
+        )
+        PharmacyOrder.objects.create(
+            pharmacy=self.other_drug.pharmacy,
+            order=order,
+            status=PharmacyOrder.Status.CONFIRMED,
+        )
+        return order
+
+    def fetch(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get("/pharmacies/orders/?page_size=50")
+        self.assertEqual(response.status_code, 200)
+        return response.data, len(queries)
+
+    def test_rows_only_carry_the_pharmacys_share(self):
+        self.place(self.buyer)
+        data, _ = self.fetch()
+        (row,) = data["orders"]
+        self.assertEqual([item["drug_name"] for item in row["items"]], ["Ibuprofen"])
+        self.assertEqual(row["items"][0]["status"], PharmacyOrder.Status.PENDING)
+        self.assertEqual(row["user"]["id"], str(self.buyer.id))
+
+    def test_query_budget_does_not_grow_with_page_size(self):
+        self.place(self.buyer)
+        _, baseline = self.fetch()
+        for index in range(10):
+            buyer = CustomUser.objects.create(
+                username=f"b{index}@x.com", email=f"b{index}@x.com"
+            )
+            self.place(buyer)
+
+        data, queries = self.fetch()
+        self.assertEqual(len(data["orders"]), 11)
+        self.assertEqual(queries, baseline)
+        with self.assertNumQueries(baseline):
+            self.client.get("/pharmacies/orders/?page_size=50")
+
+
+class DashboardRollupTests(StockedPharmacyTestCase):
+    def rollup(self, day=None):
+        return PharmacyDailyStats.objects.values(
+            "orders_count", "revenue", "units_sold"
+        ).get(pharmacy=self.pharmacy, date=day or self.today)
+
+    def test_rollups_follow_the_order_lifecycle(self):
+        drug = self.stocked_drug("Ibuprofen", (60, 10))
+
+        order = place_order(self.buyer, [{"drug": drug.id, "quantity": 2}], "pickup")
+        self.assertEqual(
+            self.rollup(),
+            {"orders_count": 1, "revenue": Decimal("0.00"), "units_sold": 0},
+        )
+
+        order.payment_status = Order.PaymentStatus.PAID
+        order.save()
+        self.assertEqual(
+            self.rollup(),
+            {"orders_count": 1, "revenue": Decimal("8.00"), "units_sold": 2},
+        )
+
+        pharmacy_order = PharmacyOrder.objects.get(order=order)
+        pharmacy_order.status = PharmacyOrder.Status.CANCELLED
+        pharmacy_order.save()
+        self.assertEqual(
+            self.rollup(),
+            {"orders_count": 1, "revenue": Decimal("0.00"), "units_sold": 0},
+        )
+
+    def test_backfill_rebuilds_the_same_rollups(self):
+        drug = self.stocked_drug("Ibuprofen", (60, 10))
+        make_paid_order(self.buyer, drug, 3, PharmacyOrder.Status.DELIVERED)
+        make_paid_order(self.buyer, drug, 1, PharmacyOrder.Status.REFUNDED)
+        live = self.rollup()
+
+        PharmacyDailyStats.objects.update(orders_count=0, revenue=0, units_sold=0)
+        backfill_dashboard_rollups(days=2)
+
+        self.assertEqual(self.rollup(), live)
+        self.assertEqual(live["orders_count"], 2)
+        self.assertEqual(live["revenue"], Decimal("12.00"))
+
+    def test_dashboard_reads_rollups(self):
+        from rest_framework.test import APIClient
+
+        client = APIClient()
+        client.force_authenticate(user=self.pharmacy.user)
+        drug = self.stocked_drug("Ibuprofen", (60, 10))
+
+        def fetch():
+            with CaptureQueriesContext(connection) as queries:
+                response = client.get("/pharmacies/dashboard-statistics/")
+            self.assertEqual(response.status_code, 200)
+            return response.data, len(queries)
+
+        make_paid_order(self.buyer, drug, 1, PharmacyOrder.Status.DELIVERED)
+        _, baseline = fetch()
+        for quantity in (2, 3):
+            make_paid_order(self.buyer, drug, quantity, PharmacyOrder.Status.DELIVERED)
+        data, queries = fetch()
+
+        self.assertEqual(queries, baseline)
+        self.assertEqual(data["orders_today"]["count"], 3)
+        self.assertEqual(data["today_revenue"]["amount"], Decimal("24.00"))
+        self.assertEqual(
+            data["monthly_sales_trend"][-1]["total_amount"], Decimal("24.00")
+        )
+
+
+class GeoLookupTests(TestCase):
+    ACCRA = (5.6037, -0.1870)
+
+    def setUp(self):
+        from rest_framework.test import APIClient
+
+        self.client = APIClient()
+        self.client.force_authenticate(
+            user=CustomUser.objects.create(username="geo@x.com", email="geo@x.com")
+        )
+        self.today = timezone.localdate()
+        self.pharmacies = {}
+        for name, point in (
+            ("Accra", (5.6040, -0.1875)),
+            ("Tema", (5.6698, -0.0166)),
+            ("Kumasi", (6.6885, -1.6244)),
+            ("Nowhere", None),
+        ):
+            pharmacy = make_pharmacy(f"{name}@x.com", f"LIC-{name}")
+            pharmacy.pharmacy_name = name
+            if point:
+                pharmacy.latitude, pharmacy.longitude = (Decimal(str(c)) for c in point)
+            pharmacy.save()
+            self.pharmacies[name] = pharmacy
+            category = DrugCategory.objects.create(
+                pharmacy=pharmacy, name=f"Geo {name}"
+            )
+            drug = Drug.objects.create(
+                pharmacy=pharmacy,
+                name=f"Paracetamol {name}",
+                category=category,
+                base_unit=DrugUnit.TABLET,
+                unit_price=Decimal("1.00"),
+            )
+            batch = DrugBatch.objects.create(
+                pharmacy=pharmacy,
+                drug=drug,
+                batch_number=f"GEO-{name}",
+                expiry_date=self.today + timedelta(days=90),
+            )
+            StockMovement.objects.create(
+                pharmacy=pharmacy,
+                drug=drug,
+                batch=batch,
+                quantity=10,
+                reason=StockMovement.Reason.RESTOCK,
+            )
+
+    def nearby(self, **params):
+        lat, lng = self.ACCRA
+        return self.client.get(
+            "/pharmacies/profiles/nearby_pharmacies/",
+            {"lat": lat, "lng": lng, **params},
+        )
+
+    def test_grid_cell_follows_coordinates(self):
+        accra = self.pharmacies["Accra"]
+        self.assertEqual((accra.grid_lat, accra.grid_lng), grid_cell(5.6040, -0.1875))
+        accra.latitude = accra.longitude = None
+        accra.save(update_fields=["latitude", "longitude"])
+        accra.refresh_from_db()
+        self.assertIsNone(accra.grid_lat)
+
+    def test_nearby_radius_and_k_nearest(self):
+        response = self.nearby(radius=30)
+        self.assertEqual(response.status_code, 200)
+        rows = response.data
+        self.assertEqual([p["pharmacy_name"] for p in rows], ["Accra", "Tema"])
+        tema = self.pharmacies["Tema"]
+        self.assertAlmostEqual(
+            rows[1]["distance_km"],
+            haversine_km(*self.ACCRA, tema.latitude, tema.longitude),
+            places=3,
+        )
+        self.assertTrue(rows[0]["public_listing"]["requirements"][1]["done"])
+
+        names = [p["pharmacy_name"] for p in self.nearby(k=3).data]
+        self.assertEqual(names, ["Accra", "Tema", "Kumasi"])
+        self.assertEqual(len(self.nearby(k=1).data), 1)
+
+    def test_nearby_lists_every_located_pharmacy_and_pages_on_request(self):
+        names = [p["pharmacy_name"] for p in self.nearby().data]
+        self.assertEqual(names, ["Accra", "Tema", "Kumasi"])
+
+        def fetch(page_size):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.nearby(page_size=page_size)
+            stock_queries = [
+                q for q in queries.captured_queries if '"drugs"' in q["sql"]
+            ]
+            return response.data, len(stock_queries)
+
+        page, one_row = fetch(1)
+        self.assertEqual(page["count"], 3)
+        self.assertEqual(page["results"][0]["pharmacy_name"], "Accra")
+        self.assertIsNotNone(page["next"])
+        # Stock readiness is annotated on the page query, not queried per pharmacy.
+        page, two_rows = fetch(2)
+        self.assertEqual(len(page["results"]), 2)
+        self.assertEqual((one_row, two_rows), (1, 1))
+
+        self.assertEqual(
+            self.client.get("/pharmacies/profiles/nearby_pharmacies/").status_code, 400
+        )
+        self.assertEqual(self.nearby(radius="far").status_code, 400)
+
+    def test_public_inventory_sorted_and_bounded_by_distance(self):
+        lat, lng = self.ACCRA
+        response = self.client.get("/appapi/v1/inventory/", {"lat": lat, "lng": lng})
+        rows = [
+            (row["pharmacy"]["pharmacy_name"], row["pharmacy_distance_km"])
+            for row in response.data["results"]
+        ]
+        # Within the default radius only: not Kumasi, nor the unlocated pharmacy.
+        self.assertEqual([name for name, _ in rows], ["Accra", "Tema"])
+        self.assertLess(rows[0][1], rows[1][1])
+
+        response = self.client.get(
+            "/appapi/v1/inventory/", {"lat": lat, "lng": lng, "radius": 30}
+        )
+        self.assertEqual(response.data["count"], 2)
+
+        response = self.client.get(
+            "/appapi/v1/inventory/", {"lat": lat, "lng": lng, "k": 1}
+        )
+        self.assertEqual(
+            [row["pharmacy"]["pharmacy_name"] for row in response.data["results"]],
+            ["Accra"],
+        )
+
+        # Nor does a cursor re-order the nearest-first queryset by created_at.
+        params = {"lat": lat, "lng": lng, "radius": 30}
+        nearest_first = self.client.get("/appapi/v1/inventory/", params).data
+        response = self.client.get("/appapi/v1/inventory/", {**params, "cursor": ""})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["results"], nearest_first["results"])
+        self.assertEqual(response.data["count"], 2)
+
+        # The k nearest are a list, so a cursor falls back to page numbers.
+        response = self.client.get(
+            "/appapi/v1/inventory/", {"lat": lat, "lng": lng, "k": 2, "cursor": ""}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["count"], 2)
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+)
+class DrugSearchTests(StockedPharmacyTestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.amoxicillin = self.stocked_drug("Amoxicillin 500mg Capsules", (90, 10))
+        self.paracetamol = self.stocked_drug("Paracetamol", (90, 10))
+        self.syrup = self.stocked_drug("Paracetamol Syrup", (90, 10))
+        self.ibuprofen = self.stocked_drug("Ibuprofen", (90, 10))
+        self.sold_out = self.stocked_drug("Paracetamol Extra")
+
+    def search(self, text):
+        return list(
+            search_drugs(Drug.objects.all(), text).values_list("name", flat=True)
+        )
+
+    def test_prefix_alias_and_ranking(self):
+        self.assertEqual(self.search("amox 500"), ["Amoxicillin 500mg Capsules"])
+        self.assertEqual(
+            self.search("paracetamol"),
+            ["Paracetamol", "Paracetamol Extra", "Paracetamol Syrup"],
+        )
+        self.assertEqual(self.search("panadol")[0], "Paracetamol")
+        self.assertEqual(self.search("tablet cap"), ["Amoxicillin 500mg Capsules"])
+
+    def test_typos_fall_back_to_closest_catalogue_words(self):
+        self.assertEqual(self.search("amoxicilin"), ["Amoxicillin 500mg Capsules"])
+        self.assertEqual(self.search("ibuprofn"), ["Ibuprofen"])
+        self.assertEqual(self.search("zzqx"), [])
+
+    def test_index_follows_drug_and_category_changes(self):
+        self.ibuprofen.name = "Brufen Forte"
+        self.ibuprofen.save()
+        self.category.name = "Analgesics"
+        self.category.save()
+        self.assertEqual(self.search("forte"), ["Brufen Forte"])
+        self.assertEqual(len(self.search("analgesic")), 5)
+
+    def test_public_inventory_search_keeps_stock_and_distance_filters(self):
+        from rest_framework.test import APIClient
+
+        client = APIClient()
+        response = client.get("/appapi/v1/inventory/", {"search": "paracet"})
+        self.assertEqual(
+            [row["name"] for row in response.data["results"]],
+            ["Paracetamol", "Paracetamol Syrup"],
+        )
+
+        # A cursor would re-order by created_at, so relevance keeps page numbers.
+        response = client.get(
+            "/appapi/v1/inventory/", {"search": "paracet", "cursor": ""}
+        )
+        self.assertEqual(
+            [row["name"] for row in response.data["results"]],
+            ["Paracetamol", "Paracetamol Syrup"],
+        )
+        self.assertEqual(response.data["count"], 2)
+
+        response = client.get(
+            "/appapi/v1/inventory/", {"search": "paracet", "ordering": "-name"}
+        )
+        self.assertEqual(
+            [row["name"] for row in response.data["results"]],
+            ["Paracetamol Syrup", "Paracetamol"],
+        )
+
+        self.pharmacy.latitude, self.pharmacy.longitude = Decimal("5.6"), Decimal(
+            "-0.19"
+        )
+        self.pharmacy.save()
+        response = client.get(
+            "/appapi/v1/inventory/",
+            {"search": "paracet", "lat": 5.6, "lng": -0.19, "radius": 5},
+        )
+        self.assertEqual(response.data["count"], 2)
+        response = client.get(
+            "/appapi/v1/inventory/",
+            {"search": "paracet", "lat": 6.7, "lng": -1.6, "radius": 5},
+        )
+        self.assertEqual(response.data["count"], 0)
+
+
+class ConcurrentCheckoutTests(TransactionTestCase):
+    def test_parallel_checkouts_never_oversell(self):
+        pharmacy = make_pharmacy("race@x.com", "LIC-RACE")
+        buyer = CustomUser.objects.create(username="racer@x.com", email="racer@x.com")
+        category = DrugCategory.objects.create(pharmacy=pharmacy, name="Race")
+        drug = Drug.objects.create(
+            pharmacy=pharmacy,
+            name="Contended",
+            category=category,
+            base_unit=DrugUnit.TABLET,
+            unit_price=Decimal("1.00"),
+        )
+        for index in range(2):
+            batch = DrugBatch.objects.create(
+                pharmacy=pharmacy,
+                drug=drug,
+                batch_number=f"R-{index}",
+                expiry_date=timezone.localdate() + timedelta(days=30 + index),
+            )
+            StockMovement.objects.create(
+                pharmacy=pharmacy,
+                drug=drug,
+                batch=batch,
+                quantity=5,
+                reason=StockMovement.Reason.RESTOCK,
+            )
+
+        def checkout(_):
+            try:
+                place_order(buyer, [{"drug": drug.id, "quantity": 3}], "pickup")
+                return True
+            except exceptions.InsufficientStockException:
+                return False
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=6) as pool:
+            placed = sum(pool.map(checkout, range(6)))
+
+        self.assertEqual(placed, 3)
+        self.assertEqual(DrugStockLevel.objects.get(drug=drug).available_quantity, 1)
+        self.assertFalse(BatchStockLevel.objects.filter(quantity__lt=0).exists())
+
+
+@skipUnless(redis_available(), "Redis is not reachable")
+class CartServiceTests(TestCase):
+    def setUp(self):
+        self.user_id = str(uuid.uuid4())
+        self.addCleanup(CartService.clear_cart, self.user_id)
+
+    def add(self, drug_id, quantity, price, pharmacy_id="p1"):
+        return CartService.add_item(
+            user_id=self.user_id,
+            pharmacy_id=pharmacy_id,
+            pharmacy_name=f"Pharmacy {pharmacy_id}",
+            drug_id=drug_id,
+            drug_name=f"Drug {drug_id}",
+            quantity=quantity,
+            unit_price=Decimal(price),
+        )
+
+    def test_totals_track_every_write(self):
+        self.add("d1", 2, "3.50")
+        self.add("d2", 1, "10.00", pharmacy_id="p2")
+        cart = self.add("d1", 3, "9.99")  # re-adding keeps the original price
+
+        self.assertEqual([i["drug_id"] for i in cart["items"]], ["d1", "d2"])
+        self.assertEqual(cart["items"][0]["quantity"], 5)
+        self.assertEqual(cart["items"][0]["subtotal"], Decimal("17.50"))
+        self.assertEqual(cart["total_items"], 6)
+        self.assertEqual(cart["total_amount"], Decimal("27.50"))
+
+        cart = CartService.update_item_quantity(self.user_id, "p1", "d1", 1)
+        self.assertEqual(cart["total_amount"], Decimal("13.50"))
+        cart = CartService.remove_item(self.user_id, "p2", "d2")
+        self.assertEqual(cart["total_items"], 1)
+        self.assertEqual(cart["total_amount"], Decimal("3.50"))
+
+        CartService.clear_cart(self.user_id, pharmacy_id="p1")
+        cart = CartService.get_cart(self.user_id)
+        self.assertEqual((cart["items"], cart["total_items"]), ([], 0))
+
+    def test_concurrent_adds_are_not_lost(self):
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            list(pool.map(lambda _: self.add("d1", 1, "2.00"), range(40)))
+
+        cart = CartService.get_cart(self.user_id)
+        self.assertEqual(cart["items"][0]["quantity"], 40)
+        self.assertEqual(cart["total_amount"], Decimal("80.00"))
+
+    def test_ttl_is_read_from_redis(self):
+        self.assertIsNone(CartService.get_cart_ttl(self.user_id))
+        self.add("d1", 1, "1.00")
+        get_redis().expire(CartService._get_cart_key(self.user_id), 120)
+        self.assertLessEqual(CartService.get_cart_ttl(self.user_id), 120)
+        self.assertTrue(CartService.refresh_cart_ttl(self.user_id))
+        self.assertGreater(CartService.get_cart_ttl(self.user_id), 120)
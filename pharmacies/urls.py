@@ -27,6 +27,12 @@ router.register(
     basename="stock-movement",
 )
 
+router.register(
+    "stock-alerts",
+    views.StockAlertViewSet,
+    basename="stock-alert",
+)
+
 router.register(
     "payments",
     views.PaymentViewset,
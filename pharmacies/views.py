@@ -1,22 +1,33 @@
+from collections import defaultdict
 from decimal import Decimal
 from datetime import date, datetime, timedelta
 from django.db import transaction
 from django.http import HttpRequest
 from rest_framework import viewsets, permissions, filters, status
-from rest_framework.pagination import PageNumberPagination
+from rest_framework.pagination import CursorPagination
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework.views import APIView
+from config.pagination import DefaultPagination
 from helpers import exceptions
 from pharmacies.permissions import PharmacyProfileRequired
+from .batch_allocation import deduct_stock, return_stock
 from .cart_service import CartService
+from .dashboard_service import daily_stats_since
+from .drug_matcher import get_drug_index
+from .geo_service import by_distance, location_query
+from .order_service import place_order
 from .filters import OrderFilter
 from .settlement_service import (
+    annotate_settlements,
+    settlement_orders_prefetch,
+    settlement_summary,
     sync_settlement_for_pharmacy_date,
 )
 from . import payout_service
-from . import payment_service
+from . import webhook_service
+from .stock_service import annotate_has_stock, annotate_stock, movement_history
 from .models import (
     DrugBatch,
     DrugSupplier,
@@ -24,6 +35,8 @@ from .models import (
     PharmacyOrder,
     PharmacyProfile,
     Drug,
+    DrugStockLevel,
+    StockAlert,
     StockMovement,
     DrugCategory,
     Order,
@@ -40,12 +53,14 @@ from .serializers import (
     DrugBatchSerializer,
     DrugSerializer,
     GetPrescriptionSerializer,
+    NearbyPharmacySerializer,
     PaymentMethodSerializer,
     PaymentMethodCreateSerializer,
     PharmacyProfileSerializer,
     DrugInventorySerializer,
     DrugStockHistorySerializer,
     DrugCategorySerializer,
+    StockAlertSerializer,
     StockMovementCreateSerializer,
     StockMovementSerializer,
     SupplierSerializer,
@@ -62,7 +77,6 @@ from .serializers import (
 from django.db.models import (
     Q,
     Sum,
-    Min,
     Max,
     Count,
     F,
@@ -70,6 +84,7 @@ from django.db.models import (
     ExpressionWrapper,
     Exists,
     OuterRef,
+    Prefetch,
 )
 from django.db.models.functions import TruncMonth, Coalesce
 from django.utils import timezone
@@ -115,23 +130,50 @@ class PharmacyProfileViewSet(viewsets.ModelViewSet):
         detail=False, methods=["get"], permission_classes=[permissions.IsAuthenticated]
     )
     def nearby_pharmacies(self, request):
-        """Get pharmacies near a location"""
-        latitude = request.query_params.get("lat")
-        longitude = request.query_params.get("lng")
+        """
+        Every located pharmacy, nearest to ?lat=&lng= first, each with its
+        `distance_km`. ?radius= (km) keeps only those within it and ?k=
+        returns just the k nearest. The response is a list, as it always
+        was; passing ?page= or ?page_size= asks for a page of it instead.
+        """
+        try:
+            latitude, longitude, radius, k = location_query(request.query_params)
+        except ValueError:
+            return Response(
+                {"error": "Invalid latitude, longitude, radius or k"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
 
-        if not latitude or not longitude:
+        if latitude is None:
             return Response(
                 {"error": "Latitude and longitude are required"},
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
-        # Simple distance calculation (in production, use PostGIS or similar)
-        queryset = self.get_queryset().filter(
-            latitude__isnull=False, longitude__isnull=False, user__is_active=True
+        queryset = annotate_has_stock(
+            self.get_queryset()
+            .filter(
+                latitude__isnull=False, longitude__isnull=False, user__is_active=True
+            )
+            .select_related("user")
+        )
+        pharmacies = by_distance(
+            queryset, latitude, longitude, radius, k, default_radius_km=None
         )
 
-        serializer = self.get_serializer(queryset, many=True)
-        return Response(serializer.data)
+        paged = {
+            self.paginator.page_query_param,
+            self.paginator.page_size_query_param,
+        } & set(request.query_params)
+        page = self.paginate_queryset(pharmacies) if paged else None
+        serializer = NearbyPharmacySerializer(
+            pharmacies if page is None else page,
+            many=True,
+            context=self.get_serializer_context(),
+        )
+        if page is None:
+            return Response(serializer.data)
+        return self.get_paginated_response(serializer.data)
 
     @action(detail=False, methods=["get"])
     def me(self, request):
@@ -147,6 +189,26 @@ class PharmacyProfileViewSet(viewsets.ModelViewSet):
             )
 
 
+class StockHistoryPagination(CursorPagination):
+    """
+    Keyset pages over a drug's movement history, newest first. Only forward
+    cursors are issued: a page's running balance needs every older movement in
+    the window, and a reverse cursor would bound the query from below.
+    """
+
+    page_size = 50
+    page_size_query_param = "page_size"
+    max_page_size = 200
+    ordering = ("-created_at", "-id")
+
+    def decode_cursor(self, request):
+        cursor = super().decode_cursor(request)
+        return cursor and cursor._replace(reverse=False)
+
+    def get_previous_link(self):
+        return None
+
+
 class InventoryViewSet(viewsets.ReadOnlyModelViewSet):
     """
     ViewSet for managing pharmacy inventory with search, pagination, and ordering
@@ -177,20 +239,9 @@ class InventoryViewSet(viewsets.ReadOnlyModelViewSet):
         thirty_days = today + timedelta(days=30)
         pharmacy = self.request.user.pharmacy_profile
 
-        queryset = (
-            Drug.objects.filter(pharmacy=pharmacy)
-            .annotate(
-                available_quantity=Sum(
-                    "movements__quantity",
-                    filter=Q(movements__batch__expiry_date__gte=today),
-                ),
-                nearest_expiry=Min(
-                    "batches__expiry_date",
-                    filter=Q(batches__expiry_date__gte=today),
-                ),
-            )
-            .select_related("category")
-        )
+        queryset = annotate_stock(
+            Drug.objects.filter(pharmacy=pharmacy), today
+        ).select_related("category")
 
         expiry_filter = self.request.query_params.get("expiry_filter")
         if expiry_filter == "expiring_soon":
@@ -215,12 +266,24 @@ class InventoryViewSet(viewsets.ReadOnlyModelViewSet):
         url_name="history",
     )
     def history(self, request, pk=None):
-        """Confirm an appointment"""
+        """
+        Stock movement history of a drug (sales excluded), newest first, with
+        each movement's previous quantity and running balance. Pass `?cursor=`
+        (empty for the first page) to page through it with keyset cursors.
+        """
         drug = self.get_object()
 
-        history = StockMovement.objects.exclude(
-            reason__in=[StockMovement.Reason.SALE],
-        ).filter(drug=drug)
+        history = movement_history(drug, exclude_reasons=[StockMovement.Reason.SALE])
+
+        if "cursor" in request.query_params:
+            # No view: the inventory's name ordering must not override the cursor's.
+            paginator = StockHistoryPagination()
+            page = paginator.paginate_queryset(history, request)
+            return paginator.get_paginated_response(
+                DrugStockHistorySerializer(
+                    page, many=True, context={"request": request}
+                ).data
+            )
 
         return Response(
             data=DrugStockHistorySerializer(
@@ -379,10 +442,27 @@ class InventoryViewSet(viewsets.ReadOnlyModelViewSet):
             )
 
         # Get prescriptions for that visitation
-        prescriptions = Prescription.objects.filter(visitation=visitation)
-
-        # Get available drugs in pharmacy inventory
-        drug_queryset = self.get_queryset()
+        prescriptions = list(Prescription.objects.filter(visitation=visitation))
+
+        # Resolve every prescribed medication against the pharmacy's cached
+        # name index in one pass, then load only the matched drugs.
+        matches = {}
+        if hasattr(request.user, "pharmacy_profile"):
+            index = get_drug_index(request.user.pharmacy_profile.pk)
+            matches = index.match_many(
+                p.medication.strip() for p in prescriptions if p.medication
+            )
+        # The index covers the whole pharmacy; take each medication's
+        # highest-ranked match that the view's queryset still holds.
+        matched_drugs = self.get_queryset().in_bulk(
+            {drug_id for ranked in matches.values() for drug_id, _ in ranked}
+        )
+        best = {}
+        for medication, ranked in matches.items():
+            for drug_id, score in ranked:
+                if drug_id in matched_drugs:
+                    best[medication] = drug_id, score
+                    break
 
         # Separate available and unavailable drugs
         available_drugs = []
@@ -390,32 +470,16 @@ class InventoryViewSet(viewsets.ReadOnlyModelViewSet):
 
         for prescription in prescriptions:
             medication_name = (
-                prescription.medication.strip().lower()
-                if prescription.medication
-                else ""
+                prescription.medication.strip() if prescription.medication else ""
             )
 
             if not medication_name:
                 continue
 
-            # Try to find matching drug in inventory
             matched_drug = None
-
-            # First, try exact match (case-insensitive)
-            for drug in drug_queryset:
-                if medication_name == drug.name.lower():
-                    matched_drug = drug
-                    break
-
-            # If no exact match, try partial match (medication name in drug name)
-            if not matched_drug:
-                for drug in drug_queryset:
-                    if (
-                        medication_name in drug.name.lower()
-                        or drug.name.lower() in medication_name
-                    ):
-                        matched_drug = drug
-                        break
+            if medication_name in best:
+                drug_id, score = best[medication_name]
+                matched_drug = matched_drugs.get(drug_id)
 
             if matched_drug:
                 # Drug is available in inventory
@@ -423,6 +487,7 @@ class InventoryViewSet(viewsets.ReadOnlyModelViewSet):
                     matched_drug,
                     context={"request": request},
                 ).data
+                drug_data["match_score"] = score
                 # Add prescription details to the drug data
                 drug_data["prescription"] = {
                     "id": prescription.id,
@@ -477,33 +542,29 @@ class DashboardStatisticsView(APIView):
             pharmacy=pharmacy
         ).select_related("order", "order__user")
 
-        orders_today = pharmacy_orders.filter(created_at__date=today).count()
-        orders_yesterday = pharmacy_orders.filter(created_at__date=yesterday).count()
+        month_points = []
+        for offset in range(5, -1, -1):
+            month_num = today.month - offset
+            year_num = today.year
+            while month_num <= 0:
+                month_num += 12
+                year_num -= 1
+            month_points.append((year_num, month_num))
+        first_trend_month = date(month_points[0][0], month_points[0][1], 1)
+
+        # Orders, revenue and the sales trend come from the daily rollups
+        # (one indexed read) instead of aggregating orders on every request.
+        daily = daily_stats_since(pharmacy, min(first_trend_month, yesterday))
+        empty_day = {"orders_count": 0, "revenue": Decimal("0.00")}
+
+        orders_today = daily.get(today, empty_day)["orders_count"]
+        orders_yesterday = daily.get(yesterday, empty_day)["orders_count"]
         pending_orders = pharmacy_orders.filter(
             status=PharmacyOrder.Status.PENDING
         ).count()
 
-        sales_items = (
-            OrderItem.objects.filter(
-                drug__pharmacy=pharmacy,
-                order__payment_status=Order.PaymentStatus.PAID,
-            )
-            .exclude(
-                order__pharmacy_orders__pharmacy=pharmacy,
-                order__pharmacy_orders__status__in=[
-                    PharmacyOrder.Status.CANCELLED,
-                    PharmacyOrder.Status.REFUNDED,
-                ],
-            )
-            .distinct()
-        )
-
-        today_revenue = sales_items.filter(order__created_at__date=today).aggregate(
-            total=Sum("total_price")
-        )["total"] or Decimal("0.00")
-        yesterday_revenue = sales_items.filter(
-            order__created_at__date=yesterday
-        ).aggregate(total=Sum("total_price"))["total"] or Decimal("0.00")
+        today_revenue = daily.get(today, empty_day)["revenue"]
+        yesterday_revenue = daily.get(yesterday, empty_day)["revenue"]
 
         if yesterday_revenue > 0:
             revenue_change_percentage = (
@@ -514,15 +575,9 @@ class DashboardStatisticsView(APIView):
                 Decimal("100.00") if today_revenue > 0 else Decimal("0.00")
             )
 
-        inventory_qs = Drug.objects.filter(pharmacy=pharmacy).annotate(
-            available_quantity=Coalesce(
-                Sum(
-                    "movements__quantity",
-                    filter=Q(movements__batch__expiry_date__gte=today),
-                ),
-                0,
-            )
-        )
+        inventory_qs = annotate_stock(
+            Drug.objects.filter(pharmacy=pharmacy), today
+        ).annotate(available_quantity=Coalesce("available_quantity", 0))
 
         inventory_value = inventory_qs.aggregate(
             total=Sum(
@@ -533,15 +588,30 @@ class DashboardStatisticsView(APIView):
             )
         )["total"] or Decimal("0.00")
 
-        low_stock_qs = inventory_qs.filter(
-            available_quantity__lte=F("low_stock_threshold")
-        ).order_by("available_quantity", "name")
+        # Stock statuses are kept current as stock moves (see stock_service),
+        # so the low-stock list is an indexed read rather than a scan of the
+        # inventory. A drug that never had stock has no level row yet and is
+        # out of stock.
+        low_stock_qs = (
+            Drug.objects.filter(pharmacy=pharmacy)
+            .filter(
+                Q(stock_level__isnull=True)
+                | Q(
+                    stock_level__stock_status__in=[
+                        DrugStockLevel.StockStatus.LOW_STOCK,
+                        DrugStockLevel.StockStatus.OUT_OF_STOCK,
+                    ]
+                )
+            )
+            .annotate(quantity_left=Coalesce("stock_level__available_quantity", 0))
+            .order_by("quantity_left", "name")
+        )
 
         low_stock_alerts = [
             {
                 "drug_id": str(drug.id),
                 "drug_name": drug.name,
-                "quantity_left": drug.available_quantity,
+                "quantity_left": drug.quantity_left,
                 "threshold": drug.low_stock_threshold,
             }
             for drug in low_stock_qs[:4]
@@ -577,28 +647,10 @@ class DashboardStatisticsView(APIView):
                 }
             )
 
-        _ = today.replace(day=1)
-        month_points = []
-        for offset in range(5, -1, -1):
-            month_num = today.month - offset
-            year_num = today.year
-            while month_num <= 0:
-                month_num += 12
-                year_num -= 1
-            month_points.append((year_num, month_num))
-
-        first_trend_month = date(month_points[0][0], month_points[0][1], 1)
-        trend_rows = (
-            sales_items.filter(order__created_at__date__gte=first_trend_month)
-            .annotate(month=TruncMonth("order__created_at"))
-            .values("month")
-            .annotate(total_amount=Sum("total_price"))
-        )
-        trend_map = {
-            (row["month"].year, row["month"].month): row["total_amount"]
-            or Decimal("0.00")
-            for row in trend_rows
-        }
+        trend_map = defaultdict(Decimal)
+        for day, row in daily.items():
+            if day >= first_trend_month:
+                trend_map[(day.year, day.month)] += row["revenue"]
         monthly_sales_trend = [
             {
                 "month": date(year, month, 1).strftime("%b"),
@@ -749,12 +801,61 @@ class StockMovementViewSet(viewsets.ModelViewSet):
 
     def get_queryset(self):
         pharmacy = self.request.user.pharmacy_profile
-        return self.queryset.filter(pharmacy=pharmacy)
+        return self.queryset.filter(pharmacy=pharmacy).select_related(
+            "drug", "batch__drug", "batch__supplier"
+        )
+
+    def create(self, request, *args, **kwargs):
+        """
+        With a `batch`, records that single movement. Without one, a stock-out
+        is split FEFO across the drug's batches (or a return booked onto its
+        latest-expiring batch) and the list of movements written is returned.
+        """
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+        if data.get("batch") is not None:
+            self.perform_create(serializer)
+            return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+        drug = data["drug"]
+        if drug.pharmacy_id != request.user.pharmacy_profile.pk:
+            raise exceptions.GeneralException(detail="Drug not found")
+        if data["reason"] == StockMovement.Reason.RETURN:
+            movements = return_stock(drug, data["quantity"], note=data.get("note", ""))
+        else:
+            movements = deduct_stock(
+                drug, -data["quantity"], data["reason"], note=data.get("note", "")
+            )
+        return Response(
+            StockMovementSerializer(movements, many=True).data,
+            status=status.HTTP_201_CREATED,
+        )
 
     def perform_create(self, serializer):
         serializer.save(pharmacy=self.request.user.pharmacy_profile)
 
 
+class StockAlertViewSet(viewsets.ReadOnlyModelViewSet):
+    """
+    The pharmacy's stock alerts, newest first: each time a drug's stock fell
+    to or below its low-stock threshold, ran out, or recovered. New alerts
+    are also pushed over the ws/pharmacies/stock-alerts/ socket.
+    """
+
+    serializer_class = StockAlertSerializer
+    permission_classes = [PharmacyProfileRequired]
+    filter_backends = [DjangoFilterBackend]
+    filterset_fields = ["stock_status", "drug"]
+
+    def get_queryset(self):
+        return (
+            StockAlert.objects.filter(pharmacy=self.request.user.pharmacy_profile)
+            .select_related("drug")
+            .order_by("-created_at")
+        )
+
+
 class PaymentViewset(viewsets.ModelViewSet):
     queryset = Payment.objects.all()
     serializer_class = PaymentSerializer
@@ -881,12 +982,14 @@ class PaymentViewset(viewsets.ModelViewSet):
         )
 
 
-class SettlementPagination(PageNumberPagination):
+class SettlementPagination(DefaultPagination):
     page_size = 20
     page_size_query_param = "page_size"
     max_page_size = 100
 
     def get_paginated_response(self, data):
+        if self.keyset is not None:
+            return self.keyset.get_paginated_response(data, results_key="settlements")
         from collections import OrderedDict
 
         return Response(
@@ -918,19 +1021,32 @@ class SettlementViewSet(viewsets.ReadOnlyModelViewSet):
 
         return SettlementListSerializer
 
-    def get_queryset(self):
+    def _pharmacy_settlements(self):
         if not hasattr(self.request.user, "pharmacy_profile"):
             return Settlement.objects.none()
+        return Settlement.objects.filter(pharmacy=self.request.user.pharmacy_profile)
 
-        return (
-            Settlement.objects.filter(pharmacy=self.request.user.pharmacy_profile)
-            .prefetch_related("settlement_orders__order__user")
-            .order_by("-settlement_date", "-created_at")
-        )
+    def get_queryset(self):
+        queryset = annotate_settlements(self._pharmacy_settlements())
+        if self.action == "retrieve":
+            queryset = queryset.prefetch_related(settlement_orders_prefetch())
+        return queryset.order_by("-settlement_date", "-created_at")
 
     def list(self, request, *args, **kwargs):
-        queryset = self.get_queryset()
+        """
+        Settlements of the pharmacy, newest first (optionally ?status=).
+        With ?summary=true only the aggregate totals are returned.
+        """
         status_filter = request.query_params.get("status")
+        if request.query_params.get("summary", "").lower() == "true":
+            queryset = self._pharmacy_settlements()
+            if status_filter:
+                queryset = queryset.filter(status=status_filter)
+            return Response(
+                data=settlement_summary(queryset), status=status.HTTP_200_OK
+            )
+
+        queryset = self.get_queryset()
         if status_filter:
             queryset = queryset.filter(status=status_filter)
 
@@ -951,7 +1067,7 @@ class SettlementViewSet(viewsets.ReadOnlyModelViewSet):
 
     @action(methods=["get"], detail=False, url_path="statistics", url_name="statistics")
     def statistics(self, request):
-        queryset = self.get_queryset()
+        queryset = self._pharmacy_settlements()
         summary = queryset.aggregate(
             total_pending_amount=Sum(
                 "total_amount", filter=Q(status=Settlement.Status.PENDING)
@@ -1016,6 +1132,11 @@ class SettlementViewSet(viewsets.ReadOnlyModelViewSet):
                 status=status.HTTP_200_OK,
             )
 
+        settlement = (
+            annotate_settlements(Settlement.objects.filter(pk=settlement.pk))
+            .prefetch_related(settlement_orders_prefetch())
+            .get()
+        )
         serializer = SettlementDetailSerializer(settlement)
 
         return Response(
@@ -1102,7 +1223,8 @@ class PaystackWebhookView(APIView):
     """
     Single Paystack webhook for the whole platform (Paystack allows one URL).
 
-    Dispatches by event:
+    Verified events are stored and acknowledged straight away; a Celery task
+    then dispatches them by event (see webhook_service):
       - charge.success            -> mark the drug-order Payment paid
       - transfer.success/failed/reversed -> reconcile a settlement payout
 
@@ -1140,18 +1262,15 @@ class PaystackWebhookView(APIView):
         )
         logger.debug(f"Paystack webhook payload: {event_body}")
 
-        if event.startswith("charge."):
-            payment_service.apply_charge_event(event, data)
-        elif event.startswith("transfer."):
-            payout_service.apply_transfer_event(event, data)
-        else:
-            logger.info(f"Paystack webhook: ignoring unhandled event {event!r}")
+        _, created = webhook_service.ingest_event(event_body)
+        if not created:
+            logger.info(f"Paystack webhook: duplicate event {event!r} ignored")
 
         # Always 200 so Paystack doesn't retry indefinitely for events we ignore.
         return Response(status=status.HTTP_200_OK)
 
 
-class OrderPagination(PageNumberPagination):
+class OrderPagination(DefaultPagination):
     """Pagination for orders list with 'orders' key for consistency."""
 
     page_size = 20
@@ -1159,6 +1278,8 @@ class OrderPagination(PageNumberPagination):
     max_page_size = 100
 
     def get_paginated_response(self, data):
+        if self.keyset is not None:
+            return self.keyset.get_paginated_response(data, results_key="orders")
         from collections import OrderedDict
 
         return Response(
@@ -1193,75 +1314,124 @@ class OrderViewSet(viewsets.ModelViewSet):
         """Return orders for the current user's pharmacy only."""
         if not hasattr(self.request.user, "pharmacy_profile"):
             return Order.objects.none()
+        pharmacy = self.request.user.pharmacy_profile
         return (
-            Order.objects.filter(
-                pharmacy_orders__pharmacy=self.request.user.pharmacy_profile
-            )
+            Order.objects.filter(pharmacy_orders__pharmacy=pharmacy)
             .select_related("address", "user")
-            .prefetch_related("pharmacy_orders__pharmacy", "items__drug__pharmacy")
+            .prefetch_related(*self._pharmacy_prefetches(pharmacy))
             .distinct()
             .order_by("-created_at")
         )
 
-    def _build_grouped_order(self, order, pharmacy, request):
-        """Build order representation with only items from the requesting pharmacy."""
-        pharmacy_order = order.pharmacy_orders.filter(pharmacy=pharmacy).first()
-        status_value = (
-            pharmacy_order.status if pharmacy_order else PharmacyOrder.Status.PENDING
+    @staticmethod
+    def _pharmacy_prefetches(pharmacy):
+        """
+        Prefetch only the requesting pharmacy's share of each order, as
+        `own_pharmacy_orders` and `own_items`, for _build_grouped_orders.
+        """
+        return (
+            Prefetch(
+                "pharmacy_orders",
+                queryset=PharmacyOrder.objects.filter(pharmacy=pharmacy),
+                to_attr="own_pharmacy_orders",
+            ),
+            Prefetch(
+                "items",
+                queryset=OrderItem.objects.filter(drug__pharmacy=pharmacy)
+                .select_related("drug__category")
+                .order_by("created_at", "id"),
+                to_attr="own_items",
+            ),
         )
 
-        items = []
-        for item in order.items.filter(drug__pharmacy=pharmacy).select_related(
-            "drug__category"
-        ):
-            drug = item.drug
-            drug_detail = {
-                "id": str(drug.id),
-                "name": drug.name,
-                "base_unit": drug.base_unit,
-                "category": drug.category.name if drug.category_id else None,
-                "image": (
-                    request.build_absolute_uri(drug.image.url) if drug.image else None
-                ),
-            }
-            items.append(
+    def _build_grouped_orders(self, orders, pharmacy, request):
+        """
+        Build the representation of each order with only the items from the
+        requesting pharmacy. Orders must come with _pharmacy_prefetches and
+        select_related("address", "user"); rows are built from memory, so the
+        query count does not depend on how many orders there are.
+        """
+        context = {"request": request}
+        users = {}
+        addresses = {}
+        for order in orders:
+            users.setdefault(order.user_id, order.user)
+            if order.address_id:
+                addresses.setdefault(order.address_id, order.address)
+        user_data = dict(
+            zip(
+                users,
+                ShortUserSerializer(users.values(), many=True, context=context).data,
+            )
+        )
+        address_data = dict(
+            zip(
+                addresses,
+                AddressSerializer(addresses.values(), many=True, context=context).data,
+            )
+        )
+
+        grouped = []
+        for order in orders:
+            pharmacy_order = next(iter(order.own_pharmacy_orders), None)
+            status_value = (
+                pharmacy_order.status
+                if pharmacy_order
+                else PharmacyOrder.Status.PENDING
+            )
+
+            items = []
+            for item in order.own_items:
+                drug = item.drug
+                drug_detail = {
+                    "id": str(drug.id),
+                    "name": drug.name,
+                    "base_unit": drug.base_unit,
+                    "category": drug.category.name if drug.category_id else None,
+                    "image": (
+                        request.build_absolute_uri(drug.image.url)
+                        if drug.image
+                        else None
+                    ),
+                }
+                items.append(
+                    {
+                        "id": str(item.id),
+                        "drug": drug_detail,
+                        "drug_id": str(drug.id),
+                        "drug_name": drug.name,
+                        "quantity": item.quantity,
+                        "unit_price": item.unit_price,
+                        "total_price": item.total_price,
+                        "status": status_value,
+                        "created_at": item.created_at,
+                    }
+                )
+
+            grouped.append(
                 {
-                    "id": str(item.id),
-                    "drug": drug_detail,
-                    "drug_id": str(item.drug.id),
-                    "drug_name": item.drug.name,
-                    "quantity": item.quantity,
-                    "unit_price": item.unit_price,
-                    "total_price": item.total_price,
-                    "status": status_value,
-                    "created_at": item.created_at,
+                    "id": str(order.id),
+                    "order_number": order.order_number,
+                    "user": user_data[order.user_id],
+                    "status": order.status,
+                    "payment_status": order.payment_status,
+                    "subtotal": order.subtotal,
+                    "delivery_fee": order.delivery_fee,
+                    "total_amount": order.total_amount,
+                    "delivery_method": order.delivery_method,
+                    "address": str(order.address_id) if order.address_id else None,
+                    "delivery_address": address_data.get(order.address_id),
+                    "created_at": order.created_at,
+                    "updated_at": order.updated_at,
+                    "delivered_at": order.delivered_at,
+                    "items": items,
                 }
             )
+        return grouped
 
-        user_data = ShortUserSerializer(order.user, context={"request": request}).data
-        delivery_address = None
-        if order.address_id:
-            delivery_address = AddressSerializer(
-                order.address, context={"request": request}
-            ).data
-
-        return {
-            "id": str(order.id),
-            "order_number": order.order_number,
-            "user": user_data,
-            "status": order.status,
-            "payment_status": order.payment_status,
-            "subtotal": order.subtotal,
-            "delivery_fee": order.delivery_fee,
-            "total_amount": order.total_amount,
-            "delivery_method": order.delivery_method,
-            "address": str(order.address_id) if order.address_id else None,
-            "delivery_address": delivery_address,
-            "created_at": order.created_at,
-            "updated_at": order.updated_at,
-            "delivered_at": order.delivered_at,
-            "items": items,
-        }
+    def _build_grouped_order(self, order, pharmacy, request):
+        """Build order representation with only items from the requesting pharmacy."""
+        return self._build_grouped_orders([order], pharmacy, request)[0]
 
     def list(self, request: HttpRequest, *args, **kwargs):
         """Return orders for the pharmacy with only items from their pharmacy."""
@@ -1269,13 +1439,9 @@ class OrderViewSet(viewsets.ModelViewSet):
         queryset = self.filter_queryset(self.get_queryset())
         page = self.paginate_queryset(queryset)
         if page is not None:
-            grouped_orders = [
-                self._build_grouped_order(order, pharmacy, request) for order in page
-            ]
+            grouped_orders = self._build_grouped_orders(page, pharmacy, request)
             return self.get_paginated_response(grouped_orders)
-        grouped_orders = [
-            self._build_grouped_order(order, pharmacy, request) for order in queryset
-        ]
+        grouped_orders = self._build_grouped_orders(list(queryset), pharmacy, request)
         return Response(
             data={"orders": grouped_orders},
             status=status.HTTP_200_OK,
@@ -1486,11 +1652,7 @@ class OrderViewSet(viewsets.ModelViewSet):
         order = (
             Order.objects.filter(pk=order.pk)
             .select_related("address", "user")
-            .prefetch_related(
-                "pharmacy_orders__pharmacy",
-                "items__drug__pharmacy",
-                "items__drug__category",
-            )
+            .prefetch_related(*self._pharmacy_prefetches(pharmacy))
             .first()
         )
         grouped = self._build_grouped_order(order, pharmacy, request)
@@ -1503,7 +1665,6 @@ class PlaceOrderView(APIView):
     # so the caller must be authenticated.
     permission_classes = [permissions.IsAuthenticated]
 
-    @transaction.atomic
     def post(self, request):
         serializer = self.serializer_class(data=request.data)
         serializer.is_valid(raise_exception=True)
@@ -1511,55 +1672,13 @@ class PlaceOrderView(APIView):
         data = serializer.validated_data
         current_user = self.request.user
 
-        # create order object
-        order = Order.objects.create(
+        # Stock is reserved (locked, FEFO-allocated and written) atomically;
+        # an out-of-stock line rejects the whole order.
+        order = place_order(
             user=current_user,
+            items=data.get("items"),
             delivery_method=data.get("delivery_method"),
-            subtotal=0,
-            total_amount=0,
         )
-        # create order items
-        order_items = data.get("items")
-        for order_item in order_items:
-            print(order_item)
-            drug_id = order_item.get("drug")
-            quantity = order_item.get("quantity")
-
-            # get drug object
-            drug = Drug.objects.get(id=drug_id)
-            pharmacy = drug.pharmacy
-
-            # get current btach
-            today = timezone.now().today()
-            batch = drug.batches.filter(expiry_date__gte=today).first()
-
-            # create a movement item
-            _ = StockMovement.objects.create(
-                pharmacy=drug.pharmacy,
-                drug=drug,
-                batch=batch,
-                quantity=-quantity,
-                reason=StockMovement.Reason.SALE,
-            )
-
-            # create order item
-            order_item = OrderItem.objects.create(
-                order=order,
-                drug=drug,
-                quantity=quantity,
-                unit_price=drug.unit_price,
-                total_price=Decimal(drug.unit_price * quantity),
-            )
-
-            # create pharmacy order object
-            if not PharmacyOrder.objects.filter(
-                pharmacy=pharmacy, order=order
-            ).exists():
-                _ = PharmacyOrder.objects.create(pharmacy=pharmacy, order=order)
-
-            order.subtotal += order_item.total_price
-            order.total_amount = order.subtotal
-            order.save()
 
         CartService.clear_cart(str(current_user.id))
 
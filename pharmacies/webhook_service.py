@@ -0,0 +1,161 @@
+"""
+Paystack webhook ingestion.
+
+The webhook view only verifies the signature and stores the event as a
+CallBackData row (`ingest_event`), then answers 200; the event is applied
+later by the `process_webhook_events` Celery task. Each event carries an
+idempotency key (event + reference), so a redelivered event is stored once
+and applied once. Events for the same reference are applied one at a time in
+the order they were received: the consumer locks the reference's pending rows
+before applying them. A failed event is retried (ahead of the reference's
+later events) up to MAX_ATTEMPTS times by the periodic sweep, after which it
+is left for `manage.py replay_webhooks`.
+"""
+
+import hashlib
+import json
+from datetime import timedelta
+
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils import timezone
+from loguru import logger
+
+from . import payment_service, payout_service
+from .models import CallBackData
+
+MAX_ATTEMPTS = 5
+# Received events older than this are assumed to have lost their task.
+STALE_AFTER = timedelta(minutes=5)
+
+
+def _pending():
+    return CallBackData.objects.filter(
+        Q(status=CallBackData.Status.RECEIVED)
+        | Q(status=CallBackData.Status.FAILED, attempts__lt=MAX_ATTEMPTS),
+        callback_type=CallBackData.CallBackUrlType.PAYSTACK,
+    )
+
+
+def idempotency_key(event_body: dict) -> str:
+    """`paystack:<event>:<reference>`, or a hash of the body if there is no reference."""
+    event = event_body.get("event", "")
+    reference = (event_body.get("data") or {}).get("reference")
+    if not reference:
+        reference = hashlib.sha256(
+            json.dumps(event_body, sort_keys=True).encode()
+        ).hexdigest()
+    return f"paystack:{event}:{reference}"
+
+
+def ingest_event(event_body: dict):
+    """
+    Store a verified webhook event and queue it for processing once the row is
+    committed. Returns (callback, created); a duplicate returns the row stored
+    the first time and queues nothing.
+    """
+    from .tasks import process_webhook_events
+
+    data = event_body.get("data") or {}
+    key = idempotency_key(event_body)
+    try:
+        with transaction.atomic():
+            callback = CallBackData.objects.create(
+                callback_type=CallBackData.CallBackUrlType.PAYSTACK,
+                data=event_body,
+                event=event_body.get("event", "")[:100],
+                reference=str(data.get("reference") or "")[:100],
+                idempotency_key=key,
+                status=CallBackData.Status.RECEIVED,
+            )
+    except IntegrityError:
+        return CallBackData.objects.get(idempotency_key=key), False
+
+    transaction.on_commit(lambda: process_webhook_events.delay(callback.reference))
+    return callback, True
+
+
+def dispatch_event(event: str, data: dict):
+    """Apply one Paystack event to the payment or payout it concerns."""
+    if event.startswith("charge."):
+        payment_service.apply_charge_event(event, data)
+    elif event.startswith("transfer."):
+        payout_service.apply_transfer_event(event, data)
+    else:
+        logger.info(f"Paystack webhook: ignoring unhandled event {event!r}")
+
+
+def process_pending_events(reference: str) -> int:
+    """
+    Apply the reference's pending events (received, or failed with attempts
+    left), oldest first, while holding a lock on them so a concurrent consumer
+    for the same reference waits its turn. Stops at the first failure
+    (recorded on the row) so later events are not applied ahead of it.
+    Returns the number of events applied.
+    """
+    applied = 0
+    with transaction.atomic():
+        pending = list(
+            _pending()
+            .select_for_update()
+            .filter(reference=reference)
+            .order_by("created_at", "id")
+        )
+        for callback in pending:
+            body = callback.data or {}
+            callback.attempts += 1
+            try:
+                with transaction.atomic():
+                    dispatch_event(body.get("event", ""), body.get("data") or {})
+            except Exception as exc:
+                logger.exception(
+                    f"Paystack webhook {callback.uuid} ({callback.event}) failed: {exc}"
+                )
+                callback.status = CallBackData.Status.FAILED
+                callback.last_error = str(exc)
+                callback.save(
+                    update_fields=["status", "attempts", "last_error", "updated_at"]
+                )
+                break
+            callback.status = CallBackData.Status.PROCESSED
+            callback.processed_at = timezone.now()
+            callback.last_error = ""
+            callback.save(
+                update_fields=[
+                    "status",
+                    "attempts",
+                    "last_error",
+                    "processed_at",
+                    "updated_at",
+                ]
+            )
+            applied += 1
+    return applied
+
+
+def replay_events(callbacks) -> int:
+    """
+    Mark stored Paystack events as received again and process them, grouped
+    by reference in receipt order. The handlers are idempotent, so replaying
+    an event that was already applied is harmless. Returns the events applied.
+    """
+    callbacks = callbacks.filter(callback_type=CallBackData.CallBackUrlType.PAYSTACK)
+    references = sorted(set(callbacks.values_list("reference", flat=True)))
+    callbacks.update(
+        status=CallBackData.Status.RECEIVED, attempts=0, updated_at=timezone.now()
+    )
+    return sum(process_pending_events(reference) for reference in references)
+
+
+def stale_references() -> list:
+    """References with failed events to retry or received events left unprocessed."""
+    return sorted(
+        set(
+            _pending()
+            .filter(
+                Q(status=CallBackData.Status.FAILED)
+                | Q(created_at__lt=timezone.now() - STALE_AFTER)
+            )
+            .values_list("reference", flat=True)
+        )
+    )
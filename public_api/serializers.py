@@ -1,4 +1,3 @@
-import math
 from rest_framework import serializers
 from accounts.serializers import UserSerializer
 from communities import models as community_models
@@ -7,15 +6,6 @@ from pharmacies.models import PharmacyProfile, Drug, DrugCategory
 from django.utils import timezone
 
 
-def haversine_km(lat1, lon1, lat2, lon2):
-    """Return distance in km between two lat/lng points."""
-    R = 6371
-    lat1, lon1, lat2, lon2 = map(math.radians, [float(lat1), float(lon1), float(lat2), float(lon2)])
-    dlat, dlon = lat2 - lat1, lon2 - lon1
-    a = math.sin(dlat / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon / 2) ** 2
-    return R * 2 * math.asin(math.sqrt(a))
-
-
 class LocumJobRoleSerializer(serializers.ModelSerializer):
     """
     Serializer for locum job roles
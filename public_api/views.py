@@ -1,4 +1,4 @@
-from django.db.models import Q, Min, Sum, Max
+from django.db.models import Q, Max
 from communities import models as community_models
 from rest_framework.viewsets import ModelViewSet
 from django.utils import timezone
@@ -11,6 +11,9 @@ from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework import status
 from pharmacies import models as pharmacy_models
+from pharmacies.filters import DrugSearchFilter
+from pharmacies.geo_service import by_distance, location_query
+from pharmacies.stock_service import annotate_stock
 
 
 """ LOCUM JOBS """
@@ -139,16 +142,16 @@ class ProfessionalProfileViewSet(ModelViewSet):
 
 class InventoryViewSet(ModelViewSet):
     """
-    Public pharmacy inventory. Supports location-based sorting via ?lat=&lng= query params.
+    Public pharmacy inventory. Supports location-based sorting via ?lat=&lng= query params
+    (with optional ?radius= and ?k=), and ranked drug search via ?search=.
     """
 
     serializer_class = serializers.DrugInventorySerializer
     filter_backends = [
         DjangoFilterBackend,
-        filters.SearchFilter,
         filters.OrderingFilter,
+        DrugSearchFilter,
     ]
-    search_fields = ["name", "category__name", "base_unit"]
     ordering_fields = [
         "name",
         "available_quantity",
@@ -162,67 +165,50 @@ class InventoryViewSet(ModelViewSet):
     def get_queryset(self):
         today = timezone.now().date()
         return (
-            pharmacy_models.Drug.objects.filter(pharmacy__is_verified=True)
-            .annotate(
-                available_quantity=Sum(
-                    "movements__quantity",
-                    filter=Q(movements__batch__expiry_date__gte=today),
-                ),
-                nearest_expiry=Min(
-                    "batches__expiry_date",
-                    filter=Q(batches__expiry_date__gte=today),
-                ),
+            annotate_stock(
+                pharmacy_models.Drug.objects.filter(pharmacy__is_verified=True), today
             )
             .filter(available_quantity__gt=0)
             .select_related("category", "pharmacy")
         )
 
     def list(self, request, *args, **kwargs):
-        from .serializers import haversine_km
-
-        lat_param = request.query_params.get("lat")
-        lng_param = request.query_params.get("lng")
-
+        """
+        With ?lat=&lng=, drugs are ordered by their pharmacy's distance, which
+        is computed and sorted in SQL so only the requested page is loaded.
+        ?radius= (km, default geo_service.DEFAULT_RADIUS_KM) keeps drugs from
+        pharmacies within it; ?k= returns the k nearest drugs.
+        """
         queryset = self.filter_queryset(self.get_queryset())
 
-        # Location-aware path: sort by distance
-        if lat_param and lng_param:
-            try:
-                user_lat = float(lat_param)
-                user_lng = float(lng_param)
-            except (ValueError, TypeError):
-                user_lat = user_lng = None
-        else:
-            user_lat = user_lng = None
+        try:
+            user_lat, user_lng, radius, k = location_query(request.query_params)
+        except ValueError:
+            user_lat = None
 
-        if user_lat is not None:
-            drugs = list(queryset)
-            distances = {}
-            for drug in drugs:
-                p = drug.pharmacy
-                if p.latitude and p.longitude:
-                    distances[drug.id] = haversine_km(
-                        user_lat, user_lng, float(p.latitude), float(p.longitude)
-                    )
-                else:
-                    distances[drug.id] = float("inf")
-
-            drugs.sort(key=lambda d: distances[d.id])
-
-            page = self.paginate_queryset(drugs)
-            ctx = {**self.get_serializer_context(), "distances": distances}
+        # Default path (no location)
+        if user_lat is None:
+            page = self.paginate_queryset(queryset)
             if page is not None:
-                serializer = self.get_serializer(page, many=True, context=ctx)
+                serializer = self.get_serializer(page, many=True)
                 return self.get_paginated_response(serializer.data)
-            serializer = self.get_serializer(drugs, many=True, context=ctx)
+            serializer = self.get_serializer(queryset, many=True)
             return Response(serializer.data)
 
-        # Default path (no location)
-        page = self.paginate_queryset(queryset)
+        # Location-aware path: nearest pharmacies first
+        drugs = by_distance(
+            queryset, user_lat, user_lng, radius, k, prefix="pharmacy__"
+        )
+        page = self.paginate_queryset(drugs)
+        rows = page if page is not None else drugs
+        distances = {
+            drug.id: float("inf") if drug.distance_km is None else drug.distance_km
+            for drug in rows
+        }
+        ctx = {**self.get_serializer_context(), "distances": distances}
+        serializer = self.get_serializer(rows, many=True, context=ctx)
         if page is not None:
-            serializer = self.get_serializer(page, many=True)
             return self.get_paginated_response(serializer.data)
-        serializer = self.get_serializer(queryset, many=True)
         return Response(serializer.data)
 
 